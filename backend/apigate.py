@@ -1,4 +1,5 @@
 import os
+import json
 import random
 from datetime import date as dt
 from datetime import datetime
@@ -14,6 +15,11 @@ import dbserver as db         #FOR SQL SERVER DATABASE
 import loginscript as login   #FOR SQL SERVER DATABASE
 from flask_cors import CORS
 import reportgen as report
+import invmatrix as inv        #IN-MEMORY STOCK FOR THE INVENTORY READ ROUTES
+import router                  #NEAREST-WAREHOUSE ORDER ROUTING
+import rebalance               #INTER-WAREHOUSE REBALANCING PLANNER
+import reportcache             #GENERATED REPORT CACHE
+import reportjobs              #BACKGROUND REPORT GENERATION
 
 app = Flask(__name__)
 CORS(app)
@@ -25,6 +31,16 @@ TEMP_FOLDER = os.path.join(APP_ROOT, 'temp_files')
 app.config['TEMP_FOLDER'] = TEMP_FOLDER
 app.config['SECRET_KEY'] = "spacIFY_792739"
 
+# Bring products.db up to the latest schema before serving requests
+db.migrate()
+inv.matrix.load()
+router.index.load()
+
+# Hand the request thread's database connections back to the pool once the request is done
+@app.teardown_appcontext
+def release_db(exc):
+    db.release_conns()
+
 @app.route('/')
 def home():
     #return redirect(url_for('intro'))
@@ -114,7 +130,9 @@ def addwarehouse():
         name = request.form['name']
         location = request.form['location']
         quantity = request.form['quantity']
-        if db.add_warehouse(name, location, quantity):
+        latitude = request.form.get('latitude', type=float)
+        longitude = request.form.get('longitude', type=float)
+        if db.add_warehouse(name, location, quantity, latitude, longitude):
             return jsonify("Warehouse Added"), 200
         else:
             return jsonify("Warehouse Addition Failed"), 404
@@ -174,7 +192,7 @@ def updateinventory():
 def getinventorylevels():
     if request.method == 'GET':
         product_id = request.form['product_id']
-        inventory = db.get_inventory_levels(product_id)
+        inventory = inv.get_inventory_levels(product_id)
         return jsonify(inventory), 200
     else:
         return jsonify("ERROR : contact the correct endpoint for the API"), 404
@@ -274,7 +292,7 @@ def get_warehouse_by_location():
 @app.route('/api/v1/get_inventory_by_product', methods=['GET'])
 def get_inventory_by_product():
     product_id = request.args.get('product_id')
-    inventory = db.get_inventory_by_product(product_id)
+    inventory = inv.get_inventory_by_product(product_id)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -284,7 +302,7 @@ def get_inventory_by_product():
 @app.route('/api/v1/get_inventory_by_warehouse', methods=['GET'])
 def get_inventory_by_warehouse():
     warehouse_id = request.args.get('warehouse_id')
-    inventory = db.get_inventory_by_warehouse(warehouse_id)
+    inventory = inv.get_inventory_by_warehouse(warehouse_id)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -295,7 +313,7 @@ def get_inventory_by_warehouse():
 def get_inventory_by_product_and_warehouse():
     product_id = request.args.get('product_id')
     warehouse_id = request.args.get('warehouse_id')
-    inventory = db.get_inventory_by_product_and_warehouse(product_id, warehouse_id)
+    inventory = inv.get_inventory_by_product_and_warehouse(product_id, warehouse_id)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -305,7 +323,7 @@ def get_inventory_by_product_and_warehouse():
 @app.route('/api/v1/get_inventory_by_quantity', methods=['GET'])
 def get_inventory_by_quantity():
     quantity = request.args.get('quantity')
-    inventory = db.get_inventory_by_quantity(quantity)
+    inventory = inv.get_inventory_by_quantity(quantity)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -316,7 +334,7 @@ def get_inventory_by_quantity():
 def get_inventory_by_product_and_quantity():
     product_id = request.args.get('product_id')
     quantity = request.args.get('quantity')
-    inventory = db.get_inventory_by_product_and_quantity(product_id, quantity)
+    inventory = inv.get_inventory_by_product_and_quantity(product_id, quantity)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -327,7 +345,7 @@ def get_inventory_by_product_and_quantity():
 def get_inventory_by_warehouse_and_quantity():
     warehouse_id = request.args.get('warehouse_id')
     quantity = request.args.get('quantity')
-    inventory = db.get_inventory_by_warehouse_and_quantity(warehouse_id, quantity)
+    inventory = inv.get_inventory_by_warehouse_and_quantity(warehouse_id, quantity)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -339,7 +357,7 @@ def get_inventory_by_product_and_warehouse_and_quantity():
     product_id = request.args.get('product_id')
     warehouse_id = request.args.get('warehouse_id')
     quantity = request.args.get('quantity')
-    inventory = db.get_inventory_by_product_and_warehouse_and_quantity(product_id, warehouse_id, quantity)
+    inventory = inv.get_inventory_by_product_and_warehouse_and_quantity(product_id, warehouse_id, quantity)
     if inventory:
         return jsonify(inventory),200
     else:
@@ -356,6 +374,29 @@ def get_warehouse_location_by_id():
         jsonify("Product not found"), 404
     # return jsonify(location) if location else jsonify("Location not found"), 404
 
+# Query products, warehouses or inventory with filters, sorting, projection and a limit
+# e.g. /api/v1/query/inventory?warehouse_id=3&quantity__lt=20&sort=quantity&fields=product_id,quantity&limit=100
+# Filters are column=value or column__op=value with op one of eq, lt, gt, between, in;
+# between and in take comma separated values.
+@app.route('/api/v1/query/<entity>', methods=['GET'])
+def query(entity):
+    filters = []
+    for key, value in request.args.items():
+        if key in ('sort', 'fields', 'limit'):
+            continue
+        column, _, op = key.partition('__')
+        op = op or 'eq'
+        values = value.split(',') if op in ('in', 'between') else [value]
+        filters.append((column, op, values))
+    sort = [s for s in request.args.get('sort', '').split(',') if s]
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    limit = request.args.get('limit', 1000)
+    try:
+        rows = db.query(entity, filters, sort, fields, limit)
+    except ValueError as e:
+        return jsonify(f"ERROR : {e}"), 400
+    return jsonify(rows), 200
+
 # Routes for adding transactions
 @app.route('/api/v1/add_transaction', methods=['POST'])
 def add_transaction():
@@ -380,6 +421,40 @@ def add_sale():
     else:
         return jsonify("Sale addition failed"), 404
 
+# Records many sales in one commit
+# Body is JSON ({"sales": [...], "all_or_nothing": true} or a bare list) or NDJSON, one sale object per line.
+# Each sale is {"product_id": 1, "warehouse_id": 1, "quantity": 3}; "quantity_sold" is accepted too.
+@app.route('/api/v1/add_sales_bulk', methods=['POST'])
+def add_sales_bulk():
+    all_or_nothing = request.args.get('all_or_nothing', '').lower() in ('1', 'true', 'yes')
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        # Each line is parsed on its own, so a bad line is reported by number
+        sales = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                sale = json.loads(line)
+            except ValueError as e:
+                return jsonify(f"Malformed sale on line {number}: {e}"), 400
+            if not isinstance(sale, dict):
+                return jsonify(f"Malformed sale on line {number}: expected a JSON object"), 400
+            sales.append(sale)
+    else:
+        data = request.get_json(force=True, silent=True)
+        if data is None:
+            return jsonify("Malformed sales payload"), 400
+        if isinstance(data, dict):
+            all_or_nothing = all_or_nothing or bool(data.get('all_or_nothing'))
+            data = data.get('sales', [])
+        sales = data
+    try:
+        lines = [(s.get('product_id'), s.get('warehouse_id'), s.get('quantity', s.get('quantity_sold'))) for s in sales]
+    except (ValueError, AttributeError, TypeError):
+        return jsonify("Malformed sales payload"), 400
+    result = db.add_sales(lines, all_or_nothing)
+    return jsonify(result), 200 if result["committed"] else 409
+
 @app.route('/api/v1/add_transfer', methods=['POST'])
 def add_transfer():
     data = request.form
@@ -392,23 +467,210 @@ def add_transfer():
     else:
         return jsonify("Transfer addition failed"), 404
 
+# Moves many products between two warehouses in one commit
+# JSON body: {"source_warehouse_id": 1, "destination_warehouse_id": 2, "items": [{"product_id": 1, "quantity": 5}, ...]}
+@app.route('/api/v1/add_transfers_batch', methods=['POST'])
+def add_transfers_batch():
+    data = request.get_json(silent=True) or {}
+    source_warehouse_id = data.get('source_warehouse_id')
+    destination_warehouse_id = data.get('destination_warehouse_id')
+    items = [(item.get('product_id'), item.get('quantity')) for item in data.get('items', [])]
+    if db.add_transfers(source_warehouse_id, destination_warehouse_id, items):
+        return jsonify("Transfers added"), 200
+    else:
+        return jsonify("Transfer addition failed"), 404
+
+# Function to read the date_from/date_to query arguments as timestamps (None when absent).
+# Raises ValueError for a date that isn't "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS".
+def date_range_args():
+    return tuple(db.to_ts(value) if value else None
+                 for value in (request.args.get('date_from'), request.args.get('date_to')))
+
 # Route for getting transactions
 @app.route('/api/v1/get_transactions', methods=['GET'])
 def get_transactions():
     product_id = request.args.get('product_id')
     warehouse_id = request.args.get('warehouse_id')
     transaction_type = request.args.get('transaction_type')
-    date_from = request.args.get('date_from')
-    date_to = request.args.get('date_to')
     product_name = request.args.get('product_name')
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    try:
+        date_from, date_to = date_range_args()
+        if limit is not None:
+            if not limit.isdigit() or int(limit) < 1:
+                raise ValueError(f"invalid limit {limit!r}, expected a positive integer")
+            limit = int(limit)
+        after = db.parse_cursor(after) if after else None
+    except ValueError as e:
+        return jsonify(f"ERROR : {e}"), 400
+    # format=ndjson streams every matching row, one JSON array per line
+    if request.args.get('format') == 'ndjson':
+        rows = db.iter_transactions(product_id, warehouse_id, transaction_type, date_from, date_to, product_name)
+        return Response(stream_with_context(json.dumps(row) + "\n" for row in rows), mimetype='application/x-ndjson')
+    # limit/after return one page plus the cursor for the next one
+    if limit is not None:
+        transactions = db.get_transactions(product_id, warehouse_id, transaction_type, date_from, date_to, product_name, limit, after)
+        next_cursor = db.make_cursor(transactions[-1]) if len(transactions) == limit else None
+        return jsonify({"transactions": transactions, "next": next_cursor}), 200
     transactions = db.get_transactions(product_id, warehouse_id, transaction_type, date_from, date_to, product_name)
-    return jsonify(transactions) if transactions else jsonify("Transactions not found"), 404
-
+    return (jsonify(transactions), 200) if transactions else (jsonify("Transactions not found"), 404)
+
+# Daily sales per product and warehouse, read from the daily_sales rollup
+@app.route('/api/v1/daily_sales', methods=['GET'])
+def daily_sales():
+    try:
+        date_from, date_to = date_range_args()
+    except ValueError as e:
+        return jsonify(f"ERROR : {e}"), 400
+    product_id = request.args.get('product_id')
+    warehouse_id = request.args.get('warehouse_id')
+    client_id = request.args.get('client_id')
+    sales = db.get_daily_sales(date_from and db.ts_day(date_from), date_to and db.ts_day(date_to),
+                               product_id, warehouse_id, client_id)
+    return jsonify(sales), 200
+
+# Nearest warehouse(s) holding enough stock to fulfil an order
+@app.route('/api/v1/route_order', methods=['GET'])
+def route_order():
+    try:
+        routes = router.route_order(request.args.get('product_id'), request.args.get('quantity', 1),
+                                    request.args.get('latitude'), request.args.get('longitude'),
+                                    request.args.get('count', 1))
+    except (TypeError, ValueError) as e:
+        return jsonify(f"Invalid order: {e}"), 400
+    if not routes:
+        return jsonify("No warehouse can fulfil this order"), 404
+    return jsonify([{"warehouse_id": warehouse_id, "warehouse_name": name, "distance_km": distance_km, "stock": stock}
+                    for warehouse_id, name, distance_km, stock in routes]), 200
+
+# Routes many orders at once and records them as sales in one commit; preview=true only plans
+# JSON body: {"orders": [{"product_id": 1, "quantity": 2, "latitude": 19.07, "longitude": 72.87}, ...], "all_or_nothing": false}
+@app.route('/api/v1/route_orders_batch', methods=['POST'])
+def route_orders_batch():
+    preview = request.args.get('preview', '').lower() in ('1', 'true', 'yes')
+    all_or_nothing = request.args.get('all_or_nothing', '').lower() in ('1', 'true', 'yes')
+    data = request.get_json(force=True, silent=True)
+    if isinstance(data, dict):
+        all_or_nothing = all_or_nothing or bool(data.get('all_or_nothing'))
+        data = data.get('orders')
+    if not isinstance(data, list):
+        return jsonify("Malformed orders payload"), 400
+    result = router.route_orders(data, commit=not preview, all_or_nothing=all_or_nothing)
+    return jsonify(result), 200 if preview or result["committed"] else 409
+
+# Rebalancing plan: GET previews the cheapest transfers covering projected demand, POST executes
+# them as one commit. POST may carry a previewed plan as {"moves": [...]}; otherwise a fresh plan is made.
+@app.route('/api/v1/rebalance', methods=['GET', 'POST'])
+def rebalance_plan():
+    horizon_days = request.args.get('horizon_days', rebalance.HORIZON_DAYS, type=int)
+    history_days = request.args.get('history_days', rebalance.HISTORY_DAYS, type=int)
+    if horizon_days <= 0 or history_days <= 0:
+        return jsonify("horizon_days and history_days must be positive"), 400
+    data = request.get_json(silent=True) if request.method == 'POST' else None
+    if isinstance(data, dict) and 'moves' in data:
+        plan = {"moves": data['moves']}
+    else:
+        plan = rebalance.plan_rebalance(rebalance.projected_demand(horizon_days, history_days))
+    if request.method == 'GET':
+        return jsonify(plan), 200
+    try:
+        result = rebalance.execute_plan(plan["moves"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify("Malformed transfer plan"), 400
+    if result:
+        return jsonify(dict(plan, executed=result)), 200
+    return jsonify("Transfer plan failed"), 409
+
+# Forecast daily sales per product and warehouse, read from the forecasts table
+@app.route('/api/v1/forecasts', methods=['GET'])
+def forecasts():
+    date_from = request.args.get('date_from')
+    date_to = request.args.get('date_to')
+    product_id = request.args.get('product_id')
+    warehouse_id = request.args.get('warehouse_id')
+    client_id = request.args.get('client_id')
+    rows = db.get_forecasts(date_from, date_to, product_id, warehouse_id, client_id)
+    return jsonify(rows), 200
+
+# Fill ratio of every warehouse, read from the occupancy counters
+@app.route('/api/v1/warehouse_utilization', methods=['GET'])
+def warehouse_utilization():
+    utilization = [{"warehouse_id": warehouse_id, "warehouse_name": name, "capacity": capacity,
+                    "occupied": occupied, "fill_ratio": fill_ratio}
+                   for warehouse_id, name, capacity, occupied, fill_ratio in db.get_warehouse_utilization()]
+    return jsonify(utilization), 200
+
+# Inventory pairs at or below their reorder point, computed by reorder.py on a schedule
+@app.route('/api/v1/reorder_suggestions', methods=['GET'])
+def reorder_suggestions():
+    warehouse_id = request.args.get('warehouse_id')
+    client_id = request.args.get('client_id')
+    suggestions = [{"product_id": product_id, "warehouse_id": warehouse_id, "quantity": quantity,
+                    "reorder_point": reorder_point, "safety_stock": safety_stock, "daily_demand": daily_demand}
+                   for product_id, warehouse_id, quantity, reorder_point, safety_stock, daily_demand
+                   in db.get_reorder_suggestions(warehouse_id, client_id)]
+    return jsonify(suggestions), 200
+
+# Returns the client's report when it is already cached (e.g. pre-generated by reportbatch.py);
+# otherwise queues it like POST /api/v1/reportgen/jobs and returns 202 with the job id to poll,
+# so no request thread waits on the model. Prefer /api/v1/reportgen/stream for new callers.
 @app.route('/api/v1/reportgen', methods=['GET'])
 def reportgen():
     client_id = request.args.get('email')
-    genreport = report.gen_report(client_id)
-    return jsonify(genreport)
+    if not client_id:
+        return jsonify("email is required"), 400
+    cached, _, _ = report.cached_report(client_id)
+    if cached is not None:
+        return jsonify(cached), 200
+    job = reportjobs.jobs.submit(client_id)
+    return jsonify({"job_id": job["job_id"], "status": job["status"]}), 202, \
+        {'Location': f"/api/v1/reportgen/jobs/{job['job_id']}"}
+
+# Queues a report for the client and returns its job id at once; a job already in flight for the client is reused
+@app.route('/api/v1/reportgen/jobs', methods=['POST'])
+def reportgen_submit():
+    client_id = request.args.get('email')
+    if not client_id:
+        return jsonify("email is required"), 400
+    job = reportjobs.jobs.submit(client_id)
+    return jsonify({"job_id": job["job_id"], "status": job["status"]}), 202
+
+# Status of a report job, with the report once it is done
+@app.route('/api/v1/reportgen/jobs/<job_id>', methods=['GET'])
+def reportgen_job(job_id):
+    job = reportjobs.jobs.status(job_id)
+    if job is None:
+        return jsonify("Job not found"), 404
+    return jsonify(job), 200
+
+# Streams the client's report as Server-Sent Events while the model writes it: one "data:" event per
+# JSON-encoded text delta, then an "end" event, or an "error" event if generation fails or times out.
+# Generation runs as the client's report job, so it shares the worker pool, the timeout and the job
+# already in flight for the client with every other report route.
+@app.route('/api/v1/reportgen/stream', methods=['GET'])
+def reportgen_stream():
+    client_id = request.args.get('email')
+    if not client_id:
+        return jsonify("email is required"), 400
+    job_id = reportjobs.jobs.submit(client_id)["job_id"]
+
+    def events():
+        try:
+            for delta in reportjobs.jobs.follow(job_id):
+                yield f"data: {json.dumps(delta)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+            return
+        yield "event: end\ndata: {}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Hit and miss counts and size of the generated report cache
+@app.route('/api/v1/reportgen/cache_stats', methods=['GET'])
+def reportgen_cache_stats():
+    return jsonify(reportcache.cache.stats()), 200
 
 
 
@@ -0,0 +1,168 @@
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import numpy as np
+
+import dbserver as db
+import forecast
+
+# Rolling-origin backtest of the forecasting methods against naive baselines.
+# Daily sales are read straight from the transactions ledger, a chunk of products at a time
+# through the (product_id, warehouse_id, ts, ...) covering index, so only one chunk of series is
+# ever in memory however long the ledger is. Chunks are scored in a process pool. For each origin
+# every method is fitted on the TRAIN_DAYS before it and scored on the HORIZON days after it.
+#   python backtest.py [through YYYY-MM-DD] [workers]
+# prints the overall scores and writes backtest_by_product.csv and backtest_by_warehouse.csv.
+
+TRAIN_DAYS = forecast.HISTORY_DAYS
+HORIZON = 7             # days forecast from each origin
+ORIGINS = 4             # origins, HORIZON days apart, ending HORIZON days before `through`
+CHUNK_PRODUCTS = 200    # products per chunk read from the ledger
+
+
+def _naive(y, first_weekday, horizon):
+    return np.repeat(y[:, -1:], horizon, axis=1)
+
+def _seasonal_naive(y, first_weekday, horizon):
+    return y[:, [y.shape[1] - forecast.SEASON + h % forecast.SEASON for h in range(horizon)]]
+
+def _moving_average(y, first_weekday, horizon):
+    return np.repeat(y[:, -28:].mean(axis=1, keepdims=True), horizon, axis=1)
+
+def _smoothing(**grid):
+    def method(y, first_weekday, horizon):
+        state = forecast.fit(y, first_weekday, **grid)
+        last = (first_weekday + y.shape[1] - 1) % forecast.SEASON
+        weekdays = [(last + h) % forecast.SEASON for h in range(1, horizon + 1)]
+        return np.maximum(state["level"][:, None] + state["season"][:, weekdays], 0.0)
+    return method
+
+# Candidate methods: name -> method(train (series x days), weekday of its first day, horizon) -> (series x horizon)
+METHODS = {
+    "naive": _naive,
+    "seasonal_naive": _seasonal_naive,
+    "moving_average_28": _moving_average,
+    "ses": _smoothing(alphas=(0.3,), gammas=(0.0,), naive=False),
+    "holt_winters": _smoothing(alphas=(0.3,), gammas=(0.15,), naive=False),
+    "auto": _smoothing(),               # what forecast.py fit/refresh uses in production
+}
+# Per-series accumulators: summed |error| / actual and its count over days with sales, summed error, summed actual
+STATS = 4
+
+
+# Read one chunk of series from the ledger: (product_ids, warehouse_ids, y as series x days)
+def load_chunk(lo, hi, start, n_days):
+    start_ts = db.to_ts(start.isoformat())
+    # Summed per day in NumPy rather than GROUP BY, which would add a temp B-tree sort per chunk
+    rows = db.get_conn().execute("""
+    SELECT (product_id << 32) | warehouse_id, (ts - ?) / 86400, -quantity
+    FROM transactions
+    WHERE product_id >= ? AND product_id <= ? AND type_id = ? AND ts >= ? AND ts < ?
+    """, (start_ts, lo, hi, db.SALE, start_ts, start_ts + n_days * 86400)).fetchall()
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, n_days))
+    data = np.array(rows, dtype=np.int64)
+    keys, series = np.unique(data[:, 0], return_inverse=True)
+    y = np.zeros((len(keys), n_days))
+    np.add.at(y, (series, data[:, 1]), data[:, 2])
+    return keys >> 32, keys & 0xFFFFFFFF, y
+
+# Score every method on one chunk: (product_ids, warehouse_ids, stats shaped series x methods x STATS)
+def score_chunk(task):
+    lo, hi, start, n_days = task
+    products, warehouses, y = load_chunk(lo, hi, start, n_days)
+    stats = np.zeros((len(y), len(METHODS), STATS))
+    for k in range(ORIGINS):
+        origin = n_days - (ORIGINS - k) * HORIZON
+        train, actual = y[:, origin - TRAIN_DAYS:origin], y[:, origin:origin + HORIZON]
+        first_weekday = (start + timedelta(days=origin - TRAIN_DAYS)).weekday()
+        sold = actual > 0
+        for m, method in enumerate(METHODS.values()):
+            err = method(train, first_weekday, HORIZON) - actual
+            stats[:, m, 0] += np.where(sold, np.abs(err) / np.where(sold, actual, 1), 0).sum(axis=1)
+            stats[:, m, 1] += sold.sum(axis=1)
+            stats[:, m, 2] += err.sum(axis=1)
+            stats[:, m, 3] += actual.sum(axis=1)
+    return products, warehouses, stats
+
+def _init_worker(path):
+    db.proddb = path
+
+
+# MAPE (%) over days with sales and bias (% of actual volume) from accumulated STATS
+def metrics(stats):
+    mape = np.where(stats[..., 1] > 0, stats[..., 0] / np.maximum(stats[..., 1], 1) * 100, np.nan)
+    bias = np.where(stats[..., 3] > 0, stats[..., 2] / np.maximum(stats[..., 3], 1) * 100, np.nan)
+    return mape, bias
+
+# Function to run the backtest over every series with sales in the window ending on `through`.
+# Returns {"overall": {method: (mape, bias)}, "by_product": {...}, "by_warehouse": {...}, "series", "seconds"}
+def run(through=None, workers=None):
+    started = time.perf_counter()
+    through = through or forecast.last_complete_day()
+    n_days = TRAIN_DAYS + ORIGINS * HORIZON
+    start = through - timedelta(days=n_days - 1)
+    ids = [p for p, in db.get_conn().execute("SELECT product_id FROM products ORDER BY product_id")]
+    tasks = [(ids[i], ids[min(i + CHUNK_PRODUCTS, len(ids)) - 1], start, n_days) for i in range(0, len(ids), CHUNK_PRODUCTS)]
+
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1 and len(tasks) > 1:
+        # Spawned, not forked: workers open their own connections instead of inheriting the parent's
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker, initargs=(db.proddb,))
+        chunks = pool.map(score_chunk, tasks)
+    else:
+        chunks = map(score_chunk, tasks)
+
+    overall = np.zeros((len(METHODS), STATS))
+    by_product = {}
+    by_warehouse = {}
+    n_series = 0
+    try:
+        for products, warehouses, stats in chunks:
+            n_series += len(stats)
+            overall += stats.sum(axis=0)
+            # Chunks hold whole products, so product totals are final; warehouse totals keep adding up
+            for groups, column in ((by_product, products), (by_warehouse, warehouses)):
+                keys, at = np.unique(column, return_inverse=True)
+                sums = np.zeros((len(keys),) + stats.shape[1:])
+                np.add.at(sums, at, stats)
+                for key, total in zip(keys.tolist(), sums):
+                    groups[key] = groups.get(key, 0) + total
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    def table(groups):
+        return {key: dict(zip(METHODS, zip(*(v.tolist() for v in metrics(stats))))) for key, stats in groups.items()}
+    return {"overall": table({"all": overall})["all"], "by_product": table(by_product), "by_warehouse": table(by_warehouse),
+            "series": n_series, "through": through.isoformat(), "workers": workers, "seconds": time.perf_counter() - started}
+
+def write_csv(path, groups, label):
+    with open(path, "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow([label, "method", "mape", "bias"])
+        for key, scores in sorted(groups.items()):
+            for method, (mape, bias) in scores.items():
+                out.writerow([key, method, round(mape, 2), round(bias, 2)])
+
+
+if __name__ == "__main__":
+    through = date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else None
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    db.migrate()
+    result = run(through, workers)
+    print(f"Backtest of {result['series']} series through {result['through']}, {ORIGINS} origins x {HORIZON} days, "
+          f"{result['workers']} workers: {result['seconds']:.1f}s wall-clock")
+    print(f"  {'method':<20} {'MAPE %':>8} {'bias %':>8}")
+    for method, (mape, bias) in result["overall"].items():
+        print(f"  {method:<20} {mape:>8.1f} {bias:>8.1f}")
+    write_csv("backtest_by_product.csv", result["by_product"], "product_id")
+    write_csv("backtest_by_warehouse.csv", result["by_warehouse"], "warehouse_id")
+    print("  per-product and per-warehouse scores written to backtest_by_product.csv and backtest_by_warehouse.csv")
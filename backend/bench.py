@@ -0,0 +1,941 @@
+import json
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+
+import dbserver as db
+
+# Micro-benchmarks for the database layer.
+# Every benchmark runs against a throwaway copy of the schema, never products.db.
+#   python bench.py            -> run all benchmarks
+#   python bench.py reads      -> run a single benchmark by name
+#   python bench.py plans      -> fail if a hot query plan does a full table scan
+
+N_PRODUCTS = 200
+N_WAREHOUSES = 20
+N_CALLS = 5000
+
+
+def setup_db(schema=None):
+    path = os.path.join(tempfile.mkdtemp(prefix="spacify_bench_"), "bench.db")
+    db.close_all()
+    db.proddb = path
+    db.migrate(schema)
+    conn = db.get_conn()
+    with conn:
+        conn.executemany("INSERT INTO warehouses (warehouse_name, location, capacity) VALUES (?, ?, ?)",
+                         [(f"W{w}", f"City {w}", 1_000_000) for w in range(1, N_WAREHOUSES + 1)])
+        conn.executemany("INSERT INTO products (product_name, description, price, category, client_id) VALUES (?, ?, ?, ?, ?)",
+                         [(f"P{p}", "", p % 50 + 0.99, f"C{p % 10}", p % 5 + 1) for p in range(1, N_PRODUCTS + 1)])
+        conn.executemany("INSERT INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                         [(p, w, 1000) for p in range(1, N_PRODUCTS + 1) for w in range(1, N_WAREHOUSES + 1)])
+    if db.schema_version() >= 8:
+        db.rebuild_warehouse_occupancy()
+    return path
+
+
+def timeit(label, fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<28} {n / elapsed:>12,.0f} calls/s   {elapsed / n * 1e6:>8.1f} us/call")
+    return elapsed
+
+
+# The pre-pooling access pattern: open, query, close on every call
+def legacy_query(path, sql, params):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute(sql, params)
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+
+def bench_reads():
+    path = setup_db()
+    print(f"read helpers, {N_CALLS} calls each")
+    cases = [
+        ("get_inventory_levels",
+         "SELECT w.warehouse_name, i.quantity FROM inventory i JOIN warehouses w ON i.warehouse_id = w.warehouse_id WHERE i.product_id = ?",
+         lambda i: (i % N_PRODUCTS + 1,),
+         lambda i: db.get_inventory_levels(i % N_PRODUCTS + 1)),
+        ("get_product_by_client_id",
+         "SELECT * FROM products WHERE client_id=?",
+         lambda i: (i % 5 + 1,),
+         lambda i: db.get_product_by_client_id(i % 5 + 1)),
+        ("get_warehouse_by_id",
+         "SELECT * FROM warehouses WHERE warehouse_id=?",
+         lambda i: (i % N_WAREHOUSES + 1,),
+         lambda i: db.get_warehouse_by_id(i % N_WAREHOUSES + 1)),
+        ("get_inventory_by_product_and_warehouse",
+         "SELECT * FROM inventory WHERE product_id=? AND warehouse_id=?",
+         lambda i: (i % N_PRODUCTS + 1, i % N_WAREHOUSES + 1),
+         lambda i: db.get_inventory_by_product_and_warehouse(i % N_PRODUCTS + 1, i % N_WAREHOUSES + 1)),
+    ]
+    for name, sql, params, pooled in cases:
+        print(name)
+        before = timeit("before (connect per call)", lambda i: legacy_query(path, sql, params(i)), N_CALLS)
+        after = timeit("after (pooled connection)", pooled, N_CALLS)
+        print(f"  speedup {before / after:.1f}x")
+
+
+# EXPLAIN QUERY PLAN check (test_plans.py): exits non-zero if a hot query falls back to a full table scan
+def bench_plans():
+    import test_plans
+    try:
+        test_plans.test_hot_queries_use_an_index()
+    except AssertionError as e:
+        print(f"FULL SCAN: {e}")
+        sys.exit(1)
+    print(f"query plans: all {len(db.HOT_QUERIES)} hot queries use an index")
+
+
+# Concurrent add_sale stress test (test_stress.py) with more threads: exits non-zero if stock,
+# successful sales and logged rows disagree (lost updates)
+def bench_stress(threads=8, sales_per_thread=500):
+    import test_stress
+    stock, sold, left, logged, elapsed = test_stress.sell_concurrently(threads, sales_per_thread)
+    print(f"stress: {threads} threads x {sales_per_thread} sales against stock {stock}")
+    print(f"  {threads * sales_per_thread / elapsed:,.0f} sale attempts/s, {sold / elapsed:,.0f} sales/s")
+    print(f"  sold {sold}, stock left {left}, logged rows {logged[0]} totalling {logged[1]}")
+    try:
+        test_stress.assert_consistent(stock, sold, left, logged)
+    except AssertionError as e:
+        print(f"LOST UPDATE: {e}")
+        sys.exit(1)
+
+
+# Transfer throughput: the old two-commit path vs one-commit add_transfer vs batched add_transfers
+def bench_transfers(n=2000, batch=100):
+    setup_db()
+    print(f"transfers, {n} product moves between two warehouses")
+
+    def legacy(i):
+        p = i % N_PRODUCTS + 1
+        if db.add_transaction(p, 1, "transfer out", -1):
+            db.add_transaction(p, 2, "transfer in", 1)
+
+    before = timeit("before (two commits)", legacy, n)
+    after = timeit("add_transfer (one commit)", lambda i: db.add_transfer(i % N_PRODUCTS + 1, 1, 2, 1), n)
+    items = [(p, 1) for p in range(1, batch + 1)]
+    start = time.perf_counter()
+    for _ in range(n // batch):
+        db.add_transfers(1, 2, items)
+    batched = time.perf_counter() - start
+    print(f"  {'add_transfers (' + str(batch) + ' per commit)':<28} {n / batched:>12,.0f} moves/s   {batched / n * 1e6:>8.1f} us/move")
+    print(f"  speedup {before / after:.1f}x single, {before / batched:.1f}x batched")
+
+
+# Bulk ingestion: one add_sale per row vs add_sales batches in one commit
+def bench_bulk_sales(n_single=2000, n_bulk=200_000, batch=5000):
+    setup_db()
+    with db.get_conn() as conn:
+        conn.execute("UPDATE inventory SET quantity = 1000000")
+        conn.execute("UPDATE warehouses SET capacity = 1000000000")
+    db.rebuild_warehouse_occupancy()
+    print("sales ingestion")
+    single = timeit("add_sale (one per commit)", lambda i: db.add_sale(i % N_PRODUCTS + 1, i % N_WAREHOUSES + 1, 1), n_single)
+    lines = [(i % N_PRODUCTS + 1, i % N_WAREHOUSES + 1, 1) for i in range(batch)]
+    start = time.perf_counter()
+    for _ in range(n_bulk // batch):
+        result = db.add_sales(lines)
+        assert result["accepted"] == batch
+    bulk = time.perf_counter() - start
+    print(f"  {'add_sales (' + str(batch) + ' per commit)':<28} {n_bulk / bulk:>12,.0f} rows/s    {bulk / n_bulk * 1e6:>8.1f} us/row")
+    print(f"  speedup {(single / n_single) / (bulk / n_bulk):.0f}x rows/s")
+
+    # The same through the Flask routes (test client: full request handling, no socket)
+    import apigate
+    client = apigate.app.test_client()
+    def post_sale(i):
+        response = client.post('/api/v1/add_sale', data={"product_id": i % N_PRODUCTS + 1, "warehouse_id": i % N_WAREHOUSES + 1,
+                                                         "quantity_sold": 1})
+        assert response.status_code == 200
+    single = timeit("POST /add_sale", post_sale, n_single)
+    for fmt in ("json", "ndjson"):
+        sales = [{"product_id": p, "warehouse_id": w, "quantity": q} for p, w, q in lines]
+        if fmt == "json":
+            kwargs = {"json": {"sales": sales}}
+        else:
+            kwargs = {"data": "\n".join(json.dumps(s) for s in sales), "content_type": "application/x-ndjson"}
+        start = time.perf_counter()
+        for _ in range(n_bulk // batch):
+            response = client.post('/api/v1/add_sales_bulk', **kwargs)
+            assert response.status_code == 200 and response.get_json()["accepted"] == batch
+        bulk = time.perf_counter() - start
+        print(f"  {'POST /add_sales_bulk ' + fmt:<28} {n_bulk / bulk:>12,.0f} rows/s    {bulk / n_bulk * 1e6:>8.1f} us/row")
+        print(f"  endpoint speedup {(single / n_single) / (bulk / n_bulk):.0f}x rows/s")
+
+
+# Ledger size and range-query speed on the text layout (schema v5) vs the compact layout
+def bench_storage(n=500_000, n_queries=200):
+    path = setup_db(schema=5)
+    conn = db.get_conn()
+    types = ["sale", "sale", "sale", "transfer out", "transfer in"]
+    start_ts = db.to_ts("2024-01-01")
+    step = 365 * 86400 // n
+    with conn:
+        conn.executemany("INSERT INTO transactions (product_id, warehouse_id, transaction_type, quantity, transaction_date) VALUES (?, ?, ?, ?, ?)",
+                         ((i % N_PRODUCTS + 1, i % N_WAREHOUSES + 1, types[i % 5], -1 - i % 3,
+                           time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start_ts + i * step))) for i in range(n)))
+    old_sql = """
+    SELECT t.transaction_id, p.product_name, w.warehouse_name, t.transaction_type, t.quantity, t.transaction_date
+    FROM transactions t
+    JOIN products p ON t.product_id = p.product_id
+    JOIN warehouses w ON t.warehouse_id = w.warehouse_id
+    WHERE 1=1 AND t.transaction_date >= ? AND t.transaction_date <= ?
+    """
+    days = [(f"2024-{m:02d}-{d:02d} 00:00:00", f"2024-{m:02d}-{d:02d} 23:59:59") for m in range(1, 13) for d in (3, 11, 19, 27)]
+
+    def size():
+        conn.execute("VACUUM")
+        return os.path.getsize(path) / 1e6
+
+    # Same ranges summed inside SQLite, without building Python rows, to isolate the storage cost
+    old_sum_sql = "SELECT SUM(quantity) FROM transactions WHERE transaction_type = 'sale' AND transaction_date >= ? AND transaction_date <= ?"
+    new_sum_sql = f"SELECT SUM(quantity) FROM transactions WHERE type_id = {db.SALE} AND ts >= ? AND ts <= ?"
+    ts_days = [(db.to_ts(lo), db.to_ts(hi)) for lo, hi in days]
+
+    print(f"transactions storage, {n} rows, {n_queries} one-day range queries")
+    before_size = size()
+    before = timeit("before (text layout)", lambda i: conn.execute(old_sql, days[i % len(days)]).fetchall(), n_queries)
+    before_sum = timeit("before, SUM in SQLite", lambda i: conn.execute(old_sum_sql, days[i % len(days)]).fetchall(), n_queries)
+    migrate_start = time.perf_counter()
+    db.migrate()
+    print(f"  migration took {time.perf_counter() - migrate_start:.1f}s")
+    after_size = size()
+    after = timeit("after (compact layout)", lambda i: db.get_transactions(date_from=days[i % len(days)][0], date_to=days[i % len(days)][1]), n_queries)
+    after_sum = timeit("after, SUM in SQLite", lambda i: conn.execute(new_sum_sql, ts_days[i % len(days)]).fetchall(), n_queries)
+    print(f"  database size {before_size:.1f} MB -> {after_size:.1f} MB ({after_size / before_size:.0%})")
+    print(f"  range query speedup {before / after:.1f}x rows returned, {before_sum / after_sum:.1f}x in SQLite")
+
+
+# Inventory read routes: in-memory matrix vs SQLite
+def bench_matrix(n=5000):
+    import invmatrix as inv
+    setup_db()
+    inv.matrix.load()
+    print(f"inventory reads, {n} calls each")
+    cases = [
+        ("by product and warehouse", lambda i: (i % N_PRODUCTS + 1, i % N_WAREHOUSES + 1), "get_inventory_by_product_and_warehouse"),
+        ("by product", lambda i: (i % N_PRODUCTS + 1,), "get_inventory_by_product"),
+        ("levels", lambda i: (i % N_PRODUCTS + 1,), "get_inventory_levels"),
+        ("by warehouse", lambda i: (i % N_WAREHOUSES + 1,), "get_inventory_by_warehouse"),
+        ("by warehouse and quantity", lambda i: (i % N_WAREHOUSES + 1, 1000), "get_inventory_by_warehouse_and_quantity"),
+    ]
+    for label, args, name in cases:
+        print(label)
+        before = timeit("sqlite", lambda i: getattr(db, name)(*args(i)), n)
+        after = timeit("matrix", lambda i: getattr(inv, name)(*args(i)), n)
+        print(f"  speedup {before / after:.1f}x")
+
+
+# Order routing: KD-tree / stocked-candidate lookups vs distances to every warehouse,
+# with tens of thousands of warehouses; checks both agree and that add_warehouse keeps the index exact
+def bench_route(n_warehouses=20_000, n=5000, n_added=1000):
+    import numpy as np
+    import invmatrix as inv
+    import router
+    setup_db()
+    rng = np.random.default_rng(7)
+    lat = rng.uniform(-60, 70, n_warehouses)
+    lon = rng.uniform(-180, 180, n_warehouses)
+    conn = db.get_conn()
+    with conn:
+        first = conn.execute("SELECT MAX(warehouse_id) FROM warehouses").fetchone()[0] + 1
+        conn.executemany("INSERT INTO warehouses (warehouse_name, location, capacity, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+                         [(f"G{i}", "", 1_000_000, float(lat[i]), float(lon[i])) for i in range(n_warehouses)])
+        # Product 1 is everywhere, product 2 in 1 of 40 warehouses, product 3 in 1 of 4
+        conn.executemany("INSERT INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                         [(p, first + i, int(rng.integers(0, 20))) for p, every in ((1, 1), (2, 40), (3, 4))
+                          for i in range(0, n_warehouses, every)])
+    db.rebuild_warehouse_occupancy()
+    start = time.perf_counter()
+    inv.matrix.load()
+    router.index.load()
+    print(f"order routing, {n_warehouses} warehouses, index and matrix loaded in {time.perf_counter() - start:.2f}s")
+    orders = [(int(p), int(rng.integers(1, 10)), float(a), float(o)) for p, a, o in
+              zip(rng.integers(1, 4, n), rng.uniform(-60, 70, n), rng.uniform(-180, 180, n))]
+    xyz = router.to_xyz(lat, lon)
+
+    # Reference answer: distance to every stocked warehouse
+    cols = np.array([inv.matrix.warehouse_cols.get(w, -1) for w in range(first, first + n_warehouses)])
+
+    def brute(i, count=1):
+        p, q, a, o = orders[i % n]
+        line = inv.matrix.quantity[inv.matrix.product_rows[p]]
+        ok = np.flatnonzero((cols >= 0) & (line[cols] >= q))
+        d = ((xyz[ok] - router.to_xyz(a, o)) ** 2).sum(axis=1)
+        return (first + ok[np.argsort(d)[:count]]).tolist()
+
+    for count in (1, 5):
+        print(f"nearest {count}")
+        before = timeit("distance to every warehouse", lambda i: brute(i, count), n)
+        after = timeit("route_order", lambda i: router.index.nearest(*orders[i % n], count=count), n)
+        print(f"  speedup {before / after:.1f}x")
+    bad = [i for i in range(n) if [w for w, _, _ in router.index.nearest(*orders[i], count=5)] != brute(i, 5)]
+    added = timeit("add_warehouse (indexed)", lambda i: db.add_warehouse(f"N{i}", "", 1000, float(rng.uniform(-60, 70)),
+                                                                          float(rng.uniform(-180, 180))), n_added)
+    stale = set(w for w, in conn.execute("SELECT warehouse_id FROM warehouses WHERE latitude IS NOT NULL")) - set(router.index.points)
+    print(f"  {len(bad)} of {n} lookups disagree with the full scan, {len(stale)} added warehouses missing from the index")
+    if bad or stale:
+        sys.exit(1)
+
+
+# Batch routing, 10k orders x 1k warehouses: route_order + add_sale per order vs one route_orders call.
+# Both run on identical databases and must pick the same warehouses without overselling.
+def bench_route_batch(n_orders=10_000, n_warehouses=1000):
+    import numpy as np
+    import invmatrix as inv
+    import router
+
+    def build():
+        setup_db()
+        rng = np.random.default_rng(11)
+        conn = db.get_conn()
+        with conn:
+            first = conn.execute("SELECT MAX(warehouse_id) FROM warehouses").fetchone()[0] + 1
+            conn.executemany("INSERT INTO warehouses (warehouse_name, location, capacity, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+                             [(f"G{i}", "", 1_000_000, float(a), float(o)) for i, (a, o) in
+                              enumerate(zip(rng.uniform(8, 35, n_warehouses), rng.uniform(68, 97, n_warehouses)))])
+            conn.executemany("INSERT INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                             [(p, first + w, int(q)) for p in range(1, N_PRODUCTS + 1)
+                              for w, q in enumerate(rng.integers(0, 4, n_warehouses))])
+        db.rebuild_warehouse_occupancy()
+        inv.matrix.load()
+        router.index.load()
+        # A flash sale: half the orders hit product 1, the rest spread over the catalogue
+        products = np.where(rng.random(n_orders) < 0.5, 1, rng.integers(1, N_PRODUCTS + 1, n_orders))
+        return [{"product_id": int(p), "quantity": int(q), "latitude": float(a), "longitude": float(o)}
+                for p, q, a, o in zip(products, rng.integers(1, 3, n_orders),
+                                      rng.uniform(8, 35, n_orders), rng.uniform(68, 97, n_orders))], conn
+
+    orders, conn = build()
+    before_stock = dict(((p, w), q) for p, w, q in conn.execute("SELECT product_id, warehouse_id, quantity FROM inventory"))
+    print(f"batch routing, {n_orders} orders x {n_warehouses} warehouses")
+    single = []
+
+    def one(i):
+        o = orders[i]
+        found = router.index.nearest(o["product_id"], o["quantity"], o["latitude"], o["longitude"])
+        if found and db.add_sale(o["product_id"], found[0][0], o["quantity"]).startswith("Sale recorded"):
+            single.append(found[0][0])
+        else:
+            single.append(None)
+
+    before = timeit("route_order + add_sale", one, n_orders)
+    orders, conn = build()
+    start = time.perf_counter()
+    preview = router.route_orders(orders, commit=False)
+    planned = time.perf_counter() - start
+    start = time.perf_counter()
+    result = router.route_orders(orders)
+    after = time.perf_counter() - start
+    print(f"  {'route_orders, preview':<28} {n_orders / planned:>12,.0f} orders/s   {planned / n_orders * 1e6:>8.1f} us/order")
+    print(f"  {'route_orders, one commit':<28} {n_orders / after:>12,.0f} orders/s   {after / n_orders * 1e6:>8.1f} us/order")
+    print(f"  speedup {before / after:.0f}x, {result['routed']} routed, {result['unrouted']} unfulfillable")
+
+    batch = [r.get("warehouse_id") if r["ok"] else None for r in result["results"]]
+    taken = {}
+    for o, w in zip(orders, batch):
+        if w is not None:
+            taken[(o["product_id"], w)] = taken.get((o["product_id"], w), 0) + o["quantity"]
+    oversold = [k for k, q in taken.items() if q > before_stock[k]]
+    after_stock = dict(((p, w), q) for p, w, q in conn.execute("SELECT product_id, warehouse_id, quantity FROM inventory"))
+    drift = [k for k in before_stock if after_stock[k] != before_stock[k] - taken.get(k, 0)]
+    mismatched = sum(1 for a, b in zip(single, batch) if a != b)
+    print(f"  {mismatched} assignments differ from the per-order path, {len(oversold)} oversold pairs, {len(drift)} stock mismatches")
+    if mismatched or oversold or drift or not result["committed"] or preview["routed"] != result["routed"]:
+        sys.exit(1)
+
+
+# Rebalancing planner over thousands of SKUs: one process vs worker processes, then the plan is
+# executed in one commit and checked to conserve stock, cover demand and respect capacity
+def bench_rebalance(n_skus=3000, n_warehouses=40):
+    import numpy as np
+    import rebalance
+    setup_db()
+    rng = np.random.default_rng(5)
+    conn = db.get_conn()
+    with conn:
+        conn.execute("UPDATE warehouses SET latitude = 19 + warehouse_id * 0.1, longitude = 73 + warehouse_id * 0.05")
+        first = conn.execute("SELECT MAX(warehouse_id) FROM warehouses").fetchone()[0] + 1
+        conn.executemany("INSERT INTO warehouses (warehouse_name, location, capacity, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+                         [(f"G{i}", "", 2_000_000, float(a), float(o)) for i, (a, o) in
+                          enumerate(zip(rng.uniform(8, 35, n_warehouses), rng.uniform(68, 97, n_warehouses)))])
+        conn.executemany("INSERT INTO products (product_name, description, price, category, client_id) VALUES (?, ?, ?, ?, ?)",
+                         [(f"S{p}", "", 9.99, "C", 1) for p in range(N_PRODUCTS + 1, n_skus + 1)])
+        conn.executemany("INSERT OR REPLACE INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                         [(p, first + w, int(q)) for p in range(1, n_skus + 1)
+                          for w, q in enumerate(rng.integers(0, 200, n_warehouses))])
+    db.rebuild_warehouse_occupancy()
+    demand = {(p, first + w): float(q) for p in range(1, n_skus + 1)
+              for w, q in enumerate(rng.gamma(1.0, 100, n_warehouses))}
+    print(f"rebalancing, {n_skus} SKUs x {n_warehouses} warehouses")
+    serial = rebalance.plan_rebalance(demand, workers=1)
+    print(f"  {'1 process':<28} {serial['seconds']:>8.2f}s   {serial['skus'] / serial['seconds']:>10,.0f} SKUs/s")
+    workers = os.cpu_count() or 1
+    plan = rebalance.plan_rebalance(demand, workers=workers)
+    print(f"  {str(workers) + ' worker processes':<28} {plan['seconds']:>8.2f}s   {plan['skus'] / plan['seconds']:>10,.0f} SKUs/s")
+    print(f"  speedup {serial['seconds'] / plan['seconds']:.1f}x; {len(plan['moves'])} moves, {plan['units']} of {plan['shortfall']} "
+          f"units short covered, {plan['cost_km_units'] / max(plan['units'], 1):.0f} km per unit")
+
+    before = dict(((p, w), q) for p, w, q in conn.execute("SELECT product_id, warehouse_id, quantity FROM inventory"))
+    start = time.perf_counter()
+    ok = rebalance.execute_plan(plan["moves"])
+    print(f"  executed in one commit in {time.perf_counter() - start:.2f}s")
+    after = dict(((p, w), q) for p, w, q in conn.execute("SELECT product_id, warehouse_id, quantity FROM inventory"))
+    totals = lambda stock: {p: sum(q for (pp, _), q in stock.items() if pp == p) for p in range(1, n_skus + 1)}
+    over = conn.execute("""SELECT COUNT(*) FROM warehouses w JOIN warehouse_occupancy o ON o.warehouse_id = w.warehouse_id
+                           WHERE o.occupied > w.capacity""").fetchone()[0]
+    starved = [k for k, q in before.items() if k in demand and q >= demand[k] and after[k] < np.ceil(demand[k])]
+    if not ok or serial["moves"] != plan["moves"] or totals(before) != totals(after) or over or starved:
+        print("PLAN FAILED: execution, parallel result, conservation, capacity or source coverage check")
+        sys.exit(1)
+
+
+# Synthetic daily_sales: weekly-seasonal Poisson demand per product x warehouse, each series
+# selling on about `density` of the days
+def fill_daily_sales(days, n_products, n_warehouses, density, seed=3):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    rate = rng.gamma(2.0, 3.0, (n_products, n_warehouses))
+    weekly = np.array([1.0, 0.9, 0.9, 1.0, 1.2, 1.6, 1.4])
+    conn = db.get_conn()
+    with conn:
+        for day in days:
+            sold = rng.poisson(rate * weekly[day.weekday()]) * (rng.random(rate.shape) < density)
+            p, w = np.nonzero(sold)
+            conn.executemany("INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales) VALUES (?, ?, ?, ?)",
+                             zip([day.isoformat()] * len(p), (w + 1).tolist(), (p + 1).tolist(), sold[p, w].tolist()))
+
+
+# Forecasting every product x warehouse series: 1000 products x 100 warehouses = 100k daily series
+def bench_forecast(n_products=1000, n_warehouses=100, density=0.3):
+    from datetime import date, timedelta
+    import forecast
+    setup_db()
+    through = date(2024, 6, 30)
+    days = [(through - timedelta(days=forecast.HISTORY_DAYS - 1 - i)) for i in range(forecast.HISTORY_DAYS)]
+    start = time.perf_counter()
+    fill_daily_sales(days, n_products, n_warehouses, density)
+    conn = db.get_conn()
+    rows = conn.execute("SELECT COUNT(*) FROM daily_sales").fetchone()[0]
+    print(f"forecasting, {n_products * n_warehouses} series x {forecast.HISTORY_DAYS} days ({rows} daily_sales rows, "
+          f"generated in {time.perf_counter() - start:.1f}s)")
+    summary = forecast.run(through)
+    total = summary["load_seconds"] + summary["fit_seconds"] + summary["write_seconds"]
+    print(f"  load {summary['load_seconds']:.1f}s, fit {summary['fit_seconds']:.1f}s, write {summary['write_seconds']:.1f}s, "
+          f"total {total:.1f}s for {summary['series']} series ({summary['series'] / total:,.0f} series/s)")
+    print(f"  models chosen: {summary['models']}")
+    written = conn.execute("SELECT COUNT(*) FROM forecasts").fetchone()[0]
+    if summary["series"] < 0.99 * n_products * n_warehouses or written != summary["series"] * forecast.FORECAST_DAYS:
+        print("FORECAST FAILED: series or forecast rows missing")
+        sys.exit(1)
+
+
+# Incremental forecast refresh: one new day on which 5% of 100k series sold, vs refitting everything
+def bench_forecast_refresh(n_products=1000, n_warehouses=100, density=0.05):
+    from datetime import date, timedelta
+    import forecast
+    setup_db()
+    through = date(2024, 6, 30)
+    days = [(through - timedelta(days=forecast.HISTORY_DAYS - 1 - i)) for i in range(forecast.HISTORY_DAYS)]
+    fill_daily_sales(days, n_products, n_warehouses, 0.3)
+    full = forecast.run(through)
+    full_seconds = full["load_seconds"] + full["fit_seconds"] + full["write_seconds"]
+    conn = db.get_conn()
+    fill_daily_sales([through + timedelta(days=1)], n_products, n_warehouses, density, seed=4)
+    sold = conn.execute("SELECT COUNT(*) FROM daily_sales WHERE sale_date = ?", ((through + timedelta(days=1)).isoformat(),)).fetchone()[0]
+    print(f"forecast refresh, {full['series']} cached series, {sold} sold on the new day")
+    summary = forecast.refresh(through + timedelta(days=1))
+    print(f"  {'full refit':<28} {full_seconds:>8.2f}s")
+    print(f"  {'incremental refresh':<28} {summary['seconds']:>8.2f}s   ({summary['advanced']} advanced, {summary['refitted']} refitted)")
+    print(f"  speedup {full_seconds / summary['seconds']:.0f}x")
+    moved = conn.execute("SELECT COUNT(*) FROM forecast_models WHERE fitted_through = ?", ((through + timedelta(days=1)).isoformat(),)).fetchone()[0]
+    rows = conn.execute("SELECT COUNT(*) FROM forecasts").fetchone()[0]
+    again = forecast.refresh(through + timedelta(days=1))
+    if moved != sold or rows != full["series"] * forecast.FORECAST_DAYS + summary["refitted"] * forecast.FORECAST_DAYS \
+            or again["refreshed"] != "current":
+        print("REFRESH FAILED: advanced series, forecast rows or cache version disagree")
+        sys.exit(1)
+
+
+# Rolling-origin backtest over a ledger of daily sale transactions, in one process and in a worker pool
+def bench_backtest(n_products=500, n_warehouses=40, density=0.3):
+    from datetime import date, timedelta
+    import numpy as np
+    import backtest
+    setup_db()
+    rng = np.random.default_rng(9)
+    conn = db.get_conn()
+    through = date(2024, 6, 30)
+    n_days = backtest.TRAIN_DAYS + backtest.ORIGINS * backtest.HORIZON
+    rate = rng.gamma(2.0, 3.0, (n_products, n_warehouses))
+    weekly = np.array([1.0, 0.9, 0.9, 1.0, 1.2, 1.6, 1.4])
+    with conn:
+        conn.executemany("INSERT INTO products (product_name, description, price, category, client_id) VALUES (?, ?, ?, ?, ?)",
+                         [(f"S{p}", "", 9.99, "C", 1) for p in range(N_PRODUCTS + 1, n_products + 1)])
+        for i in range(n_days):
+            day = through - timedelta(days=n_days - 1 - i)
+            sold = rng.poisson(rate * weekly[day.weekday()]) * (rng.random(rate.shape) < density)
+            p, w = np.nonzero(sold)
+            ts = db.to_ts(day.isoformat()) + 43200
+            conn.executemany("INSERT INTO transactions (product_id, warehouse_id, type_id, quantity, ts) VALUES (?, ?, ?, ?, ?)",
+                             zip((p + 1).tolist(), (w + 1).tolist(), [db.SALE] * len(p), (-sold[p, w]).tolist(), [ts] * len(p)))
+    rows = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    print(f"backtest, {n_products * n_warehouses} series, {rows} ledger rows, {backtest.ORIGINS} origins x {backtest.HORIZON} days")
+    serial = backtest.run(through, workers=1)
+    workers = max(os.cpu_count() or 1, 2)
+    pooled = backtest.run(through, workers=workers)
+    print(f"  {'1 process':<28} {serial['seconds']:>8.2f}s")
+    print(f"  {str(workers) + ' worker processes':<28} {pooled['seconds']:>8.2f}s")
+    print(f"  {'method':<20} {'MAPE %':>8} {'bias %':>8}")
+    for method, (mape, bias) in pooled["overall"].items():
+        print(f"  {method:<20} {mape:>8.1f} {bias:>8.1f}")
+    if serial["overall"] != pooled["overall"] or len(pooled["by_product"]) != n_products or len(pooled["by_warehouse"]) != n_warehouses:
+        print("BACKTEST FAILED: pooled and serial runs disagree or groups are missing")
+        sys.exit(1)
+
+
+# Reorder points for 1000 products x 100 warehouses = 100k inventory pairs, then the dashboard's
+# suggestion query from the partial index against filtering a full inventory listing
+def bench_reorder(n_products=1000, n_warehouses=100, density=0.3, n=200):
+    from datetime import date, timedelta
+    import math
+    from statistics import NormalDist
+    import numpy as np
+    import reorder
+    setup_db()
+    rng = np.random.default_rng(5)
+    conn = db.get_conn()
+    through = date(2024, 6, 30)
+    with conn:
+        conn.executemany("INSERT INTO warehouses (warehouse_name, location, capacity) VALUES (?, ?, ?)",
+                         [(f"W{w}", f"City {w}", 1_000_000) for w in range(N_WAREHOUSES + 1, n_warehouses + 1)])
+        conn.executemany("INSERT INTO products (product_name, description, price, category, client_id) VALUES (?, ?, ?, ?, ?)",
+                         [(f"S{p}", "", 9.99, "C", 1) for p in range(N_PRODUCTS + 1, n_products + 1)])
+        conn.execute("DELETE FROM inventory")
+        conn.executemany("INSERT INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                         zip(np.repeat(np.arange(1, n_products + 1), n_warehouses).tolist(),
+                             np.tile(np.arange(1, n_warehouses + 1), n_products).tolist(),
+                             rng.integers(0, 120, n_products * n_warehouses).tolist()))
+    fill_daily_sales([through - timedelta(days=i) for i in range(reorder.HISTORY_DAYS)], n_products, n_warehouses, density)
+    print(f"reorder points, {n_products * n_warehouses} inventory pairs, {reorder.HISTORY_DAYS} days of sales")
+    summary = reorder.refresh(through)
+    print(f"  {'vectorized refresh':<28} {summary['compute_seconds'] + summary['write_seconds']:>8.2f}s   "
+          f"(compute {summary['compute_seconds']:.2f}s, write {summary['write_seconds']:.2f}s)")
+    print(f"  {summary['with_demand']} pairs with demand, {summary['at_or_below']} at or below their reorder point")
+
+    # Spot-check against the formula evaluated pair by pair
+    z = NormalDist().inv_cdf(reorder.SERVICE_LEVEL)
+    start = (through - timedelta(days=reorder.HISTORY_DAYS - 1)).isoformat()
+    for p, w, rop, ss in conn.execute("SELECT product_id, warehouse_id, reorder_point, safety_stock FROM reorder_points "
+                                      "WHERE daily_demand > 0 ORDER BY random() LIMIT 200").fetchall():
+        sales = [s for s, in conn.execute("SELECT sales FROM daily_sales WHERE product_id = ? AND warehouse_id = ? "
+                                          "AND sale_date >= ? AND sale_date <= ?", (p, w, start, through.isoformat()))]
+        sales += [0] * (reorder.HISTORY_DAYS - len(sales))
+        mean = sum(sales) / len(sales)
+        std = math.sqrt(sum((s - mean) ** 2 for s in sales) / (len(sales) - 1))
+        expected = math.ceil(mean * reorder.LEAD_TIME_DAYS + z * std * math.sqrt(reorder.LEAD_TIME_DAYS) - 1e-9)
+        if abs(expected - rop) > 1:
+            print(f"REORDER FAILED: product {p} warehouse {w} reorder point {rop}, expected {expected}")
+            sys.exit(1)
+
+    def poll(i):
+        return [row for row in db.get_inventory_by_warehouse(i % n_warehouses + 1)
+                if row[3] <= (conn.execute("SELECT reorder_point FROM reorder_points WHERE product_id = ? AND warehouse_id = ?",
+                                           (row[1], row[2])).fetchone() or (-1,))[0]]
+    before = timeit("before (poll inventory)", poll, n)
+    after = timeit("after (reorder suggestions)", lambda i: db.get_reorder_suggestions(i % n_warehouses + 1), n)
+    print(f"  speedup {before / after:.1f}x")
+    polled = sum(len(poll(w)) for w in range(n_warehouses))
+    suggested = len(db.get_reorder_suggestions())
+    if polled != suggested or suggested != summary["at_or_below"]:
+        print(f"REORDER FAILED: {suggested} suggestions, {polled} from polling inventory")
+        sys.exit(1)
+
+
+# Report inputs for one client with 5000 SKUs in 4 warehouses, among 20k products of other clients:
+# one aggregated query per input against one query per product
+def bench_report_inputs(n_skus=5000, n_other=20_000, n_warehouses=4, n=5):
+    from datetime import date, timedelta
+    import numpy as np
+    import reportgen
+    setup_db()
+    rng = np.random.default_rng(11)
+    conn = db.get_conn()
+    client = "client@example.com"
+    today = date(2024, 7, 1)
+    with conn:
+        conn.execute("DELETE FROM inventory")
+        conn.executemany("INSERT INTO products (product_name, description, price, category, client_id) VALUES (?, ?, ?, ?, ?)",
+                         [(f"S{p}", "", 9.99, "C", client if p < n_skus else "other@example.com") for p in range(n_skus + n_other)])
+        ids = [p for p, in conn.execute("SELECT product_id FROM products WHERE product_id > ?", (N_PRODUCTS,))]
+        pairs = [(p, w) for p in ids for w in range(1, n_warehouses + 1)]
+        conn.executemany("INSERT INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                         [(p, w, q) for (p, w), q in zip(pairs, rng.integers(0, 5000, len(pairs)).tolist())])
+        for d in range(1, reportgen.REPORT_DAYS + 1):
+            sold = rng.poisson(20, len(pairs)) * (rng.random(len(pairs)) < 0.5)
+            conn.executemany("INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales) VALUES (?, ?, ?, ?)",
+                             [((today - timedelta(days=d)).isoformat(), w, p, int(s)) for (p, w), s in zip(pairs, sold) if s])
+            conn.executemany("INSERT INTO forecasts (product_id, warehouse_id, forecast_date, sales) VALUES (?, ?, ?, ?)",
+                             [(p, w, (today + timedelta(days=d - 1)).isoformat(), 20.0) for p, w in pairs])
+    print(f"report inputs, client with {n_skus} SKUs x {n_warehouses} warehouses among {len(ids)} products")
+
+    # One query per input per product, timed on a sample of the client's products and scaled up
+    sample = conn.execute("SELECT product_id FROM products WHERE client_id = ? LIMIT 20", (client,)).fetchall()
+    def per_product(i):
+        out = []
+        for p, in sample:
+            out += db.get_daily_sales(date_from=(today - timedelta(days=30)).isoformat(), product_id=p)
+            out += db.get_forecasts(date_from=today.isoformat(), product_id=p)
+            out += db.get_inventory_by_product(p)
+        return out
+    start = time.perf_counter()
+    per_product(0)
+    before = (time.perf_counter() - start) * n_skus / len(sample)
+    start = time.perf_counter()
+    for i in range(n):
+        inputs = reportgen.report_inputs(client, today.isoformat())
+    after = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    sales, forecasts, stock = reportgen.input_tables(inputs)
+    tables = time.perf_counter() - start
+    print(f"  {'before (queries per product)':<28} {before:>8.2f}s per client (extrapolated from {len(sample)} products)")
+    print(f"  {'after (aggregated queries)':<28} {after:>8.2f}s per client, speedup {before / after:.0f}x")
+    print(f"  {'prompt tables':<28} {tables:>8.2f}s for {len(sales) + len(forecasts) + len(stock):,} characters")
+    expected = conn.execute("SELECT COUNT(*), SUM(d.sales) FROM daily_sales d JOIN products p ON d.product_id = p.product_id "
+                            "WHERE p.client_id = ? AND d.sale_date >= ?", (client, (today - timedelta(days=30)).isoformat())).fetchone()
+    if stock.count("\n") != n_skus * n_warehouses or forecasts.count("\n") != n_skus * n_warehouses * reportgen.REPORT_DAYS \
+            or sales.count("\n") != expected[0] or inputs["sales"].sum() != expected[1] or after > 1.0:
+        print("REPORT INPUTS FAILED: rows missing or slower than 1s")
+        sys.exit(1)
+
+
+# Give a client n_products products spread over n_categories categories, stocked in n_warehouses
+# warehouses, with REPORT_DAYS of daily sales before `today` and forecasts from it
+def add_report_client(client, n_products, n_warehouses, today, rng, n_categories=1):
+    from datetime import timedelta
+    import reportgen
+    conn = db.get_conn()
+    with conn:
+        first = conn.execute("INSERT INTO products (product_name, description, price, category, client_id) VALUES ('x', '', 1, 'C0', ?) "
+                             "RETURNING product_id", (client,)).fetchone()[0]
+        conn.executemany("INSERT INTO products (product_name, description, price, category, client_id) VALUES ('x', '', 1, ?, ?)",
+                         [(f"C{i % n_categories}", client) for i in range(1, n_products)])
+        pairs = [(p, w) for p in range(first, first + n_products) for w in range(1, n_warehouses + 1)]
+        conn.executemany("INSERT OR REPLACE INTO inventory (product_id, warehouse_id, quantity) VALUES (?, ?, ?)",
+                         [(p, w, int(q)) for (p, w), q in zip(pairs, rng.integers(0, 10000, len(pairs)))])
+        for d in range(1, reportgen.REPORT_DAYS + 1):
+            conn.executemany("INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales) VALUES (?, ?, ?, ?)",
+                             [((today - timedelta(days=d)).isoformat(), w, p, int(s)) for (p, w), s in zip(pairs, rng.integers(50, 300, len(pairs)))])
+            conn.executemany("INSERT INTO forecasts (product_id, warehouse_id, forecast_date, sales) VALUES (?, ?, ?, ?)",
+                             [(p, w, (today + timedelta(days=d - 1)).isoformat(), float(s)) for (p, w), s in zip(pairs, rng.uniform(50, 300, len(pairs)))])
+    return list(range(first, first + n_products))
+
+# Prompt size for the sample-sized client (4 products x 2 warehouses) and a 2000-SKU client:
+# raw daily rows as the prompt used to carry them against the metrics tables within the token budget
+def bench_report_prompt(sizes=((4, 2), (2000, 4))):
+    from datetime import date
+    import numpy as np
+    import reportgen
+    setup_db()
+    rng = np.random.default_rng(12)
+    today = date(2024, 7, 1)
+    print(f"report prompt, budget {reportgen.PROMPT_TOKEN_BUDGET} tokens")
+    for n_products, n_warehouses in sizes:
+        client = f"client{n_products}@example.com"
+        add_report_client(client, n_products, n_warehouses, today, rng)
+        inputs = reportgen.report_inputs(client, today.isoformat())
+        raw = reportgen.count_tokens("".join(reportgen.input_tables(inputs)))
+        start = time.perf_counter()
+        prompt = reportgen.build_prompt(inputs)
+        built = time.perf_counter() - start
+        tokens = reportgen.count_tokens(reportgen.SYSTEM_PROMPT + prompt)
+        print(f"  {n_products} products x {n_warehouses} warehouses: raw rows {raw:,} tokens, "
+              f"metrics prompt {tokens:,} tokens ({raw / tokens:.1f}x smaller), built in {built * 1000:.0f} ms")
+        if tokens > reportgen.PROMPT_TOKEN_BUDGET:
+            print("REPORT PROMPT FAILED: prompt over the token budget")
+            sys.exit(1)
+
+
+# Report cache: a first request generates (against a fake completion with LLM-like latency), repeats are
+# served from memory, then from disk after a restart, and a stock change or a small disk limit force misses
+def bench_report_cache(latency=1.0, n=200):
+    import reportgen
+    import reportcache
+    setup_db()
+    client = 1      # setup_db gives products the client_ids 1 to 5
+    calls = []
+    def fake_generate(message):
+        calls.append(message)
+        time.sleep(latency)
+        return f"report {len(calls)}: " + "x" * 4000
+    real_generate, reportgen.generate_report = reportgen.generate_report, fake_generate
+    reportcache.cache = reportcache.ReportCache()
+    try:
+        print(f"report cache, fake completion taking {latency:.1f}s")
+        start = time.perf_counter()
+        first = reportgen.gen_report(client)
+        print(f"  {'miss (generate)':<28} {(time.perf_counter() - start) * 1000:>8.1f} ms")
+        timeit("memory hit", lambda i: reportgen.gen_report(client), n)
+        reportcache.cache = reportcache.ReportCache()       # as after a restart
+        reportgen._input_hashes.clear()
+        # A disk hit while another connection holds products.db's write lock must not wait for it
+        writer = db._connect(db.proddb)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            start = time.perf_counter()
+            again = reportgen.gen_report(client)
+            print(f"  {'disk hit after restart':<28} {(time.perf_counter() - start) * 1000:>8.1f} ms  (products.db write-locked)")
+        finally:
+            writer.rollback()
+            writer.close()
+        db.update_inventory(5, 1, 123)                      # product 5 belongs to client 1
+        changed = reportgen.gen_report(client)
+        reportcache.cache.disk_bytes = 10_000
+        for c in range(2, 6):
+            reportgen.gen_report(c)
+        stats = reportcache.cache.stats()
+        print(f"  {stats}")
+        import numpy as np
+        same_bytes = [reportcache.input_hash({"sales": np.zeros(4, dtype=dtype).reshape(shape)})
+                      for dtype, shape in ((np.int64, (4,)), (np.float64, (4,)), (np.int64, (2, 2)))]
+        if again != first or changed == first or len(set(same_bytes)) != 3 or len(calls) != 6 or stats["disk_bytes"] > 10_000 or stats["evictions"] == 0:
+            print("REPORT CACHE FAILED: cached, regenerated or evicted reports are wrong")
+            sys.exit(1)
+    finally:
+        reportgen.generate_report = real_generate
+
+
+# Report job queue against the fake LLM: submits return at once, duplicate submits merge into the job in
+# flight, generation runs `workers` at a time, and a job outliving its timeout is reported as timed out
+def bench_report_jobs(n_clients=5, duplicates=4, latency=0.5, workers=4):
+    import llm
+    import reportcache
+    import reportjobs
+    setup_db()
+    real_client, llm.client = llm.client, llm.FakeLLM(latency)
+    reportcache.cache = reportcache.ReportCache()
+    queue = reportjobs.ReportJobs(workers=workers, timeout=30)
+    try:
+        print(f"report jobs, {n_clients} clients x {duplicates} submits, fake LLM {latency:.1f}s, {workers} workers")
+        start = time.perf_counter()
+        submitted = [queue.submit(c % n_clients + 1) for c in range(n_clients * duplicates)]
+        submit_ms = (time.perf_counter() - start) * 1000 / len(submitted)
+        finished = [queue.wait(job["job_id"]) for job in submitted]
+        elapsed = time.perf_counter() - start
+        print(f"  {'submit':<28} {submit_ms:>8.2f} ms per request")
+        calls = llm.client.calls
+        print(f"  {'all reports done':<28} {elapsed:>8.2f}s   ({calls} LLM calls, {queue.merged} submits merged)")
+        slow = reportjobs.ReportJobs(workers=1, timeout=0.2)
+        llm.client.latency = 1.0
+        reportcache.cache = reportcache.ReportCache(memory_entries=0)
+        reportcache.cache.clear()
+        timed_out = slow.wait(slow.submit(1)["job_id"])
+        print(f"  {'0.2s timeout on a 1s call':<28} {timed_out['status']}")
+        if len({job["job_id"] for job in submitted}) != n_clients or any(job["status"] != reportjobs.DONE for job in finished) \
+                or calls != n_clients or timed_out["status"] != reportjobs.TIMED_OUT:
+            print("REPORT JOBS FAILED: jobs not merged, not finished or not timed out")
+            sys.exit(1)
+    finally:
+        llm.client = real_client
+
+
+# Time to first byte of a report, blocking against streamed through the job queue, with a fake LLM
+# taking 2s of which 0.2s is first-token latency. The streamed report must match and be cached once
+# complete, tabs streaming the same client must share one LLM call, and a stream outliving the job
+# timeout must end in an error
+def bench_report_stream(latency=2.0, first_token=0.2, tabs=4):
+    import threading
+    import llm
+    import reportcache
+    import reportgen
+    import reportjobs
+    setup_db()
+    fake = llm.FakeLLM(latency, first_token)
+    real_client, llm.client = llm.client, fake
+    queue = reportjobs.ReportJobs(workers=2, timeout=30)
+    try:
+        print(f"report streaming, fake LLM {latency:.1f}s with {first_token:.1f}s to the first token")
+        reportcache.cache = reportcache.ReportCache()
+        start = time.perf_counter()
+        blocking = reportgen.gen_report(1)
+        print(f"  {'blocking first byte':<28} {(time.perf_counter() - start) * 1000:>8.0f} ms")
+        reportcache.cache = reportcache.ReportCache()
+        reportcache.cache.clear()
+        calls = fake.calls
+        start = time.perf_counter()
+        stream = queue.follow(queue.submit(1)["job_id"])
+        parts = [next(stream)]
+        print(f"  {'streamed first byte':<28} {(time.perf_counter() - start) * 1000:>8.0f} ms")
+        # More tabs open while the first is streaming: each joins the job and is replayed what it missed
+        texts = [None] * tabs
+        def tab(i):
+            texts[i] = "".join(queue.follow(queue.submit(1)["job_id"]))
+        threads = [threading.Thread(target=tab, args=(i,)) for i in range(tabs)]
+        for t in threads:
+            t.start()
+        parts += list(stream)
+        for t in threads:
+            t.join()
+        streamed = "".join(parts)
+        print(f"  {'streamed last byte':<28} {(time.perf_counter() - start) * 1000:>8.0f} ms  "
+              f"({tabs + 1} tabs, {fake.calls - calls} LLM call)")
+        start = time.perf_counter()
+        cached = "".join(queue.follow(queue.submit(1)["job_id"]))
+        print(f"  {'streamed from cache':<28} {(time.perf_counter() - start) * 1000:>8.1f} ms")
+        slow = reportjobs.ReportJobs(workers=1, timeout=0.5)
+        reportcache.cache.clear()
+        reportcache.cache = reportcache.ReportCache(memory_entries=0)
+        try:
+            "".join(slow.follow(slow.submit(1)["job_id"]))
+            timed_out = False
+        except RuntimeError as e:
+            timed_out = True
+            print(f"  {'0.5s timeout on a 2s stream':<28} {e}")
+        if streamed.split(":", 1)[1] != blocking.split(":", 1)[1] or any(t != streamed for t in texts) \
+                or cached != streamed or fake.calls - calls != 2 or not timed_out:
+            print("REPORT STREAM FAILED: streamed report differs, was not shared or cached, or did not time out")
+            sys.exit(1)
+    finally:
+        llm.client = real_client
+
+
+# Map-reduce report for a 2000-SKU client in 20 categories: every product lands in exactly one section
+# prompt, sections run MAP_CONCURRENCY at a time against a fake LLM, and the wall time is compared with
+# making the same calls one after another
+def bench_report_mapreduce(n_products=2000, n_warehouses=4, n_categories=20, latency=1.0, tokens=700):
+    import re
+    from datetime import date
+    import numpy as np
+    import llm
+    import reportgen
+    setup_db()
+    client = "mapreduce@example.com"
+    today = date(2024, 7, 1)
+    ids = add_report_client(client, n_products, n_warehouses, today, np.random.default_rng(24), n_categories)
+    inputs = reportgen.report_inputs(client, today.isoformat())
+    fake = llm.FakeLLM(latency, tokens=tokens)
+    messages = []
+    class Recording:
+        def complete(self, system, message, model, max_tokens):
+            messages.append((message, max_tokens))
+            return fake.complete(system, message, model, max_tokens)
+    real_client, llm.client = llm.client, Recording()
+    try:
+        start = time.perf_counter()
+        message, stats = reportgen.final_prompt(inputs)
+        elapsed = time.perf_counter() - start
+    finally:
+        llm.client = real_client
+    sections = [m for m, _ in messages if m.startswith(reportgen.SECTION_PROMPT[:60])]
+    seen = [int(p) for m in sections for p in re.findall(r"^\s*(\d+),", m.split("warehouse metrics:")[0], re.M)]
+    print(f"report map-reduce, {n_products} products x {n_warehouses} warehouses in {n_categories} categories, "
+          f"fake LLM {latency:.1f}s, {reportgen.MAP_CONCURRENCY} calls in flight")
+    print(f"  {stats['sections']} sections, {stats['calls']} LLM calls ({len(messages)} before the final one), depth {stats['depth']}")
+    print(f"  {'map-reduce before final call':<28} {elapsed:>8.2f} s")
+    print(f"  {'same calls in sequence':<28} {len(messages) * latency:>8.2f} s")
+    tokens_used = max(reportgen.count_tokens(reportgen.SYSTEM_PROMPT + m) for m, _ in messages)
+    print(f"  largest prompt {tokens_used:,} tokens, final prompt "
+          f"{reportgen.count_tokens(reportgen.SYSTEM_PROMPT + message):,} tokens")
+    if sorted(seen) != ids or stats["calls"] != len(messages) + 1 or stats["depth"] < 3 \
+            or any(reportgen.count_tokens(reportgen.SYSTEM_PROMPT + m) + t > reportgen.CONTEXT_TOKENS for m, t in messages) \
+            or reportgen.count_tokens(reportgen.SYSTEM_PROMPT + message) > reportgen.PROMPT_TOKEN_BUDGET:
+        print("REPORT MAPREDUCE FAILED: a product is missing or repeated, or a prompt is over its budget")
+        sys.exit(1)
+
+
+# Nightly report batch against a fake LLM: one client at a time, then the pipeline paced to the fake's
+# rate limit, then unpaced against a stricter limit (rejections retried), a resumed run, and the reports
+# served by gen_report without another LLM call
+def bench_report_batch(n_clients=60, n_sequential=10, latency=0.5, rpm=600):
+    from datetime import date
+    import numpy as np
+    import llm
+    import reportbatch
+    import reportcache
+    import reportgen
+    setup_db()
+    rng = np.random.default_rng(25)
+    today = date.today()
+    clients = [f"batch{i}@example.com" for i in range(n_clients)]
+    for client in clients:
+        add_report_client(client, 4, 2, today, rng)
+    real_client = llm.client
+
+    def batch(name, fake, clients, run_id, limiter, concurrency=reportbatch.CONCURRENCY, fresh=True):
+        if fresh:
+            reportcache.cache.clear()
+        reportcache.cache = reportcache.ReportCache()
+        reportgen._input_hashes.clear()
+        summary = reportbatch.run(clients, run_id, concurrency, limiter, model_client=fake)
+        print(f"  {name:<34} {summary['generated']:>3} generated {summary['skipped']:>3} skipped {summary['failed']:>2} failed "
+              f"{summary['rate_limited']:>3} rate limited  {summary['seconds']:>6.1f}s  {summary['clients_per_minute']:>6.0f} clients/min")
+        return summary
+
+    print(f"report batch, {n_clients} clients, fake LLM {latency:.1f}s allowing {rpm} calls/min")
+    sequential = batch("sequential", llm.FakeLLM(latency, rpm=rpm), clients[:n_sequential], "sequential",
+                       reportbatch.RateLimiter(None, None), concurrency=1)
+    paced = batch(f"{reportbatch.CONCURRENCY} in flight, paced to {rpm}/min", llm.FakeLLM(latency, rpm=rpm), clients,
+                  "paced", reportbatch.RateLimiter(rpm, None))
+    unpaced = batch("unpaced, fake allows 10 per 2s", llm.FakeLLM(latency, rpm=10, per=2.0), clients[:20], "unpaced",
+                    reportbatch.RateLimiter(None, None))
+    batch("interrupted run, first half", llm.FakeLLM(latency, rpm=rpm), clients[:n_clients // 2], "resume",
+          reportbatch.RateLimiter(rpm, None))
+    resumed = batch("resumed run", llm.FakeLLM(latency, rpm=rpm), clients, "resume", reportbatch.RateLimiter(rpm, None),
+                    fresh=False)
+
+    fake = llm.FakeLLM(latency)
+    llm.client = fake
+    reportcache.cache = reportcache.ReportCache()       # the API process starts with an empty memory cache
+    reportgen._input_hashes.clear()
+    try:
+        start = time.perf_counter()
+        served = [reportgen.gen_report(client) for client in clients]
+        print(f"  {'served by /api/v1/reportgen':<34} {len(served)} reports, {fake.calls} LLM calls, "
+              f"{(time.perf_counter() - start) / len(clients) * 1000:.1f} ms each")
+    finally:
+        llm.client = real_client
+    if sequential["generated"] != n_sequential or paced["generated"] != n_clients or paced["rate_limited"] \
+            or unpaced["generated"] != 20 or not unpaced["rate_limited"] \
+            or resumed["skipped"] != n_clients // 2 or resumed["generated"] != n_clients - n_clients // 2 or fake.calls:
+        print("REPORT BATCH FAILED: a report was not generated, a limit was hit, or a report was not served from the cache")
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    "reads": bench_reads,
+    "plans": bench_plans,
+    "stress": bench_stress,
+    "transfers": bench_transfers,
+    "bulk": bench_bulk_sales,
+    "storage": bench_storage,
+    "matrix": bench_matrix,
+    "route": bench_route,
+    "route_batch": bench_route_batch,
+    "rebalance": bench_rebalance,
+    "forecast": bench_forecast,
+    "forecast_refresh": bench_forecast_refresh,
+    "backtest": bench_backtest,
+    "reorder": bench_reorder,
+    "report_inputs": bench_report_inputs,
+    "report_prompt": bench_report_prompt,
+    "report_cache": bench_report_cache,
+    "report_jobs": bench_report_jobs,
+    "report_stream": bench_report_stream,
+    "report_mapreduce": bench_report_mapreduce,
+    "report_batch": bench_report_batch,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+    db.close_all()
@@ -1,12 +1,189 @@
+import calendar
 import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 
 # waredb = "warehouse.db"
 proddb = "products.db"
 
+# Connection settings, applied once when a connection is opened
+DB_TIMEOUT = 30                   # seconds to wait on a locked database
+CACHE_SIZE_KB = 64 * 1024         # page cache per connection (64 MB)
+MMAP_SIZE = 256 * 1024 * 1024     # memory mapped I/O window (256 MB)
+CACHED_STATEMENTS = 256           # prepared statements kept per connection
+
+POOL_IDLE = 8                     # idle connections kept per database for the next thread to reuse
+
+_local = threading.local()
+_checked_out = {}                 # (thread, path) -> connection the thread is using
+_idle = {}                        # path -> connections no thread is using
+_generation = 0                   # bumped by close_all, so threads drop the handles it closed
+_pool_lock = threading.Lock()
+
+# Open a connection and configure it for concurrent use by the API
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=DB_TIMEOUT, cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+# Put a connection a thread is done with back in the idle list, or close it if the list is full.
+# Call with _pool_lock held.
+def _give_back(path, conn):
+    if conn.in_transaction:
+        conn.rollback()
+    idle = _idle.setdefault(path, [])
+    if len(idle) < POOL_IDLE:
+        idle.append(conn)
+    else:
+        conn.close()
+
+# Take back the connections of threads that exited without releasing them. Call with _pool_lock held.
+def _reap():
+    for (thread, path), conn in list(_checked_out.items()):
+        if not thread.is_alive():
+            del _checked_out[(thread, path)]
+            _give_back(path, conn)
+
+# Return the calling thread's connection to the database at path.
+# A thread keeps one connection per database until it releases it (release_conns, called at the end
+# of every API request) or exits; the connection then goes back to the pool for the next thread,
+# so requests reuse open connections instead of paying the open/parse-schema/close cost, and the
+# number of open connections stays bounded by the threads alive plus POOL_IDLE.
+def pooled_conn(path, connect=_connect):
+    conns = getattr(_local, "conns", None)
+    if conns is None or _local.generation != _generation:
+        conns = _local.conns = {}
+        _local.generation = _generation
+    conn = conns.get(path)
+    if conn is None:
+        with _pool_lock:
+            _reap()
+            idle = _idle.get(path)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = connect(path)
+        with _pool_lock:
+            _checked_out[(threading.current_thread(), path)] = conn
+        conns[path] = conn
+    return conn
+
+# Return the connection to products.db owned by the calling thread
+def get_conn():
+    return pooled_conn(proddb)
+
+# Hand the calling thread's connections back to the pool
+def release_conns():
+    conns = getattr(_local, "conns", None)
+    if not conns:
+        return
+    thread = threading.current_thread()
+    with _pool_lock:
+        if _local.generation == _generation:
+            for path, conn in conns.items():
+                _checked_out.pop((thread, path), None)
+                _give_back(path, conn)
+    conns.clear()
+
+# Close every pooled connection, including the ones other threads hold (on shutdown or after
+# switching proddb); each thread opens a fresh one on its next call
+def close_all():
+    global _generation
+    with _pool_lock:
+        _generation += 1
+        for conn in list(_checked_out.values()) + [conn for idle in _idle.values() for conn in idle]:
+            conn.close()
+        _checked_out.clear()
+        _idle.clear()
+    _local.__dict__.clear()
+
+# Called after every commit that bumped the inventory version, as listener(changes, version) where
+# changes is [(inventory_id, product_id, warehouse_id, quantity), ...] and version is the
+# inventory version that commit produced
+inventory_listeners = []
+
+# Called after add_warehouse commits, as listener(warehouse_id, latitude, longitude)
+warehouse_listeners = []
+
+# Run a block as one write transaction that takes the write lock up front.
+# Commits when the block finishes, rolls back if it raises.
+@contextmanager
+def write_txn():
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    _local.inventory_changes = []
+    _local.inventory_version = None
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    if _local.inventory_version is not None:
+        for listener in inventory_listeners:
+            listener(_local.inventory_changes, _local.inventory_version)
+
+# Inventory version for the current write transaction, bumped once on first use.
+# Every inventory row written in the transaction is stamped with it.
+def _inventory_version(cursor):
+    if _local.inventory_version is None:
+        _local.inventory_version = cursor.execute("UPDATE inventory_version SET version = version + 1 RETURNING version").fetchone()[0]
+    return _local.inventory_version
+
+# Note an inventory row written in the current write transaction, for the post-commit listeners
+def _record_inventory(inventory_id, product_id, warehouse_id, quantity):
+    _local.inventory_changes.append((inventory_id, int(product_id), int(warehouse_id), quantity))
+
+# Function to get the current inventory version
+def inventory_version():
+    return get_conn().execute("SELECT version FROM inventory_version").fetchone()[0]
+
+# Transaction type codes stored in transactions.type_id; names live in transaction_types
+SALE = 1
+TRANSFER_OUT = 2
+TRANSFER_IN = 3
+TRANSFER_ROLLBACK = 4
+
+_type_ids = {}
+
+# Function to get the code for a transaction type name, registering new names on first use
+def transaction_type_id(name):
+    type_id = _type_ids.get((proddb, name))
+    if type_id is None:
+        conn = get_conn()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO transaction_types (name) VALUES (?)", (name,))
+        type_id = conn.execute("SELECT type_id FROM transaction_types WHERE name = ?", (name,)).fetchone()[0]
+        _type_ids[(proddb, name)] = type_id
+    return type_id
+
+# Transaction timestamps are integer seconds since 1970-01-01 of the local wall clock
+# (no timezone shift), so they round-trip with the "YYYY-MM-DD HH:MM:SS" strings the API uses.
+def now_ts():
+    return calendar.timegm(datetime.now().timetuple())
+
+# Function to convert an API date ("YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS") or integer to a timestamp
+def to_ts(value):
+    if isinstance(value, int) or str(value).isdigit():
+        return int(value)
+    try:
+        return calendar.timegm(datetime.fromisoformat(value).timetuple())
+    except ValueError:
+        raise ValueError(f"invalid date {value!r}, expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS") from None
+
+def ts_day(ts):
+    return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
 def create_tables():
     # Create Products table
-    conn = sqlite3.connect(proddb)
+    conn = get_conn()
     c = conn.cursor()
     cursor = c
     cursor.execute("""
@@ -64,66 +241,397 @@ def create_tables():
     """)
 
     conn.commit()
-    conn.close()
 
-# Function to add a new product
-def add_product(name, description, price, category,client_id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
+#schema migrations
+
+def _migration_inventory_unique(cursor):
+    # Fold duplicate (product, warehouse) rows into the oldest one before adding the unique index
     cursor.execute("""
-    INSERT INTO products (product_name, description, price, category, client_id)
-    VALUES (?, ?, ?, ?, ?)
-    """, (name, description, price, category, client_id))
-    conn.commit()
-    conn.close()
-    return True
+    UPDATE inventory
+    SET quantity = (SELECT SUM(i2.quantity) FROM inventory i2
+                    WHERE i2.product_id = inventory.product_id AND i2.warehouse_id = inventory.warehouse_id)
+    WHERE inventory_id IN (SELECT MIN(inventory_id) FROM inventory
+                           GROUP BY product_id, warehouse_id HAVING COUNT(*) > 1)
+    """)
+    cursor.execute("""
+    DELETE FROM inventory
+    WHERE inventory_id NOT IN (SELECT MIN(inventory_id) FROM inventory GROUP BY product_id, warehouse_id)
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_inventory_product_warehouse ON inventory(product_id, warehouse_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inventory_warehouse ON inventory(warehouse_id, quantity)")
 
-# Function to add a new warehouse
-def add_warehouse(name, location, capacity=1000):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
+def _migration_transactions_indexes(cursor):
+    # Covers get_transactions filtered by product/warehouse and a date range without touching the table
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_transactions_product_warehouse_date
+    ON transactions(product_id, warehouse_id, transaction_date, transaction_type, quantity)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(transaction_date)")
+
+def _migration_products_client(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_client ON products(client_id)")
+
+def _migration_transactions_keyset(cursor):
+    # Put transaction_id right after the date so keyset pages on (transaction_date, transaction_id) need no sort
+    cursor.execute("DROP INDEX IF EXISTS idx_transactions_product_warehouse_date")
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_transactions_product_warehouse_date_id
+    ON transactions(product_id, warehouse_id, transaction_date, transaction_id, transaction_type, quantity)
+    """)
+
+def _migration_daily_sales(cursor):
+    # Per-day sales per product and warehouse, kept current by every sale
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS daily_sales (
+        sale_date TEXT NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        sales INTEGER NOT NULL,
+        PRIMARY KEY (sale_date, warehouse_id, product_id)
+    ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+    INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales)
+    SELECT substr(transaction_date, 1, 10), warehouse_id, product_id, -SUM(quantity)
+    FROM transactions WHERE transaction_type = 'sale'
+    GROUP BY substr(transaction_date, 1, 10), warehouse_id, product_id
+    """)
+
+def _migration_compact_transactions(cursor):
+    # Type names move to a lookup table and text timestamps become integer seconds.
+    # The table is rebuilt in transaction_id order, which is insertion (time) order,
+    # so rows stay clustered by time in the rowid B-tree.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS transaction_types (
+        type_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+    """)
+    cursor.executemany("INSERT OR IGNORE INTO transaction_types (type_id, name) VALUES (?, ?)",
+                       [(SALE, "sale"), (TRANSFER_OUT, "transfer out"), (TRANSFER_IN, "transfer in"), (TRANSFER_ROLLBACK, "transfer rollback")])
+    cursor.execute("INSERT OR IGNORE INTO transaction_types (name) SELECT DISTINCT transaction_type FROM transactions")
+    cursor.execute("""
+    CREATE TABLE transactions_compact (
+        transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        type_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        FOREIGN KEY (product_id) REFERENCES products(product_id),
+        FOREIGN KEY (warehouse_id) REFERENCES warehouses(warehouse_id),
+        FOREIGN KEY (type_id) REFERENCES transaction_types(type_id)
+    );
+    """)
+    cursor.execute("""
+    INSERT INTO transactions_compact (transaction_id, product_id, warehouse_id, type_id, quantity, ts)
+    SELECT t.transaction_id, t.product_id, t.warehouse_id, tt.type_id, t.quantity, CAST(strftime('%s', t.transaction_date) AS INTEGER)
+    FROM transactions t JOIN transaction_types tt ON tt.name = t.transaction_type
+    ORDER BY t.transaction_id
+    """)
+    cursor.execute("DROP TABLE transactions")
+    cursor.execute("ALTER TABLE transactions_compact RENAME TO transactions")
+    cursor.execute("""
+    CREATE INDEX idx_transactions_product_warehouse_ts
+    ON transactions(product_id, warehouse_id, ts, transaction_id, type_id, quantity)
+    """)
+    # The date index also carries each row's formatted timestamp, which SQLite reads from the index
+    # instead of running datetime() per row when a date range returns rows to the API
+    cursor.execute("CREATE INDEX idx_transactions_ts ON transactions(ts, datetime(ts, 'unixepoch'))")
+
+def _migration_inventory_versions(cursor):
+    # A global counter bumped by every inventory write, and the version that last wrote each row,
+    # so in-process caches can fetch just the rows changed since the version they hold
+    cursor.execute("CREATE TABLE IF NOT EXISTS inventory_version (version INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO inventory_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM inventory_version)")
+    cursor.execute("ALTER TABLE inventory ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inventory_row_version ON inventory(row_version)")
+
+def _migration_warehouse_occupancy(cursor):
+    # Units stored per warehouse, kept in step with every inventory write so capacity checks need no SUM
     cursor.execute("""
-    INSERT INTO warehouses (warehouse_name, location, capacity)
-    VALUES (?, ?, ?)
-    """, (name, location, capacity))
+    CREATE TABLE IF NOT EXISTS warehouse_occupancy (
+        warehouse_id INTEGER PRIMARY KEY,
+        occupied INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (warehouse_id) REFERENCES warehouses(warehouse_id)
+    );
+    """)
+    cursor.execute(_occupancy_rebuild_sql)
+
+def _migration_warehouse_coordinates(cursor):
+    # Degrees, NULL until the warehouse is geocoded; read by the routing index
+    cursor.execute("ALTER TABLE warehouses ADD COLUMN latitude REAL")
+    cursor.execute("ALTER TABLE warehouses ADD COLUMN longitude REAL")
+
+def _migration_forecasts(cursor):
+    # Daily demand forecasts per product and warehouse, written by forecast.py
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS forecasts (
+        product_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        forecast_date TEXT NOT NULL,
+        sales REAL NOT NULL,
+        PRIMARY KEY (product_id, warehouse_id, forecast_date)
+    ) WITHOUT ROWID;
+    """)
+    # The model chosen for each series and its smoothing state after the last day it saw
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS forecast_models (
+        product_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        alpha REAL,
+        gamma REAL,
+        mae REAL,
+        level REAL,
+        season BLOB,
+        fitted_through TEXT NOT NULL,
+        PRIMARY KEY (product_id, warehouse_id)
+    ) WITHOUT ROWID;
+    """)
+
+def _migration_forecast_versions(cursor):
+    # Ledger version (last transaction_id) each cached forecast reflects, and the last refresh pass
+    cursor.execute("ALTER TABLE forecast_models ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS forecast_refresh (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        through TEXT NOT NULL,
+        data_version INTEGER NOT NULL
+    );
+    """)
+
+def _migration_reorder_points(cursor):
+    # Safety stock and reorder point per product and warehouse, written by reorder.py
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS reorder_points (
+        product_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        daily_demand REAL NOT NULL,
+        demand_std REAL NOT NULL,
+        lead_time_days REAL NOT NULL,
+        safety_stock INTEGER NOT NULL,
+        reorder_point INTEGER NOT NULL,
+        computed_through TEXT NOT NULL,
+        PRIMARY KEY (product_id, warehouse_id)
+    ) WITHOUT ROWID;
+    """)
+    # The reorder point is copied onto its inventory row so a partial index can hold exactly the
+    # rows at or below it; every stock write keeps that index current without extra work
+    cursor.execute("ALTER TABLE inventory ADD COLUMN reorder_point INTEGER")
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_inventory_reorder
+    ON inventory(warehouse_id, product_id, quantity, reorder_point) WHERE quantity <= reorder_point
+    """)
+
+def _migration_daily_sales_product(cursor):
+    # Covering index so one client's daily sales are read product by product, not by scanning every client's days
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_sales_product ON daily_sales(product_id, warehouse_id, sale_date, sales)")
+
+def _migration_report_batch(cursor):
+    # Per-client checkpoints of reportbatch.py runs, so an interrupted run resumes where it stopped
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS report_batch (
+        run_id TEXT NOT NULL,
+        client_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        error TEXT,
+        seconds REAL,
+        finished_at TEXT NOT NULL,
+        PRIMARY KEY (run_id, client_id)
+    ) WITHOUT ROWID;
+    """)
+
+def _migration_inventory_deletes(cursor):
+    # Deleting an inventory row, however it is done, bumps the inventory version and leaves a
+    # tombstone, so in-process caches drop the row on their next refresh
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS inventory_deleted (
+        product_id INTEGER NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        version INTEGER NOT NULL
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inventory_deleted_version ON inventory_deleted(version)")
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_inventory_deleted AFTER DELETE ON inventory
+    BEGIN
+        UPDATE inventory_version SET version = version + 1;
+        INSERT INTO inventory_deleted (product_id, warehouse_id, version)
+        SELECT OLD.product_id, OLD.warehouse_id, version FROM inventory_version;
+    END;
+    """)
+
+# Ordered upgrade steps: (version, description, step).
+# Append new steps at the end; never renumber or edit a step that has shipped.
+MIGRATIONS = [
+    (1, "unique inventory per product and warehouse", _migration_inventory_unique),
+    (2, "transactions product/warehouse/date indexes", _migration_transactions_indexes),
+    (3, "products client_id index", _migration_products_client),
+    (4, "transactions keyset pagination index", _migration_transactions_keyset),
+    (5, "daily_sales rollup", _migration_daily_sales),
+    (6, "compact transactions: type codes and integer timestamps", _migration_compact_transactions),
+    (7, "inventory row versions", _migration_inventory_versions),
+    (8, "warehouse occupancy counters", _migration_warehouse_occupancy),
+    (9, "warehouse coordinates", _migration_warehouse_coordinates),
+    (10, "forecasts", _migration_forecasts),
+    (11, "forecast data versions", _migration_forecast_versions),
+    (12, "reorder points", _migration_reorder_points),
+    (13, "daily_sales product index", _migration_daily_sales_product),
+    (14, "report batch checkpoints", _migration_report_batch),
+    (15, "inventory delete tombstones", _migration_inventory_deletes),
+]
+
+# Function to get the schema version of the database
+def schema_version():
+    row = get_conn().execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+# Function to bring the database up to the latest schema (or to target), run on startup
+def migrate(target=None):
+    create_tables()
+    conn = get_conn()
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    );
+    """)
     conn.commit()
-    conn.close()
+    for version, description, step in MIGRATIONS:
+        if version <= schema_version() or (target is not None and version > target):
+            continue
+        # Take the write lock first so concurrent workers apply each step only once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= schema_version():
+                conn.rollback()
+                continue
+            step(conn.cursor())
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migrated {proddb} to schema version {version}: {description}")
+    return schema_version()
+
+# Queries on the request path that must be answered from an index
+HOT_QUERIES = {
+    "inventory by product and warehouse": ("SELECT quantity FROM inventory WHERE product_id = ? AND warehouse_id = ?", (1, 1)),
+    "inventory levels": ("""
+        SELECT w.warehouse_name, i.quantity FROM inventory i
+        JOIN warehouses w ON i.warehouse_id = w.warehouse_id WHERE i.product_id = ?""", (1,)),
+    "inventory by warehouse": ("SELECT inventory_id, product_id, warehouse_id, quantity FROM inventory WHERE warehouse_id=?", (1,)),
+    "inventory below a quantity in a warehouse": (
+        "SELECT inventory_id, product_id, warehouse_id, quantity FROM inventory WHERE warehouse_id = ? AND quantity < ?", (3, 20)),
+    "warehouse occupancy": ("SELECT occupied FROM warehouse_occupancy WHERE warehouse_id = ?", (1,)),
+    "forecasts by product": ("""
+        SELECT f.forecast_date, f.warehouse_id, f.product_id, f.sales FROM forecasts f
+        WHERE f.product_id = ? AND f.forecast_date >= ? AND f.forecast_date <= ?""", (1, "2024-01-01", "2024-01-31")),
+    "reorder suggestions by warehouse": ("""
+        SELECT i.product_id, i.warehouse_id, i.quantity, i.reorder_point FROM inventory i
+        WHERE i.quantity <= i.reorder_point AND i.warehouse_id = ?""", (1,)),
+    "products by client": ("SELECT * FROM products WHERE client_id=?", (1,)),
+    "transactions by product, warehouse and date": ("""
+        SELECT t.transaction_id, p.product_name, w.warehouse_name, tt.name, t.quantity, datetime(t.ts, 'unixepoch')
+        FROM transactions t
+        JOIN products p ON t.product_id = p.product_id
+        JOIN warehouses w ON t.warehouse_id = w.warehouse_id
+        JOIN transaction_types tt ON t.type_id = tt.type_id
+        WHERE t.product_id = ? AND t.warehouse_id = ? AND t.ts >= ? AND t.ts <= ?""",
+        (1, 1, 1704067200, 1706745600)),
+    "daily sales by date": ("""
+        SELECT d.sale_date, d.warehouse_id, d.product_id, d.sales FROM daily_sales d
+        WHERE d.sale_date >= ? AND d.sale_date <= ? ORDER BY d.sale_date, d.warehouse_id, d.product_id""",
+        ("2024-01-01", "2024-01-31")),
+    "daily sales by client": ("""
+        SELECT d.sale_date, d.warehouse_id, d.product_id, d.sales FROM products p
+        JOIN daily_sales d ON d.product_id = p.product_id
+        WHERE p.client_id = ? AND d.sale_date >= ? AND d.sale_date <= ?""", ("client@example.com", "2024-01-01", "2024-01-31")),
+    "transactions page by product and warehouse": ("""
+        SELECT t.transaction_id, t.type_id, t.quantity, t.ts
+        FROM transactions t WHERE t.product_id = ? AND t.warehouse_id = ?
+        AND (t.ts, t.transaction_id) > (?, ?)
+        ORDER BY t.ts, t.transaction_id LIMIT ?""", (1, 1, 1704067200, 0, 100)),
+    "transactions by date": ("""
+        SELECT t.transaction_id, t.type_id, t.quantity, t.ts
+        FROM transactions t WHERE t.ts >= ? AND t.ts <= ?""",
+        (1704067200, 1706745600)),
+}
+
+# Function to find hot queries whose plan falls back to a full table scan or a sort
+def full_scan_queries():
+    conn = get_conn()
+    out = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if detail.startswith("SCAN") or detail.startswith("USE TEMP B-TREE"):
+                out.append((name, detail))
+    return out
+
+# Function to add a new product
+def add_product(name, description, price, category,client_id):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+        INSERT INTO products (product_name, description, price, category, client_id)
+        VALUES (?, ?, ?, ?, ?)
+        """, (name, description, price, category, client_id))
+    return True
+
+# Function to add a new warehouse; latitude and longitude are in degrees
+def add_warehouse(name, location, capacity=1000, latitude=None, longitude=None):
+    with write_txn() as cursor:
+        warehouse_id = cursor.execute("""
+        INSERT INTO warehouses (warehouse_name, location, capacity, latitude, longitude)
+        VALUES (?, ?, ?, ?, ?)
+        RETURNING warehouse_id
+        """, (name, location, capacity, latitude, longitude)).fetchone()[0]
+        cursor.execute(_occupancy_sql, (warehouse_id, 0))
+    for listener in warehouse_listeners:
+        listener(warehouse_id, latitude, longitude)
     return True
 
 # Function to add inventory to a warehouse
 def add_inventory(product_id, warehouse_id, quantity):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
-    cursor.execute("""
-    INSERT INTO inventory (product_id, warehouse_id, quantity)
-    VALUES (?, ?, ?)
-    """, (product_id, warehouse_id, quantity))
-    conn.commit()
-    conn.close()
+    with write_txn() as cursor:
+        version = _inventory_version(cursor)
+        row = cursor.execute("""
+        INSERT INTO inventory (product_id, warehouse_id, quantity, row_version)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (product_id, warehouse_id) DO UPDATE SET quantity = quantity + excluded.quantity, row_version = excluded.row_version
+        RETURNING inventory_id, quantity
+        """, (product_id, warehouse_id, quantity, version)).fetchone()
+        cursor.execute(_occupancy_sql, (warehouse_id, quantity))
+        _record_inventory(row[0], product_id, warehouse_id, row[1])
     return True
 
 # Function to update inventory quantity
 def update_inventory(product_id, warehouse_id, quantity):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
-    cursor.execute("""
-    UPDATE inventory
-    SET quantity = ?
-    WHERE product_id = ? AND warehouse_id = ?
-    """, (quantity, product_id, warehouse_id))
-    conn.commit()
-    conn.close()
+    with write_txn() as cursor:
+        old = cursor.execute("SELECT quantity FROM inventory WHERE product_id = ? AND warehouse_id = ?",
+                             (product_id, warehouse_id)).fetchone()
+        if old is None:
+            return True
+        version = _inventory_version(cursor)
+        for row in cursor.execute("""
+        UPDATE inventory
+        SET quantity = ?, row_version = ?
+        WHERE product_id = ? AND warehouse_id = ?
+        RETURNING inventory_id, quantity
+        """, (quantity, version, product_id, warehouse_id)).fetchall():
+            cursor.execute(_occupancy_sql, (warehouse_id, row[1] - old[0]))
+            _record_inventory(row[0], product_id, warehouse_id, row[1])
     return True
 
 # Function to retrieve inventory levels for a specific product across warehouses
 def get_inventory_levels(product_id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
+    cursor = get_conn().cursor()
     cursor.execute("""
     SELECT w.warehouse_name, i.quantity
     FROM inventory i
@@ -131,214 +639,252 @@ def get_inventory_levels(product_id):
     WHERE i.product_id = ?
     """, (product_id,))
     out = cursor.fetchall()
-    conn.close()
     return out
 
 
 # Function to retrieve all products
 def get_all_products():
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
+    cursor = get_conn().cursor()
     cursor.execute("SELECT * FROM products")
     out = cursor.fetchall()
-    conn.close()
     return out
 
 def get_warehouse():
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
+    c = get_conn().cursor()
     c.execute("SELECT * FROM warehouses")
     rows = c.fetchall()
-    conn.close()
     return rows
 
 
+#query engine
+
+# Entities the query engine can read: table, and the columns that may be filtered and sorted on.
+# The default projection is every column of the table in table order (matching SELECT *), read
+# from the schema when a query is compiled, so columns added by later migrations are included.
+QUERY_ENTITIES = {
+    "products": ("products", {"product_id", "product_name", "price", "category", "client_id"}),
+    "warehouses": ("warehouses", {"warehouse_id", "warehouse_name", "location", "capacity"}),
+    "inventory": ("inventory", {"inventory_id", "product_id", "warehouse_id", "quantity"}),
+}
+
+# Function to get a table's columns in table order
+def table_columns(table):
+    return [row[1] for row in get_conn().execute(f"PRAGMA table_info({table})")]
+
+# Operator -> (SQL template for one column, number of values it takes; None means one or more)
+QUERY_OPERATORS = {
+    "eq": ("{} = ?", 1),
+    "lt": ("{} < ?", 1),
+    "gt": ("{} > ?", 1),
+    "between": ("{} BETWEEN ? AND ?", 2),
+    "in": ("{} IN ({})", None),
+}
+
+MAX_QUERY_LIMIT = 10000
+
+# Compile a query shape to SQL. Only the shape is cached (database, entity, (column, operator, value
+# count) per filter, sort, projection, whether limited); values are always bound as parameters, so every
+# call with the same shape reuses the same SQL text and SQLite's prepared statement cache hits too.
+@lru_cache(maxsize=512)
+def _compile_query(database, entity, filters, sort, fields, limited):
+    if entity not in QUERY_ENTITIES:
+        raise ValueError(f"unknown entity {entity!r}")
+    table, filterable = QUERY_ENTITIES[entity]
+    columns = table_columns(table)
+    for field in fields:
+        if field not in columns:
+            raise ValueError(f"unknown field {field!r} for {entity}")
+    where = []
+    for column, op, count in filters:
+        if column not in filterable:
+            raise ValueError(f"cannot filter {entity} on {column!r}")
+        if op not in QUERY_OPERATORS:
+            raise ValueError(f"unknown operator {op!r}")
+        template, expected = QUERY_OPERATORS[op]
+        if expected is None:
+            if count < 1:
+                raise ValueError(f"{op} on {column} needs at least one value")
+            where.append(template.format(column, ", ".join("?" * count)))
+        else:
+            if count != expected:
+                raise ValueError(f"{op} on {column} takes {expected} value(s), got {count}")
+            where.append(template.format(column))
+    order = []
+    for key in sort:
+        column = key.lstrip("-")
+        if column not in filterable:
+            raise ValueError(f"cannot sort {entity} on {column!r}")
+        order.append(f"{column} DESC" if key.startswith("-") else column)
+    query = f"SELECT {', '.join(fields or columns)} FROM {table}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    if order:
+        query += " ORDER BY " + ", ".join(order)
+    if limited:
+        query += " LIMIT ?"
+    return query
+
+# Function to query products, warehouses or inventory.
+# filters is a list of (column, operator, values) with values a list, e.g.
+# [("warehouse_id", "eq", [3]), ("quantity", "lt", [20])]; sort is a list of columns, "-column" for
+# descending; fields is the projection (default all columns); limit caps the rows returned.
+def query(entity, filters=(), sort=(), fields=(), limit=None):
+    params = []
+    shape = []
+    for column, op, values in filters:
+        shape.append((column, op, len(values)))
+        params.extend(values)
+    if limit is not None:
+        limit = int(limit)
+        if not 0 < limit <= MAX_QUERY_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_QUERY_LIMIT}")
+        params.append(limit)
+    sql = _compile_query(proddb, entity, tuple(shape), tuple(sort), tuple(fields), limit is not None)
+    cursor = get_conn().cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
 def get_product_by_id(id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE id=?", (id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("products", [("product_id", "eq", [id])])
 
 def get_product_by_name(name):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE product_name=?", (name,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("products", [("product_name", "eq", [name])])
 
+# Products stocked in a warehouse (products have no warehouse column of their own)
 def get_product_by_warehouse(warehouse):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE warehouse=?", (warehouse,))
+    c = get_conn().cursor()
+    c.execute("SELECT * FROM products WHERE product_id IN (SELECT product_id FROM inventory WHERE warehouse_id=?)", (warehouse,))
     rows = c.fetchall()
-    conn.close()
     return rows
 
 def get_product_by_category(category):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE category=?", (category,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("products", [("category", "eq", [category])])
 
 def get_product_by_price(price):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE price=?", (price,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("products", [("price", "eq", [price])])
 
 def get_product_by_client_id(client_id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE client_id=?", (client_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("products", [("client_id", "eq", [client_id])])
 
 def get_warehouse_by_id(id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM warehouses WHERE warehouse_id=?", (id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("warehouses", [("warehouse_id", "eq", [id])])
 
 def get_warehouse_by_name(name):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM warehouses WHERE warehouse_name=?", (name,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("warehouses", [("warehouse_name", "eq", [name])])
 
 def get_warehouse_by_location(location):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM warehouses WHERE location=?", (location,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("warehouses", [("location", "eq", [location])])
 
 def get_inventory_by_product(product_id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE product_id=?", (product_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("product_id", "eq", [product_id])])
 
 def get_inventory_by_warehouse(warehouse_id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE warehouse_id=?", (warehouse_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("warehouse_id", "eq", [warehouse_id])])
 
 def get_inventory_by_product_and_warehouse(product_id, warehouse_id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE product_id=? AND warehouse_id=?", (product_id, warehouse_id))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("product_id", "eq", [product_id]), ("warehouse_id", "eq", [warehouse_id])])
 
 def get_inventory_by_quantity(quantity):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE quantity=?", (quantity,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("quantity", "eq", [quantity])])
 
 def get_inventory_by_product_and_quantity(product_id, quantity):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE product_id=? AND quantity=?", (product_id, quantity))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("product_id", "eq", [product_id]), ("quantity", "eq", [quantity])])
 
 def get_inventory_by_warehouse_and_quantity(warehouse_id, quantity):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE warehouse_id=? AND quantity=?", (warehouse_id, quantity))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("warehouse_id", "eq", [warehouse_id]), ("quantity", "eq", [quantity])])
 
 def get_inventory_by_product_and_warehouse_and_quantity(product_id, warehouse_id, quantity):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT * FROM inventory WHERE product_id=? AND warehouse_id=? AND quantity=?", (product_id, warehouse_id, quantity))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("inventory", [("product_id", "eq", [product_id]), ("warehouse_id", "eq", [warehouse_id]), ("quantity", "eq", [quantity])])
 
 def get_warehouse_location_by_id(id):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    c.execute("SELECT location FROM warehouses WHERE warehouse_id=?", (id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return query("warehouses", [("warehouse_id", "eq", [id])], fields=["location"])
 
 
 #transaction functions add , sale , transfer
 
-# Function to automatically update inventory and log transactions
-def add_transaction(product_id, warehouse_id, transaction_type, quantity):
-    # Check and update inventory
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
-    cursor.execute("""
-    SELECT quantity FROM inventory WHERE product_id = ? AND warehouse_id = ?
-    """, (product_id, warehouse_id))
-    result = cursor.fetchone()
+# Adds quantity to a product's stock, creating the row if needed.
+# Admission is O(1): an increase must fit the warehouse's free space (capacity minus the
+# warehouse_occupancy counter), a decrease must not take the product's stock below zero.
+# The candidate row is only produced when the warehouse exists and either the row already
+# exists (the conflict clause then guards the new total) or the quantity alone is admissible.
+# Affects no row when the check fails.
+_apply_stock_sql = """
+INSERT INTO inventory (product_id, warehouse_id, quantity, row_version)
+SELECT :product_id, :warehouse_id, :quantity, :version
+FROM warehouses w
+WHERE w.warehouse_id = :warehouse_id
+  AND ((:quantity >= 0
+        AND COALESCE((SELECT occupied FROM warehouse_occupancy WHERE warehouse_id = :warehouse_id), 0) + :quantity <= w.capacity)
+       OR EXISTS (SELECT 1 FROM inventory WHERE product_id = :product_id AND warehouse_id = :warehouse_id))
+ON CONFLICT (product_id, warehouse_id) DO UPDATE SET quantity = quantity + excluded.quantity, row_version = excluded.row_version
+WHERE inventory.quantity + excluded.quantity >= 0
+  AND (excluded.quantity <= 0
+       OR COALESCE((SELECT occupied FROM warehouse_occupancy WHERE warehouse_id = excluded.warehouse_id), 0) + excluded.quantity
+          <= (SELECT capacity FROM warehouses WHERE warehouse_id = excluded.warehouse_id))
+RETURNING inventory_id, quantity
+"""
 
-    cursor.execute("""
-    SELECT capacity FROM warehouses WHERE warehouse_id = ?
-    """, (warehouse_id))
-    result2 = cursor.fetchone()
-
-    if result:
-        # Calculate new inventory quantity
-        new_quantity = result[0] + quantity
-        if new_quantity < 0 or new_quantity > result2[0]:
-            print("Error: Not enough inventory for this operation.")
-            return False  # Operation failed due to insufficient inventory
-
-        # Update existing inventory record
-        cursor.execute("""
-        UPDATE inventory SET quantity = ? WHERE product_id = ? AND warehouse_id = ?
-        """, (new_quantity, product_id, warehouse_id))
-    else:
-        # If no record exists, create a new one (only if quantity is positive)
-        if quantity < 0:
-            print("Error: Not enough inventory for this operation.")
-            return False  # Operation failed due to insufficient inventory
-        cursor.execute("""
-        INSERT INTO inventory (product_id, warehouse_id, quantity)
-        VALUES (?, ?, ?)
-        """, (product_id, warehouse_id, quantity))
-
-    # Log the transaction
-    transaction_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("""
-    INSERT INTO transactions (product_id, warehouse_id, transaction_type, quantity, transaction_date)
-    VALUES (?, ?, ?, ?, ?)
-    """, (product_id, warehouse_id, transaction_type, quantity, transaction_date))
+# Adds units to a warehouse's occupancy counter: (warehouse_id, units)
+_occupancy_sql = """
+INSERT INTO warehouse_occupancy (warehouse_id, occupied)
+VALUES (?, ?)
+ON CONFLICT (warehouse_id) DO UPDATE SET occupied = occupied + excluded.occupied
+"""
 
-    conn.commit()
-    conn.close()
+_log_transaction_sql = """
+INSERT INTO transactions (product_id, warehouse_id, type_id, quantity, ts)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+# Adds units sold to the daily_sales rollup: (sale_date, warehouse_id, product_id, sales)
+_rollup_sale_sql = """
+INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (sale_date, warehouse_id, product_id) DO UPDATE SET sales = sales + excluded.sales
+"""
+
+# Recomputes rollup rows from the ledger; callers append the WHERE clause before the grouping
+_rollup_from_transactions_sql = """
+INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales)
+SELECT date(ts, 'unixepoch'), warehouse_id, product_id, -SUM(quantity)
+FROM transactions"""
+_rollup_group_sql = """
+GROUP BY date(ts, 'unixepoch'), warehouse_id, product_id
+ON CONFLICT (sale_date, warehouse_id, product_id) DO UPDATE SET sales = sales + excluded.sales
+"""
+
+# Raised inside write_txn() to roll back a unit of work that failed a check
+class _Rollback(Exception):
+    pass
+
+# Apply one stock movement and log it, inside a write transaction owned by the caller.
+# The inventory version is bumped before the bounds check, so a caller whose movement is rejected
+# must roll the transaction back (raise _Rollback) rather than commit it.
+def _apply_transaction(cursor, product_id, warehouse_id, type_id, quantity, ts):
+    row = cursor.execute(_apply_stock_sql, {"product_id": product_id, "warehouse_id": warehouse_id, "quantity": quantity,
+                                            "version": _inventory_version(cursor)}).fetchone()
+    if row is None:
+        return False
+    _record_inventory(row[0], product_id, warehouse_id, row[1])
+    cursor.execute(_occupancy_sql, (warehouse_id, quantity))
+    cursor.execute(_log_transaction_sql, (product_id, warehouse_id, type_id, quantity, ts))
+    if type_id == SALE:
+        cursor.execute(_rollup_sale_sql, (ts_day(ts), warehouse_id, product_id, -quantity))
+    return True
+
+# Function to automatically update inventory and log transactions
+def add_transaction(product_id, warehouse_id, transaction_type, quantity):
+    quantity = int(quantity)
+    type_id = transaction_type_id(transaction_type)
+    ts = now_ts()
+    # Check, update inventory and log the transaction in one commit; a rejected one is rolled back
+    try:
+        with write_txn() as cursor:
+            if not _apply_transaction(cursor, product_id, warehouse_id, type_id, quantity, ts):
+                raise _Rollback("Not enough inventory for this operation.")
+    except _Rollback as e:
+        print(f"Error: {e}")
+        return False  # Operation failed due to insufficient inventory or capacity
     return True  # Operation successful
 
 def add_sale(product_id, warehouse_id, quantity_sold):
@@ -349,31 +895,136 @@ def add_sale(product_id, warehouse_id, quantity_sold):
     else:
         return("Sale transaction failed due to insufficient inventory.")
 
+# Move stock between warehouses inside a write transaction owned by the caller.
+# Raises _Rollback if either leg fails its bounds check.
+def _apply_transfer(cursor, product_id, source_warehouse_id, destination_warehouse_id, quantity_transferred, ts):
+    if not _apply_transaction(cursor, product_id, source_warehouse_id, TRANSFER_OUT, -quantity_transferred, ts):
+        raise _Rollback(f"Transfer transaction failed due to insufficient inventory at source warehouse. Product ID {product_id}")
+    if not _apply_transaction(cursor, product_id, destination_warehouse_id, TRANSFER_IN, quantity_transferred, ts):
+        raise _Rollback(f"Transfer transaction failed at destination warehouse. Product ID {product_id}")
+
 def add_transfer(product_id, source_warehouse_id, destination_warehouse_id, quantity_transferred):
-    # Transfer out from source warehouse (negative quantity)
+    # Both legs and both log rows are committed together, or not at all
     quantity_transferred = int(quantity_transferred)
-    if add_transaction(product_id, source_warehouse_id, "transfer out", -quantity_transferred):
-        # Transfer in to destination warehouse (positive quantity)
-        if add_transaction(product_id, destination_warehouse_id, "transfer in", quantity_transferred):
-            return(f"Transfer recorded: Product ID {product_id}, From Warehouse {source_warehouse_id} to {destination_warehouse_id}, Quantity: {quantity_transferred}")
-        else:
-            # Rollback the initial deduction if addition to destination fails
-            add_transaction(product_id, source_warehouse_id, "transfer rollback", quantity_transferred)
-            return("Transfer transaction failed at destination warehouse.")
-    else:
-        return("Transfer transaction failed due to insufficient inventory at source warehouse.")
+    ts = now_ts()
+    try:
+        with write_txn() as cursor:
+            _apply_transfer(cursor, product_id, source_warehouse_id, destination_warehouse_id, quantity_transferred, ts)
+    except _Rollback as e:
+        print(f"Error: {e}")
+        return False
+    return(f"Transfer recorded: Product ID {product_id}, From Warehouse {source_warehouse_id} to {destination_warehouse_id}, Quantity: {quantity_transferred}")
 
+# Function to move many products between two warehouses in one commit.
+# items is a list of (product_id, quantity) pairs; if any product fails, nothing moves.
+def add_transfers(source_warehouse_id, destination_warehouse_id, items):
+    items = [(product_id, int(quantity)) for product_id, quantity in items]
+    ts = now_ts()
+    try:
+        with write_txn() as cursor:
+            for product_id, quantity in items:
+                _apply_transfer(cursor, product_id, source_warehouse_id, destination_warehouse_id, quantity, ts)
+    except _Rollback as e:
+        print(f"Error: {e}")
+        return False
+    return(f"Transfer recorded: {len(items)} products, From Warehouse {source_warehouse_id} to {destination_warehouse_id}, Quantity: {sum(q for _, q in items)}")
 
+# Function to execute a transfer plan in one commit.
+# moves is a list of (product_id, source_warehouse_id, destination_warehouse_id, quantity). Every
+# outgoing leg is applied before any incoming one, so space a plan frees in a warehouse is
+# available to the stock it moves in; if any leg fails, nothing moves.
+def add_transfer_plan(moves):
+    moves = [(product_id, source, destination, int(quantity)) for product_id, source, destination, quantity in moves]
+    ts = now_ts()
+    try:
+        with write_txn() as cursor:
+            for product_id, source, destination, quantity in moves:
+                if not _apply_transaction(cursor, product_id, source, TRANSFER_OUT, -quantity, ts):
+                    raise _Rollback(f"Transfer plan failed due to insufficient inventory at source warehouse {source}. Product ID {product_id}")
+            for product_id, source, destination, quantity in moves:
+                if not _apply_transaction(cursor, product_id, destination, TRANSFER_IN, quantity, ts):
+                    raise _Rollback(f"Transfer plan failed at destination warehouse {destination}. Product ID {product_id}")
+    except _Rollback as e:
+        print(f"Error: {e}")
+        return False
+    return(f"Transfer plan recorded: {len(moves)} moves, Quantity: {sum(m[3] for m in moves)}")
 
-def get_transactions(product_id=None, warehouse_id=None, transaction_type=None, date_from=None, date_to=None,product_name=None):
-    conn = sqlite3.connect(proddb)
-    c = conn.cursor()
-    cursor = c
+# Function to record many sales in one commit.
+# lines is a list of (product_id, warehouse_id, quantity_sold). Every line is validated
+# first, then checked against stock in order under the write lock, and the accepted
+# lines are applied with executemany. Returns a summary with one result per line.
+# With all_or_nothing=True a single rejected line rolls back the whole batch.
+def add_sales(lines, all_or_nothing=False):
+    results = []
+    parsed = []
+    for i, line in enumerate(lines):
+        try:
+            product_id, warehouse_id, quantity_sold = (int(v) for v in line)
+            if quantity_sold <= 0:
+                raise ValueError("quantity must be positive")
+        except (TypeError, ValueError) as e:
+            results.append({"line": i, "ok": False, "error": f"invalid line: {e}"})
+            parsed.append(None)
+            continue
+        results.append({"line": i, "ok": True})
+        parsed.append((product_id, warehouse_id, quantity_sold))
+
+    ts = now_ts()
+    committed = False
+    try:
+        with write_txn() as cursor:
+            stock = {}
+            inventory_ids = {}
+            deltas = {}
+            log_rows = []
+            for result, sale in zip(results, parsed):
+                if sale is None:
+                    continue
+                product_id, warehouse_id, quantity_sold = sale
+                key = (product_id, warehouse_id)
+                if key not in stock:
+                    row = cursor.execute("SELECT inventory_id, quantity FROM inventory WHERE product_id = ? AND warehouse_id = ?", key).fetchone()
+                    inventory_ids[key], stock[key] = row if row else (None, 0)
+                if stock[key] < quantity_sold:
+                    result.update(ok=False, error="insufficient inventory")
+                    continue
+                stock[key] -= quantity_sold
+                deltas[key] = deltas.get(key, 0) + quantity_sold
+                log_rows.append((product_id, warehouse_id, SALE, -quantity_sold, ts))
+
+            rejected = sum(1 for r in results if not r["ok"])
+            if all_or_nothing and rejected:
+                raise _Rollback(f"{rejected} of {len(results)} sales rejected")
+            # A batch with every line rejected writes nothing and leaves the inventory version alone
+            if deltas:
+                version = _inventory_version(cursor)
+                cursor.executemany("UPDATE inventory SET quantity = quantity - ?, row_version = ? WHERE product_id = ? AND warehouse_id = ?",
+                                   [(q, version, p, w) for (p, w), q in deltas.items()])
+                for p, w in deltas:
+                    _record_inventory(inventory_ids[(p, w)], p, w, stock[(p, w)])
+                freed = {}
+                for (p, w), q in deltas.items():
+                    freed[w] = freed.get(w, 0) - q
+                cursor.executemany(_occupancy_sql, freed.items())
+                cursor.executemany(_log_transaction_sql, log_rows)
+                cursor.executemany(_rollup_sale_sql, [(ts_day(ts), w, p, q) for (p, w), q in deltas.items()])
+        committed = True
+    except _Rollback as e:
+        print(f"Error: bulk sale rolled back, {e}")
+
+    passed = sum(1 for r in results if r["ok"])
+    return {"committed": committed, "accepted": passed if committed else 0, "rejected": len(results) - passed, "results": results}
+
+
+# Build the filtered transactions query shared by get_transactions and iter_transactions.
+# datetime(t.ts, 'unixepoch') must stay spelled as in idx_transactions_ts, so date ranges read it from the index.
+def _transactions_query(product_id=None, warehouse_id=None, transaction_type=None, date_from=None, date_to=None, product_name=None):
     query = """
-    SELECT t.transaction_id, p.product_name, w.warehouse_name, t.transaction_type, t.quantity, t.transaction_date
+    SELECT t.transaction_id, p.product_name, w.warehouse_name, tt.name, t.quantity, datetime(t.ts, 'unixepoch')
     FROM transactions t
     JOIN products p ON t.product_id = p.product_id
     JOIN warehouses w ON t.warehouse_id = w.warehouse_id
+    JOIN transaction_types tt ON t.type_id = tt.type_id
     WHERE 1=1
     """
     params = []
@@ -386,22 +1037,211 @@ def get_transactions(product_id=None, warehouse_id=None, transaction_type=None,
         query += " AND t.warehouse_id = ?"
         params.append(warehouse_id)
     if transaction_type:
-        query += " AND t.transaction_type = ?"
+        query += " AND t.type_id = (SELECT type_id FROM transaction_types WHERE name = ?)"
         params.append(transaction_type)
     if date_from:
-        query += " AND t.transaction_date >= ?"
-        params.append(date_from)
+        query += " AND t.ts >= ?"
+        params.append(to_ts(date_from))
     if date_to:
-        query += " AND t.transaction_date <= ?"
-        params.append(date_to)
+        query += " AND t.ts <= ?"
+        params.append(to_ts(date_to))
     if product_name:
         query += " AND p.product_name = ?"
         params.append(product_name)
+    return query, params
+
+# Keyset page: rows strictly after the (ts, transaction_id) cursor, in that order
+def _transactions_page(cursor, query, params, limit, after):
+    if after:
+        query += " AND (t.ts, t.transaction_id) > (?, ?)"
+        params = params + [after[0], after[1]]
+    query += " ORDER BY t.ts, t.transaction_id LIMIT ?"
+    cursor.execute(query, tuple(params + [limit]))
+    return cursor.fetchall()
+
+# Cursor tokens are "<transaction_date>|<transaction_id>" of the last row on a page
+def make_cursor(row):
+    return f"{row[5]}|{row[0]}"
+
+def parse_cursor(token):
+    date, _, transaction_id = token.rpartition("|")
+    try:
+        return to_ts(date), int(transaction_id)
+    except ValueError:
+        raise ValueError(f"invalid cursor {token!r}") from None
+
+# Function to get transactions, optionally one keyset page at a time.
+# Without limit all matching rows are returned. With limit, rows are ordered by
+# (transaction_date, transaction_id) and after is the cursor of the previous page.
+def get_transactions(product_id=None, warehouse_id=None, transaction_type=None, date_from=None, date_to=None,product_name=None, limit=None, after=None):
+    cursor = get_conn().cursor()
+    query, params = _transactions_query(product_id, warehouse_id, transaction_type, date_from, date_to, product_name)
+    if limit is None:
+        cursor.execute(query, tuple(params))
+        return cursor.fetchall()
+    if isinstance(after, str):
+        after = parse_cursor(after)
+    return _transactions_page(cursor, query, params, int(limit), after)
+
+# Function to stream matching transactions in constant memory.
+# Walks the ledger in keyset pages so no read snapshot is held for the whole export.
+def iter_transactions(product_id=None, warehouse_id=None, transaction_type=None, date_from=None, date_to=None, product_name=None, page_size=5000):
+    cursor = get_conn().cursor()
+    query, params = _transactions_query(product_id, warehouse_id, transaction_type, date_from, date_to, product_name)
+    after = None
+    while True:
+        rows = _transactions_page(cursor, query, params, page_size, after)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = (to_ts(rows[-1][5]), rows[-1][0])
+
+# Function to recompute daily_sales from the transactions ledger.
+# The rollup is rebuilt into a temporary staging table, folding the ledger in id-range chunks,
+# without holding the write lock. One write transaction then folds in the sales made since,
+# and swaps the staged rows into daily_sales. Readers see the old rollup or the new one, never a partial one.
+def rebuild_daily_sales(chunk_size=100000):
+    conn = get_conn()
+    conn.execute("DROP TABLE IF EXISTS temp.daily_sales_rebuild")
+    conn.execute("""
+    CREATE TEMP TABLE daily_sales_rebuild (
+        sale_date TEXT NOT NULL,
+        warehouse_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        sales INTEGER NOT NULL,
+        PRIMARY KEY (sale_date, warehouse_id, product_id)
+    ) WITHOUT ROWID
+    """)
+    staging_sql = (_rollup_from_transactions_sql.replace("INTO daily_sales", "INTO temp.daily_sales_rebuild")
+                   + f" WHERE type_id = {SALE} AND transaction_id > ? AND transaction_id <= ?" + _rollup_group_sql)
+    try:
+        high = conn.execute("SELECT COALESCE(MAX(transaction_id), 0) FROM transactions").fetchone()[0]
+        for low in range(0, high, chunk_size):
+            with conn:
+                conn.execute(staging_sql, (low, min(low + chunk_size, high)))
+        with write_txn() as cursor:
+            last = cursor.execute("SELECT COALESCE(MAX(transaction_id), 0) FROM transactions").fetchone()[0]
+            cursor.execute(staging_sql, (high, last))
+            cursor.execute("DELETE FROM daily_sales")
+            cursor.execute("INSERT INTO daily_sales (sale_date, warehouse_id, product_id, sales) "
+                           "SELECT sale_date, warehouse_id, product_id, sales FROM temp.daily_sales_rebuild")
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.daily_sales_rebuild")
+    return last
 
+_occupancy_rebuild_sql = """
+INSERT OR REPLACE INTO warehouse_occupancy (warehouse_id, occupied)
+SELECT w.warehouse_id, COALESCE((SELECT SUM(quantity) FROM inventory i WHERE i.warehouse_id = w.warehouse_id), 0)
+FROM warehouses w
+"""
+
+# Function to recompute every warehouse_occupancy counter from the inventory table
+def rebuild_warehouse_occupancy():
+    with write_txn() as cursor:
+        cursor.execute(_occupancy_rebuild_sql)
+
+# Function to get fill ratios for all warehouses from the occupancy counters, without scanning inventory:
+# (warehouse_id, warehouse_name, capacity, occupied, fill_ratio)
+def get_warehouse_utilization():
+    cursor = get_conn().cursor()
+    cursor.execute("""
+    SELECT w.warehouse_id, w.warehouse_name, w.capacity, COALESCE(o.occupied, 0),
+           CASE WHEN w.capacity > 0 THEN CAST(COALESCE(o.occupied, 0) AS REAL) / w.capacity END
+    FROM warehouses w
+    LEFT JOIN warehouse_occupancy o ON o.warehouse_id = w.warehouse_id
+    ORDER BY w.warehouse_id
+    """)
+    return cursor.fetchall()
+
+# Function to get daily sales from the rollup as (sale_date, warehouse_id, product_id, sales),
+# optionally limited to a date range, product, warehouse or client
+def get_daily_sales(date_from=None, date_to=None, product_id=None, warehouse_id=None, client_id=None):
+    query = """
+    SELECT d.sale_date, d.warehouse_id, d.product_id, d.sales
+    FROM daily_sales d
+    """
+    params = []
+    if client_id:
+        query += " JOIN products p ON d.product_id = p.product_id AND p.client_id = ?"
+        params.append(client_id)
+    query += " WHERE 1=1"
+    if date_from:
+        query += " AND d.sale_date >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND d.sale_date <= ?"
+        params.append(date_to)
+    if product_id:
+        query += " AND d.product_id = ?"
+        params.append(product_id)
+    if warehouse_id:
+        query += " AND d.warehouse_id = ?"
+        params.append(warehouse_id)
+    query += " ORDER BY d.sale_date, d.warehouse_id, d.product_id"
+    cursor = get_conn().cursor()
+    cursor.execute(query, tuple(params))
+    return cursor.fetchall()
+
+# Function to get forecast daily sales written by forecast.py: (forecast_date, warehouse_id, product_id, sales)
+def get_forecasts(date_from=None, date_to=None, product_id=None, warehouse_id=None, client_id=None):
+    query = """
+    SELECT f.forecast_date, f.warehouse_id, f.product_id, f.sales
+    FROM forecasts f
+    """
+    params = []
+    if client_id:
+        query += " JOIN products p ON f.product_id = p.product_id AND p.client_id = ?"
+        params.append(client_id)
+    query += " WHERE 1=1"
+    if date_from:
+        query += " AND f.forecast_date >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND f.forecast_date <= ?"
+        params.append(date_to)
+    if product_id:
+        query += " AND f.product_id = ?"
+        params.append(product_id)
+    if warehouse_id:
+        query += " AND f.warehouse_id = ?"
+        params.append(warehouse_id)
+    query += " ORDER BY f.forecast_date, f.warehouse_id, f.product_id"
+    cursor = get_conn().cursor()
+    cursor.execute(query, tuple(params))
+    return cursor.fetchall()
+
+# Function to get the inventory rows at or below their reorder point, read from the partial index that
+# holds only those rows: (product_id, warehouse_id, quantity, reorder_point, safety_stock, daily_demand)
+def get_reorder_suggestions(warehouse_id=None, client_id=None):
+    query = """
+    SELECT i.product_id, i.warehouse_id, i.quantity, i.reorder_point, r.safety_stock, r.daily_demand
+    FROM inventory i
+    JOIN reorder_points r ON r.product_id = i.product_id AND r.warehouse_id = i.warehouse_id
+    """
+    params = []
+    if client_id:
+        # CROSS JOIN keeps the partial index as the outer loop: only rows at or below are visited
+        query += " CROSS JOIN products p ON i.product_id = p.product_id AND p.client_id = ?"
+        params.append(client_id)
+    query += " WHERE i.quantity <= i.reorder_point"
+    if warehouse_id:
+        query += " AND i.warehouse_id = ?"
+        params.append(warehouse_id)
+    query += " ORDER BY i.warehouse_id, i.product_id"
+    cursor = get_conn().cursor()
     cursor.execute(query, tuple(params))
-    conn.close()
     return cursor.fetchall()
 
 # Initialize tables
-# create_tables()
+# migrate()
+
+# Maintenance commands: python dbserver.py migrate | rebuild_daily_sales | rebuild_warehouse_occupancy
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    migrate()
+    if command == "rebuild_daily_sales":
+        print(f"daily_sales rebuilt from {rebuild_daily_sales()} transactions")
+    elif command == "rebuild_warehouse_occupancy":
+        rebuild_warehouse_occupancy()
+        print("warehouse_occupancy rebuilt")
 
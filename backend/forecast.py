@@ -0,0 +1,271 @@
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+import dbserver as db
+
+# Daily demand forecasts for every product x warehouse series.
+# History comes from the daily_sales rollup, which add_sale / add_sales keep in the same commit as
+# the transactions ledger, as one (series x day) array. Simple exponential smoothing, additive weekly
+# Holt-Winters and seasonal-naive are fitted to all series at once; each series keeps the model with
+# the lowest one-step error over the last EVAL_DAYS, and its forecast goes to the forecasts table.
+# Every model ends in the same state, a level plus one seasonal term per weekday, and forecasts
+# level + season[weekday]; seasonal-naive is alpha 0, gamma 1, which keeps the last value seen
+# on each weekday. The tables are a cache: each series records the ledger version (last
+# transaction_id) it reflects, and a refresh pass only advances the series that sold on the days
+# since the previous pass, feeding those days through their saved state. Readers never fit.
+#   python forecast.py [fit|refresh]
+
+HISTORY_DAYS = 112      # days of daily sales the models are fitted on
+FORECAST_DAYS = 30      # days ahead written to the forecasts table
+EVAL_DAYS = 28          # trailing days whose one-step errors pick the model
+SEASON = 7
+ALPHAS = (0.1, 0.3, 0.6)
+GAMMAS = (0.0, 0.15)    # 0 is simple exponential smoothing, above 0 adds weekly seasonality
+MODELS = ["ses", "holt_winters", "seasonal_naive"]
+WRITE_CHUNK = 20000     # series per executemany batch when writing forecasts
+
+
+# Function to get the last complete day of sales (yesterday) as a date
+def last_complete_day():
+    return date.fromisoformat(db.ts_day(db.now_ts())) - timedelta(days=1)
+
+# Function to load daily sales for every series with sales in the window ending on `through`.
+# Returns (product_ids, warehouse_ids, y) with y shaped (series, days), oldest day first.
+def load_series(through=None, history_days=HISTORY_DAYS):
+    through = through or last_complete_day()
+    start = through - timedelta(days=history_days - 1)
+    # Series key and day offset are computed in SQLite so only integers cross into Python
+    rows = db.get_conn().execute("""
+    SELECT (product_id << 32) | warehouse_id, CAST(julianday(sale_date) - julianday(?) AS INTEGER), sales
+    FROM daily_sales
+    WHERE sale_date >= ? AND sale_date <= ?
+    """, (start.isoformat(), start.isoformat(), through.isoformat())).fetchall()
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, history_days))
+    data = np.array(rows, dtype=np.int64)
+    keys, series = np.unique(data[:, 0], return_inverse=True)
+    y = np.zeros((len(keys), history_days))
+    y[series, data[:, 1]] = data[:, 2]
+    return keys >> 32, keys & 0xFFFFFFFF, y
+
+
+# Run the smoothing recursions for K parameter sets over every series at once.
+# level (K, N) and season (7, K, N) are updated in place; season is indexed by weekday.
+# Series i ignores its first skip[i] days, when given.
+# Returns the summed absolute one-step errors over the last `scored` days, shape (K, N).
+def smooth(y, first_weekday, alpha, gamma, level, season, scored=0, skip=None):
+    n_days = y.shape[1]
+    sae = np.zeros_like(level)
+    damp = gamma * (1 - alpha)
+    for t in range(n_days):
+        wd = (first_weekday + t) % SEASON
+        err = y[:, t] - level - season[wd]
+        if skip is not None:
+            err = np.where(t >= skip, err, 0.0)
+        if t >= n_days - scored:
+            sae += np.abs(err)
+        level += alpha * err
+        season[wd] += damp * err
+    return sae
+
+# Function to fit every series of y (series x days, the first day falling on first_weekday).
+# alphas, gammas and naive restrict the candidates (the backtest uses this to score single models).
+# Returns a dict of per-series arrays: model (index into MODELS), alpha, gamma, mae, level and
+# season (series x 7, by weekday), ready for forecast_from_state.
+def fit(y, first_weekday, alphas=ALPHAS, gammas=GAMMAS, naive=True):
+    n_series, n_days = y.shape
+    grid = [(a, g) for g in gammas for a in alphas]
+    alpha = np.array([a for a, _ in grid])[:, None]
+    gamma = np.array([g for _, g in grid])[:, None]
+    warm = min(2 * SEASON, n_days)
+    base = y[:, :warm].mean(axis=1)
+    level = np.repeat(base[None, :], len(grid), axis=0)
+    season = np.zeros((SEASON, len(grid), n_series))
+    for wd in range(SEASON):
+        days = [i for i in range(warm) if (first_weekday + i) % SEASON == wd]
+        season[wd] = (gamma > 0) * (y[:, days].mean(axis=1) - base)
+    scored = min(EVAL_DAYS, n_days - SEASON)
+    sae = smooth(y, first_weekday, alpha, gamma, level, season, scored)
+
+    # Seasonal naive: predict each day with the same weekday a week earlier
+    naive_sae = np.abs(y[:, n_days - scored:] - y[:, n_days - scored - SEASON:n_days - SEASON]).sum(axis=1)
+    sae = np.vstack([sae, naive_sae[None, :] if naive else np.full((1, n_series), np.inf)])
+    best = np.argmin(sae, axis=0)
+    naive = best == len(grid)
+    pick = np.where(naive, 0, best)
+    cols = np.arange(n_series)
+
+    last_week = np.zeros((n_series, SEASON))
+    for t in range(n_days - SEASON, n_days):
+        last_week[:, (first_weekday + t) % SEASON] = y[:, t]
+    out_season = np.where(naive[:, None], last_week, season[:, pick, cols].T)
+    return {
+        "model": np.where(naive, MODELS.index("seasonal_naive"),
+                          np.where(gamma[pick, 0] > 0, MODELS.index("holt_winters"), MODELS.index("ses"))),
+        "alpha": np.where(naive, 0.0, alpha[pick, 0]),
+        "gamma": np.where(naive, 1.0, gamma[pick, 0]),
+        "mae": sae[best, cols] / max(scored, 1),
+        "level": np.where(naive, 0.0, level[pick, cols]),
+        "season": out_season,
+    }
+
+# Function to advance fitted states (as returned by fit, one entry per series) over new days.
+# y is (series x days) with its first day on first_weekday; series i has already seen its first skip[i] days.
+def advance(state, y, first_weekday, skip):
+    level = state["level"][None, :].copy()
+    season = state["season"].T[:, None, :].copy()
+    smooth(y, first_weekday, state["alpha"][None, :], state["gamma"][None, :], level, season, skip=skip)
+    return dict(state, level=level[0], season=season[:, 0, :].T)
+
+# Function to forecast `days` days after `through` from fitted states: (series x days), never negative
+def forecast_from_state(level, season, through, days=FORECAST_DAYS):
+    weekdays = [(through + timedelta(days=h)).weekday() for h in range(1, days + 1)]
+    return np.maximum(level[:, None] + season[:, weekdays], 0.0)
+
+
+# Function to fit every series and replace the forecasts and forecast_models tables.
+# Returns a summary with the series count, model mix and timings.
+def run(through=None, history_days=HISTORY_DAYS, days=FORECAST_DAYS):
+    started = time.perf_counter()
+    through = through or last_complete_day()
+    if history_days < 2 * SEASON:
+        raise ValueError(f"history_days must be at least {2 * SEASON}")
+    products, warehouses, y = load_series(through, history_days)
+    loaded = time.perf_counter()
+    first = through - timedelta(days=history_days - 1)
+    state = fit(y, first.weekday()) if len(y) else None
+    fitted = time.perf_counter()
+    with db.write_txn() as cursor:
+        version = ledger_version(cursor, through)
+        cursor.execute("DELETE FROM forecasts")
+        cursor.execute("DELETE FROM forecast_models")
+        if state is not None:
+            write(cursor, products, warehouses, state, through, version, days)
+        _mark_refresh(cursor, through, version)
+    done = time.perf_counter()
+    mix = {name: int((state["model"] == i).sum()) for i, name in enumerate(MODELS)} if state else {}
+    return {"series": len(y), "through": through.isoformat(), "models": mix,
+            "load_seconds": loaded - started, "fit_seconds": fitted - loaded, "write_seconds": done - fitted}
+
+# Write models and forecasts for the given series inside the caller's transaction
+def write(cursor, products, warehouses, state, through, version, days=FORECAST_DAYS):
+    dates = [(through + timedelta(days=h)).isoformat() for h in range(1, days + 1)]
+    season_blobs = [row.tobytes() for row in state["season"]]
+    cursor.executemany("""
+    INSERT OR REPLACE INTO forecast_models (product_id, warehouse_id, model, alpha, gamma, mae, level, season, fitted_through, data_version)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, zip(products.tolist(), warehouses.tolist(), [MODELS[m] for m in state["model"].tolist()], state["alpha"].tolist(),
+             state["gamma"].tolist(), state["mae"].tolist(), state["level"].tolist(), season_blobs,
+             [through.isoformat()] * len(products), [version] * len(products)))
+    for lo in range(0, len(products), WRITE_CHUNK):
+        hi = min(lo + WRITE_CHUNK, len(products))
+        sales = np.round(forecast_from_state(state["level"][lo:hi], state["season"][lo:hi], through, days), 2)
+        cursor.executemany("INSERT OR REPLACE INTO forecasts (product_id, warehouse_id, forecast_date, sales) VALUES (?, ?, ?, ?)",
+                           zip(np.repeat(products[lo:hi], days).tolist(), np.repeat(warehouses[lo:hi], days).tolist(),
+                               dates * (hi - lo), sales.ravel().tolist()))
+
+
+# Ledger version a fit through `through` reflects: the last transaction stamped on or before that day
+def ledger_version(cursor, through):
+    row = cursor.execute("SELECT transaction_id FROM transactions WHERE ts < ? ORDER BY ts DESC, transaction_id DESC LIMIT 1",
+                         (db.to_ts((through + timedelta(days=1)).isoformat()),)).fetchone()
+    return row[0] if row else 0
+
+def _mark_refresh(cursor, through, version):
+    cursor.execute("INSERT OR REPLACE INTO forecast_refresh (id, through, data_version) VALUES (1, ?, ?)",
+                   (through.isoformat(), version))
+
+# Function to bring the cache up to `through` (default yesterday) without refitting unchanged series.
+# Series that sold on the days since the last pass are advanced from their saved state; series new
+# to the cache, too stale to advance, or with sales recorded for days already fitted are fitted over
+# the full history. Everything else keeps its cached forecast. Falls back to run() on an empty cache.
+def refresh(through=None, history_days=HISTORY_DAYS, days=FORECAST_DAYS):
+    started = time.perf_counter()
+    through = through or last_complete_day()
+    conn = db.get_conn()
+    last = conn.execute("SELECT through, data_version FROM forecast_refresh WHERE id = 1").fetchone()
+    if last is None:
+        return dict(run(through, history_days, days), refreshed="full")
+    previous, previous_version = date.fromisoformat(last[0]), last[1]
+    if through <= previous:
+        return {"series": 0, "through": previous.isoformat(), "refreshed": "current", "seconds": time.perf_counter() - started}
+
+    # Series with sales on the new days, from the rollup's date-leading primary key
+    changed = conn.execute("""
+    SELECT DISTINCT (product_id << 32) | warehouse_id FROM daily_sales WHERE sale_date > ? AND sale_date <= ?
+    """, (previous.isoformat(), through.isoformat())).fetchall()
+    # Sales recorded since the last pass but stamped on days it already covered cannot be advanced over
+    late = conn.execute("""
+    SELECT DISTINCT (product_id << 32) | warehouse_id FROM transactions
+    WHERE transaction_id > ? AND type_id = ? AND ts < ?
+    """, (previous_version, db.SALE, db.to_ts((previous + timedelta(days=1)).isoformat()))).fetchall()
+    late = set(k for k, in late)
+    keys = sorted(set(k for k, in changed) | late)
+
+    cached = {}
+    for key in keys:
+        if key in late:
+            continue
+        row = conn.execute("""
+        SELECT model, alpha, gamma, mae, level, season, fitted_through FROM forecast_models WHERE product_id = ? AND warehouse_id = ?
+        """, (key >> 32, key & 0xFFFFFFFF)).fetchone()
+        if row and (through - date.fromisoformat(row[6])).days < history_days:
+            cached[key] = row
+    refit = np.array([k for k in keys if k not in cached], dtype=np.int64)
+    stepped = np.array(sorted(cached), dtype=np.int64)
+
+    states = []
+    if len(stepped):
+        rows = [cached[k] for k in stepped.tolist()]
+        oldest = min(date.fromisoformat(r[6]) for r in rows)
+        n_days = (through - oldest).days
+        y = _window(stepped, oldest + timedelta(days=1), n_days)
+        state = {"model": np.array([MODELS.index(r[0]) for r in rows]), "alpha": np.array([r[1] for r in rows]),
+                 "gamma": np.array([r[2] for r in rows]), "mae": np.array([r[3] for r in rows]),
+                 "level": np.array([r[4] for r in rows]), "season": np.vstack([np.frombuffer(r[5]) for r in rows])}
+        skip = np.array([(date.fromisoformat(r[6]) - oldest).days for r in rows])
+        states.append((stepped, advance(state, y, (oldest + timedelta(days=1)).weekday(), skip)))
+    if len(refit):
+        first = through - timedelta(days=history_days - 1)
+        states.append((refit, fit(_window(refit, first, history_days), first.weekday())))
+
+    with db.write_txn() as cursor:
+        version = ledger_version(cursor, through)
+        for series, state in states:
+            products, warehouses = series >> 32, series & 0xFFFFFFFF
+            cursor.executemany("DELETE FROM forecasts WHERE product_id = ? AND warehouse_id = ?",
+                               zip(products.tolist(), warehouses.tolist()))
+            write(cursor, products, warehouses, state, through, version, days)
+        _mark_refresh(cursor, through, version)
+    return {"series": len(keys), "advanced": len(stepped), "refitted": len(refit), "through": through.isoformat(),
+            "refreshed": "incremental", "seconds": time.perf_counter() - started}
+
+# Daily sales of the given series keys over n_days from `start`, as (series x days)
+def _window(keys, start, n_days):
+    rows = db.get_conn().execute("""
+    SELECT (product_id << 32) | warehouse_id, CAST(julianday(sale_date) - julianday(?) AS INTEGER), sales
+    FROM daily_sales
+    WHERE sale_date >= ? AND sale_date <= ?
+    """, (start.isoformat(), start.isoformat(), (start + timedelta(days=n_days - 1)).isoformat())).fetchall()
+    y = np.zeros((len(keys), n_days))
+    if rows:
+        data = np.array(rows, dtype=np.int64)
+        pos = np.searchsorted(keys, data[:, 0])
+        hit = (pos < len(keys)) & (keys[np.minimum(pos, len(keys) - 1)] == data[:, 0])
+        y[pos[hit], data[hit, 1]] = data[hit, 2]
+    return y
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "fit"
+    db.migrate()
+    if command == "fit":
+        summary = run()
+        print(f"Forecast {summary['series']} series through {summary['through']}: {summary['models']}")
+        print(f"  load {summary['load_seconds']:.1f}s, fit {summary['fit_seconds']:.1f}s, write {summary['write_seconds']:.1f}s")
+    elif command == "refresh":
+        summary = refresh()
+        print(f"Forecast cache {summary['refreshed']} through {summary['through']}: {summary}")
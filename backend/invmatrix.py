@@ -0,0 +1,236 @@
+import threading
+import time
+
+import numpy as np
+
+import dbserver as db
+
+# In-process product x warehouse stock matrix for the /api/v1/get_inventory_* routes.
+# Loaded from the inventory table, kept current write-through by dbserver's inventory
+# listeners, and refreshed from other processes' writes using the inventory version:
+# a worker never serves stock more than MAX_STALENESS seconds older than the database.
+# Deleted rows are dropped on refresh through the inventory_deleted tombstones. A row updated
+# by raw SQL that does not bump the inventory version and stamp row_version is only seen by load().
+
+MAX_STALENESS = 1.0     # seconds between version checks against the database
+
+
+class InventoryMatrix:
+    def __init__(self, max_staleness=MAX_STALENESS):
+        self.max_staleness = max_staleness
+        self.lock = threading.RLock()
+        self.path = None
+        self.generation = 0             # bumped on every full load, when rows and columns are renumbered
+        self._clear()
+
+    def _clear(self):
+        self.product_rows = {}          # product_id -> row
+        self.warehouse_cols = {}        # warehouse_id -> column
+        self.product_ids = np.zeros(0, dtype=np.int64)
+        self.warehouse_ids = np.zeros(0, dtype=np.int64)
+        self.quantity = np.zeros((0, 0), dtype=np.int64)
+        self.present = np.zeros((0, 0), dtype=bool)     # whether a (product, warehouse) pair has an inventory row
+        self.inventory_id = np.zeros((0, 0), dtype=np.int64)
+        self.row_version = np.zeros((0, 0), dtype=np.int64)
+        self.warehouse_names = {}
+        self.version = 0
+        self.checked = 0.0
+
+    # Function to (re)load the whole matrix from the inventory table
+    def load(self):
+        with self.lock:
+            self._clear()
+            self.generation += 1
+            self.path = db.proddb
+            conn = db.get_conn()
+            self.version = db.inventory_version()
+            self.warehouse_names = dict(conn.execute("SELECT warehouse_id, warehouse_name FROM warehouses"))
+            rows = conn.execute("SELECT inventory_id, product_id, warehouse_id, quantity, row_version FROM inventory").fetchall()
+            self._set(rows)
+            self.checked = time.monotonic()
+
+    def _grow(self, n_products, n_warehouses):
+        rows, cols = self.quantity.shape
+        if n_products <= rows and n_warehouses <= cols:
+            return
+        # Only the axis that overflowed doubles
+        shape = (rows if n_products <= rows else max(n_products, rows * 2, 16),
+                 cols if n_warehouses <= cols else max(n_warehouses, cols * 2, 16))
+
+        def regrow(a):
+            out = np.zeros(shape, dtype=a.dtype)
+            out[:rows, :cols] = a
+            return out
+
+        self.quantity = regrow(self.quantity)
+        self.present = regrow(self.present)
+        self.inventory_id = regrow(self.inventory_id)
+        self.row_version = regrow(self.row_version)
+        product_ids = np.zeros(shape[0], dtype=np.int64)
+        product_ids[:rows] = self.product_ids
+        self.product_ids = product_ids
+        warehouse_ids = np.zeros(shape[1], dtype=np.int64)
+        warehouse_ids[:cols] = self.warehouse_ids
+        self.warehouse_ids = warehouse_ids
+
+    def _index(self, product_id, warehouse_id):
+        row = self.product_rows.get(product_id)
+        if row is None:
+            row = self.product_rows[product_id] = len(self.product_rows)
+        col = self.warehouse_cols.get(warehouse_id)
+        if col is None:
+            col = self.warehouse_cols[warehouse_id] = len(self.warehouse_cols)
+        self._grow(len(self.product_rows), len(self.warehouse_cols))
+        self.product_ids[row] = product_id
+        self.warehouse_ids[col] = warehouse_id
+        return row, col
+
+    # Store rows of (inventory_id, product_id, warehouse_id, quantity, row_version),
+    # skipping any cell that already holds a newer version
+    def _set(self, rows):
+        for inventory_id, product_id, warehouse_id, quantity, row_version in rows:
+            row, col = self._index(product_id, warehouse_id)
+            if row_version < self.row_version[row, col]:
+                continue
+            if inventory_id is not None:
+                self.inventory_id[row, col] = inventory_id
+            self.quantity[row, col] = quantity
+            self.present[row, col] = True
+            self.row_version[row, col] = row_version
+            if warehouse_id not in self.warehouse_names:
+                self.warehouse_names.update(db.get_conn().execute("SELECT warehouse_id, warehouse_name FROM warehouses"))
+
+    # Write-through: registered as a dbserver inventory listener, called after each local commit
+    def apply(self, changes, version):
+        with self.lock:
+            if self.path != db.proddb:
+                return
+            self._set((inventory_id, product_id, warehouse_id, quantity, version)
+                      for inventory_id, product_id, warehouse_id, quantity in changes)
+            # Only advance if no other process committed in between; otherwise the next refresh catches up
+            if version == self.version + 1:
+                self.version = version
+
+    # Pull rows written or deleted by other processes since the version this matrix holds
+    def refresh(self):
+        with self.lock:
+            if self.path != db.proddb:
+                self.load()
+                return
+            version = db.inventory_version()
+            if version > self.version:
+                conn = db.get_conn()
+                # Deleted cells are cleared first, so a row deleted and written again is picked up below
+                for product_id, warehouse_id in conn.execute("""
+                SELECT DISTINCT product_id, warehouse_id FROM inventory_deleted WHERE version > ?
+                """, (self.version,)).fetchall():
+                    row, col = self.product_rows.get(product_id), self.warehouse_cols.get(warehouse_id)
+                    if row is not None and col is not None:
+                        self.quantity[row, col] = 0
+                        self.present[row, col] = False
+                        self.inventory_id[row, col] = 0
+                        self.row_version[row, col] = 0
+                rows = conn.execute("""
+                SELECT inventory_id, product_id, warehouse_id, quantity, row_version
+                FROM inventory WHERE row_version > ?
+                """, (self.version,)).fetchall()
+                self._set(rows)
+                self.version = version
+            self.checked = time.monotonic()
+
+    def _fresh(self):
+        if self.path != db.proddb or time.monotonic() - self.checked > self.max_staleness:
+            self.refresh()
+
+    # Rows in the shape of the inventory table: (inventory_id, product_id, warehouse_id, quantity)
+    def _rows(self, rows, cols):
+        return list(zip(self.inventory_id[rows, cols].tolist(), self.product_ids[rows].tolist(),
+                        self.warehouse_ids[cols].tolist(), self.quantity[rows, cols].tolist()))
+
+    # Function to select inventory rows by any combination of product, warehouse and quantity
+    def select(self, product_id=None, warehouse_id=None, quantity=None):
+        with self.lock:
+            self._fresh()
+            row = self.product_rows.get(product_id) if product_id is not None else None
+            col = self.warehouse_cols.get(warehouse_id) if warehouse_id is not None else None
+            if (product_id is not None and row is None) or (warehouse_id is not None and col is None):
+                return []
+            if row is not None and col is not None:
+                # Single cell: plain scalar reads, no array temporaries
+                stock = int(self.quantity[row, col])
+                if not self.present[row, col] or (quantity is not None and stock != quantity):
+                    return []
+                return [(int(self.inventory_id[row, col]), product_id, warehouse_id, stock)]
+            if row is not None:
+                line = self.quantity[row, :len(self.warehouse_cols)]
+                held = self.present[row, :len(self.warehouse_cols)]
+                cols = np.flatnonzero(held if quantity is None else held & (line == quantity))
+                return list(zip(self.inventory_id[row, cols].tolist(), [product_id] * len(cols),
+                                self.warehouse_ids[cols].tolist(), line[cols].tolist()))
+            if col is not None:
+                line = self.quantity[:len(self.product_rows), col]
+                held = self.present[:len(self.product_rows), col]
+                rows = np.flatnonzero(held if quantity is None else held & (line == quantity))
+                return list(zip(self.inventory_id[rows, col].tolist(), self.product_ids[rows].tolist(),
+                                [warehouse_id] * len(rows), line[rows].tolist()))
+            block = self.quantity[:len(self.product_rows), :len(self.warehouse_cols)]
+            held = self.present[:len(self.product_rows), :len(self.warehouse_cols)]
+            rows, cols = np.nonzero(held if quantity is None else held & (block == quantity))
+            return self._rows(rows, cols)
+
+    # Function to retrieve (warehouse_name, quantity) for a product across warehouses
+    def levels(self, product_id):
+        return [(self.warehouse_names.get(warehouse_id), quantity)
+                for _, _, warehouse_id, quantity in self.select(product_id=product_id)]
+
+
+matrix = InventoryMatrix()
+db.inventory_listeners.append(matrix.apply)
+
+
+# Route helpers mirroring dbserver's get_inventory_* functions; ids arrive as query strings
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def get_inventory_levels(product_id):
+    product_id = _int(product_id)
+    return matrix.levels(product_id) if product_id is not None else []
+
+def get_inventory_by_product(product_id):
+    product_id = _int(product_id)
+    return matrix.select(product_id=product_id) if product_id is not None else []
+
+def get_inventory_by_warehouse(warehouse_id):
+    warehouse_id = _int(warehouse_id)
+    return matrix.select(warehouse_id=warehouse_id) if warehouse_id is not None else []
+
+def get_inventory_by_product_and_warehouse(product_id, warehouse_id):
+    product_id, warehouse_id = _int(product_id), _int(warehouse_id)
+    if product_id is None or warehouse_id is None:
+        return []
+    return matrix.select(product_id=product_id, warehouse_id=warehouse_id)
+
+def get_inventory_by_quantity(quantity):
+    quantity = _int(quantity)
+    return matrix.select(quantity=quantity) if quantity is not None else []
+
+def get_inventory_by_product_and_quantity(product_id, quantity):
+    product_id, quantity = _int(product_id), _int(quantity)
+    if product_id is None or quantity is None:
+        return []
+    return matrix.select(product_id=product_id, quantity=quantity)
+
+def get_inventory_by_warehouse_and_quantity(warehouse_id, quantity):
+    warehouse_id, quantity = _int(warehouse_id), _int(quantity)
+    if warehouse_id is None or quantity is None:
+        return []
+    return matrix.select(warehouse_id=warehouse_id, quantity=quantity)
+
+def get_inventory_by_product_and_warehouse_and_quantity(product_id, warehouse_id, quantity):
+    product_id, warehouse_id, quantity = _int(product_id), _int(warehouse_id), _int(quantity)
+    if product_id is None or warehouse_id is None or quantity is None:
+        return []
+    return matrix.select(product_id=product_id, warehouse_id=warehouse_id, quantity=quantity)
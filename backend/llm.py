@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from collections import deque
+
+import groq
+from groq import Groq
+
+# LLM clients for report generation. Every client has
+#   complete(system, message, model, max_tokens) -> completion text
+#   stream(system, message, model, max_tokens) -> iterator of text deltas
+# and reportgen uses whichever is in `client`. GroqLLM calls the Groq API; FakeLLM answers locally
+# after an artificial latency, for benchmarks and for running without an API key
+# (SPACIFY_LLM=fake, optionally SPACIFY_FAKE_LLM_LATENCY=seconds).
+# A client over the provider's rate limit raises RateLimitError.
+
+TIMEOUT = 60.0          # seconds a completion may take before the API call gives up
+
+
+# Raised when the provider rejects a call for going over its rate limit; retry_after is the
+# number of seconds it asked for, or None
+class RateLimitError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Groq API key, read from apikey.txt when the first report is generated
+def api_key():
+    with open('apikey.txt','r') as f:
+        return f.read()
+
+
+class GroqLLM:
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.groq = None
+
+    # One Groq client per process, so its HTTP connections are kept alive and reused between reports
+    def _groq(self):
+        with self.lock:
+            if self.groq is None:
+                self.groq = Groq(
+                    api_key=api_key(),
+                    timeout=self.timeout,
+                )
+            return self.groq
+
+    def _create(self, system, message, model, max_tokens, stream):
+        try:
+            return self._request(system, message, model, max_tokens, stream)
+        except groq.RateLimitError as e:
+            retry_after = e.response.headers.get("retry-after")
+            raise RateLimitError(str(e), float(retry_after) if retry_after else None) from e
+
+    def _request(self, system, message, model, max_tokens, stream):
+
+        return self._groq().chat.completions.create(
+            #
+            # Required parameters
+            #
+            messages=[
+                # Set an optional system message. This sets the behavior of the
+                # assistant and can be used to provide specific instructions for
+                # how it should behave throughout the conversation.
+                {
+                    "role": "system",
+                    "content": system
+                },
+                # Set a user message for the assistant to respond to.
+                {
+                    "role": "user",
+                    "content": message,
+                }
+            ],
+
+            # The language model which will generate the completion.
+            model=model,
+
+            #
+            # Optional parameters
+            #
+
+            # Controls randomness: lowering results in less random completions.
+            # As the temperature approaches zero, the model will become
+            # deterministic and repetitive.
+            temperature=0,
+
+            # The maximum number of tokens to generate. Requests can use up to
+            # 2048 tokens shared between prompt and completion.
+            max_tokens=max_tokens,
+
+            # Controls diversity via nucleus sampling: 0.5 means half of all
+            # likelihood-weighted options are considered.
+            top_p=1,
+
+            # A stop sequence is a predefined or user-specified text string that
+            # signals an AI to stop generating content, ensuring its responses
+            # remain focused and concise. Examples include punctuation marks and
+            # markers like "[end]".
+            stop=None,
+
+            # If set, partial message deltas will be sent.
+            stream=stream,
+        )
+
+    def complete(self, system, message, model, max_tokens):
+        return self._create(system, message, model, max_tokens, stream=False).choices[0].message.content
+
+    # Function to yield the completion's text deltas as the model produces them
+    def stream(self, system, message, model, max_tokens):
+        for chunk in self._create(system, message, model, max_tokens, stream=True):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class FakeLLM:
+    def __init__(self, latency=1.0, first_token=None, tokens=50, rpm=None, per=60.0):
+        self.latency = latency                  # seconds for the whole completion
+        self.first_token = latency / 10 if first_token is None else first_token
+        self.tokens = tokens
+        self.rpm = rpm                          # calls allowed in any `per` seconds, like a provider's limit
+        self.per = per
+        self.lock = threading.Lock()
+        self.started = deque()                  # start times of the calls in the last `per` seconds
+        self.calls = self.rejected = 0
+
+    def complete(self, system, message, model, max_tokens):
+        return "".join(self.stream(system, message, model, max_tokens))
+
+    def stream(self, system, message, model, max_tokens):
+        with self.lock:
+            now = time.monotonic()
+            while self.started and self.started[0] <= now - self.per:
+                self.started.popleft()
+            if self.rpm is not None and len(self.started) >= self.rpm:
+                self.rejected += 1
+                raise RateLimitError(f"over {self.rpm} calls per {self.per:g}s", self.started[0] + self.per - now)
+            self.started.append(now)
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.first_token)
+        yield f"Report {call} from {model}: {len(message)} characters of input summarised."
+        for i in range(self.tokens - 1):
+            time.sleep(max(self.latency - self.first_token, 0) / max(self.tokens - 1, 1))
+            yield f" token{i}"
+
+
+if os.environ.get("SPACIFY_LLM") == "fake":
+    client = FakeLLM(float(os.environ.get("SPACIFY_FAKE_LLM_LATENCY", 1.0)))
+else:
+    client = GroqLLM()
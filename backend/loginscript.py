@@ -247,4 +247,11 @@ def getid_client(username:str):
         conn.commit()
         conn.close()
 
+def list_clients():
+    conn = sqlite3.connect(dbname)
+    try:
+        return [username for username, in conn.execute("select username from client order by username;")]
+    finally:
+        conn.close()
+
 # init_db()
\ No newline at end of file
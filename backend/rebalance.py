@@ -0,0 +1,220 @@
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import dbserver as db
+import router
+
+# Inter-warehouse rebalancing planner.
+# Demand over the horizon comes from forecast.py's forecasts, falling back to a trailing average of
+# daily sales for products with no forecast. For every SKU, warehouses holding more than their
+# projected demand are sources and warehouses short of it are sinks; the cheapest transfers
+# covering as much of the shortfall as possible are found as a transportation problem with
+# great-circle distance as the per-unit cost. SKUs are independent once destination space is shared
+# out, so their problems are solved in worker processes.
+#   python rebalance.py [preview|execute] [workers]
+
+HORIZON_DAYS = 7        # days of demand a warehouse should hold after rebalancing
+HISTORY_DAYS = 28       # days of daily_sales averaged for products with no forecast
+INLINE_MAX = 64         # SKU problems up to which solving in-process beats starting workers
+
+
+# Function to project demand per (product_id, warehouse_id) over the horizon from the daily_sales rollup
+def demand_from_sales(horizon_days=HORIZON_DAYS, history_days=HISTORY_DAYS, as_of=None):
+    as_of = db.ts_day(db.to_ts(as_of) if as_of is not None else db.now_ts())
+    start = db.ts_day(db.to_ts(as_of) - history_days * 86400)
+    rows = db.get_conn().execute("""
+    SELECT product_id, warehouse_id, SUM(sales) FROM daily_sales
+    WHERE sale_date > ? AND sale_date <= ?
+    GROUP BY product_id, warehouse_id
+    """, (start, as_of)).fetchall()
+    return {(p, w): sales * horizon_days / history_days for p, w, sales in rows}
+
+# Function to get demand per (product_id, warehouse_id) over the horizon from forecast.py's forecasts table.
+# A series whose forecast covers only part of the horizon is scaled up from the days it has.
+def demand_from_forecasts(horizon_days=HORIZON_DAYS, as_of=None):
+    first = db.to_ts(as_of) if as_of is not None else db.now_ts()
+    rows = db.get_conn().execute("""
+    SELECT product_id, warehouse_id, SUM(sales), COUNT(*) FROM forecasts
+    WHERE forecast_date >= ? AND forecast_date <= ?
+    GROUP BY product_id, warehouse_id
+    """, (db.ts_day(first), db.ts_day(first + (horizon_days - 1) * 86400))).fetchall()
+    return {(p, w): sales * horizon_days / days for p, w, sales, days in rows}
+
+# Function to project demand per (product_id, warehouse_id) over the horizon: the forecasts where a
+# product has them, the trailing daily_sales average for products with no forecast
+def projected_demand(horizon_days=HORIZON_DAYS, history_days=HISTORY_DAYS, as_of=None):
+    demand = demand_from_forecasts(horizon_days, as_of)
+    forecast_products = {p for p, _ in demand}
+    for (p, w), units in demand_from_sales(horizon_days, history_days, as_of).items():
+        if p not in forecast_products:
+            demand[(p, w)] = units
+    return demand
+
+
+# Function to solve one transportation problem by successive shortest paths.
+# cost is (sources x sinks) per-unit cost, supply and demand are integer unit counts.
+# Ships as many units as min(supply, demand) allows at minimum total cost; returns the flow matrix.
+def transport(cost, supply, demand):
+    n_src, n_dst = cost.shape
+    supply = np.asarray(supply, dtype=np.int64).copy()
+    demand = np.asarray(demand, dtype=np.int64).copy()
+    flow = np.zeros((n_src, n_dst), dtype=np.int64)
+    sinks = np.arange(n_dst)
+    sources = np.arange(n_src)
+    while supply.any() and demand.any():
+        # Label-correcting shortest paths over the residual graph: forward edges source -> sink at +cost,
+        # backward edges sink -> source at -cost wherever flow can be undone
+        # Predecessors only change on strict improvement, so ties can never close a loop
+        d_src = np.where(supply > 0, 0.0, np.inf)
+        d_dst = np.full(n_dst, np.inf)
+        pred_src = np.full(n_src, -1)       # sink a source was reached from, -1 for path starts
+        pred_dst = np.full(n_dst, -1)       # source a sink was reached from
+        for _ in range(n_src + n_dst + 1):
+            via = d_src[:, None] + cost
+            best_src = np.argmin(via, axis=0)
+            reach_dst = via[best_src, sinks]
+            improved = reach_dst < d_dst - 1e-9
+            d_dst = np.where(improved, reach_dst, d_dst)
+            pred_dst = np.where(improved, best_src, pred_dst)
+            back = np.where(flow > 0, d_dst[None, :] - cost, np.inf)
+            best_dst = np.argmin(back, axis=1)
+            reach_src = back[sources, best_dst]
+            better = reach_src < d_src - 1e-9
+            if not better.any() and not improved.any():
+                break
+            d_src = np.where(better, reach_src, d_src)
+            pred_src = np.where(better, best_dst, pred_src)
+
+        open_dst = np.where(demand > 0, d_dst, np.inf)
+        j = int(np.argmin(open_dst))
+        if open_dst[j] == np.inf:
+            break
+        # Walk back to the source the path starts from, collecting its edges
+        forward, backward = [], []
+        i = int(pred_dst[j])
+        forward.append((i, j))
+        for _ in range(n_src + n_dst):
+            if pred_src[i] < 0:
+                break
+            jb = int(pred_src[i])
+            backward.append((i, jb))
+            i = int(pred_dst[jb])
+            forward.append((i, jb))
+        amount = min(supply[i], demand[j], *(flow[e] for e in backward))
+        for e in forward:
+            flow[e] += amount
+        for e in backward:
+            flow[e] -= amount
+        supply[i] -= amount
+        demand[j] -= amount
+    return flow
+
+
+_distance = None        # warehouse x warehouse distances in km, set per worker process
+
+def _init_worker(distance):
+    global _distance
+    _distance = distance
+
+# Solve one SKU: (product_id, source columns, supply, sink columns, demand) -> [(product_id, source, sink, units)]
+def _solve(problem):
+    product_id, src, supply, dst, demand = problem
+    flow = transport(_distance[np.ix_(src, dst)], supply, demand)
+    i, j = np.nonzero(flow)
+    return [(product_id, int(src[a]), int(dst[b]), int(flow[a, b])) for a, b in zip(i.tolist(), j.tolist())]
+
+
+# Function to compute a rebalancing plan from current inventory, capacities and projected demand.
+# demand maps (product_id, warehouse_id) to units needed over the horizon; defaults to projected_demand().
+# Returns {"moves": [{product_id, source_warehouse_id, destination_warehouse_id, quantity, distance_km}], ...summary}
+def plan_rebalance(demand=None, workers=None):
+    started = time.perf_counter()
+    if demand is None:
+        demand = projected_demand()
+    conn = db.get_conn()
+    warehouses = conn.execute("""
+    SELECT w.warehouse_id, w.latitude, w.longitude, w.capacity - COALESCE(o.occupied, 0)
+    FROM warehouses w
+    LEFT JOIN warehouse_occupancy o ON o.warehouse_id = w.warehouse_id
+    WHERE w.latitude IS NOT NULL AND w.longitude IS NOT NULL
+    ORDER BY w.warehouse_id
+    """).fetchall()
+    warehouse_ids = [w[0] for w in warehouses]
+    col = {w: c for c, w in enumerate(warehouse_ids)}
+    free = np.array([max(w[3], 0) for w in warehouses], dtype=np.int64)
+    xyz = router.to_xyz([w[1] for w in warehouses], [w[2] for w in warehouses])
+    distance = router.chord_km(np.maximum(2.0 - 2.0 * (xyz @ xyz.T), 0.0)) if warehouses else np.zeros((0, 0))
+
+    products = sorted({p for p, w in demand if w in col})
+    row = {p: r for r, p in enumerate(products)}
+    stock = np.zeros((len(products), len(warehouse_ids)), dtype=np.int64)
+    need = np.zeros_like(stock)
+    for (p, w), units in demand.items():
+        if p in row and w in col:
+            need[row[p], col[w]] = math.ceil(units)
+    for p, w, quantity in conn.execute("SELECT product_id, warehouse_id, quantity FROM inventory"):
+        if p in row and w in col:
+            stock[row[p], col[w]] = quantity
+    surplus = np.maximum(stock - need, 0)
+    deficit = np.maximum(need - stock, 0)
+
+    # Share each warehouse's free space between the SKUs short there, in proportion to their shortfall,
+    # so the per-SKU solutions can never overfill a warehouse together
+    wanted = deficit.sum(axis=0)
+    scale = np.where(wanted > free, free / np.maximum(wanted, 1), 1.0)
+    deficit = np.floor(deficit * scale[None, :]).astype(np.int64)
+
+    problems = []
+    for r, p in enumerate(products):
+        src, dst = np.flatnonzero(surplus[r]), np.flatnonzero(deficit[r])
+        if len(src) and len(dst):
+            problems.append((p, src, surplus[r, src], dst, deficit[r, dst]))
+
+    workers = workers or os.cpu_count() or 1
+    pool = None
+    if workers > 1 and len(problems) > INLINE_MAX:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(distance,))
+        solved = pool.map(_solve, problems, chunksize=max(1, len(problems) // (workers * 8)))
+    else:
+        _init_worker(distance)
+        solved = map(_solve, problems)
+    moves = []
+    try:
+        for flows in solved:
+            moves.extend({"product_id": p, "source_warehouse_id": warehouse_ids[s], "destination_warehouse_id": warehouse_ids[d],
+                          "quantity": q, "distance_km": float(distance[s, d])} for p, s, d, q in flows)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    shortfall = int(np.maximum(need - stock, 0).sum())
+    moved = sum(m["quantity"] for m in moves)
+    return {"moves": moves, "skus": len(problems), "units": moved, "shortfall": shortfall,
+            "uncovered": shortfall - moved, "cost_km_units": sum(m["quantity"] * m["distance_km"] for m in moves),
+            "seconds": time.perf_counter() - started}
+
+
+# Function to execute a plan's moves as one batch of transfers (one commit, all or nothing)
+def execute_plan(moves):
+    return db.add_transfer_plan([(m["product_id"], m["source_warehouse_id"], m["destination_warehouse_id"], m["quantity"])
+                                 for m in moves])
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "preview"
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    db.migrate()
+    plan = plan_rebalance(workers=workers)
+    print(f"{len(plan['moves'])} moves, {plan['units']} units of {plan['shortfall']} short, "
+          f"{plan['cost_km_units']:,.0f} unit-km, planned in {plan['seconds']:.2f}s")
+    if command == "execute" and plan["moves"]:
+        print(execute_plan(plan["moves"]) or "Transfer plan failed")
+    elif command == "preview":
+        for m in plan["moves"]:
+            print(f"  product {m['product_id']}: {m['quantity']} from warehouse {m['source_warehouse_id']} "
+                  f"to {m['destination_warehouse_id']} ({m['distance_km']:.0f} km)")
@@ -0,0 +1,97 @@
+import sys
+import time
+from datetime import timedelta
+from statistics import NormalDist
+
+import numpy as np
+
+import dbserver as db
+import forecast
+
+# Safety stock and reorder points for every product x warehouse pair in inventory.
+# Daily demand over the last HISTORY_DAYS of the daily_sales rollup (days without sales count as
+# zero) gives each pair a mean and standard deviation, all pairs at once in NumPy. Over a
+# replenishment lead time of L days:
+#   safety_stock  = z * std * sqrt(L)            z from the target service level
+#   reorder_point = mean * L + safety_stock
+# Results replace the reorder_points table, and each reorder point is copied onto its inventory row,
+# where a partial index keeps the rows at or below it. Pairs with no demand get no reorder point.
+# Meant to run on a schedule, e.g. nightly from cron after the day's sales are in:
+#   python reorder.py [lead_time_days] [service_level]
+
+LEAD_TIME_DAYS = 7      # days between placing a replenishment order and the stock arriving
+SERVICE_LEVEL = 0.95    # probability of not running out during a lead time
+HISTORY_DAYS = 56       # days of daily sales the demand statistics are taken over
+
+
+# Function to get daily demand mean and standard deviation for the given (product_id << 32 | warehouse_id)
+# keys, sorted ascending, over history_days ending on `through`: (mean, std) arrays
+def demand_stats(keys, through, history_days=HISTORY_DAYS):
+    start = through - timedelta(days=history_days - 1)
+    rows = db.get_conn().execute("""
+    SELECT (product_id << 32) | warehouse_id, sales FROM daily_sales
+    WHERE sale_date >= ? AND sale_date <= ?
+    """, (start.isoformat(), through.isoformat())).fetchall()
+    total = np.zeros(len(keys))
+    squares = np.zeros(len(keys))
+    if rows and len(keys):
+        data = np.array(rows, dtype=np.int64)
+        pos = np.searchsorted(keys, data[:, 0])
+        hit = (pos < len(keys)) & (keys[np.minimum(pos, len(keys) - 1)] == data[:, 0])
+        sales = data[hit, 1].astype(float)
+        total = np.bincount(pos[hit], weights=sales, minlength=len(keys))
+        squares = np.bincount(pos[hit], weights=sales * sales, minlength=len(keys))
+    mean = total / history_days
+    variance = (squares - total * mean) / max(history_days - 1, 1)
+    return mean, np.sqrt(np.maximum(variance, 0.0))
+
+# Function to compute safety stock and reorder points from demand statistics: (safety_stock, reorder_point)
+# as whole units, rounded up
+def reorder_points(mean, std, lead_time_days=LEAD_TIME_DAYS, service_level=SERVICE_LEVEL):
+    z = NormalDist().inv_cdf(service_level)
+    safety_stock = np.ceil(z * std * np.sqrt(lead_time_days) - 1e-9)
+    reorder_point = np.ceil(mean * lead_time_days + z * std * np.sqrt(lead_time_days) - 1e-9)
+    return safety_stock.astype(np.int64), reorder_point.astype(np.int64)
+
+
+# Function to recompute every pair's reorder point and replace the reorder_points table.
+# Returns a summary with pair counts, how many are at or below their reorder point, and timings.
+def refresh(through=None, lead_time_days=LEAD_TIME_DAYS, service_level=SERVICE_LEVEL, history_days=HISTORY_DAYS):
+    started = time.perf_counter()
+    if lead_time_days <= 0 or not 0 < service_level < 1 or history_days < 2:
+        raise ValueError("lead_time_days must be positive, service_level between 0 and 1 and history_days at least 2")
+    through = through or forecast.last_complete_day()
+    keys = np.array([k for k, in db.get_conn().execute("SELECT (product_id << 32) | warehouse_id FROM inventory")],
+                    dtype=np.int64)
+    keys = np.unique(keys)
+    mean, std = demand_stats(keys, through, history_days)
+    safety_stock, reorder_point = reorder_points(mean, std, lead_time_days, service_level)
+    computed = time.perf_counter()
+    products, warehouses = (keys >> 32).tolist(), (keys & 0xFFFFFFFF).tolist()
+    active = np.flatnonzero(mean > 0)
+    with db.write_txn() as cursor:
+        cursor.execute("DELETE FROM reorder_points")
+        cursor.executemany("""
+        INSERT INTO reorder_points (product_id, warehouse_id, daily_demand, demand_std, lead_time_days,
+                                    safety_stock, reorder_point, computed_through)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, zip(products, warehouses, np.round(mean, 4).tolist(), np.round(std, 4).tolist(), [lead_time_days] * len(keys),
+                 safety_stock.tolist(), reorder_point.tolist(), [through.isoformat()] * len(keys)))
+        cursor.execute("UPDATE inventory SET reorder_point = NULL WHERE reorder_point IS NOT NULL")
+        cursor.executemany("UPDATE inventory SET reorder_point = ? WHERE product_id = ? AND warehouse_id = ?",
+                           zip(reorder_point[active].tolist(), (keys[active] >> 32).tolist(), (keys[active] & 0xFFFFFFFF).tolist()))
+        below = cursor.execute("SELECT COUNT(*) FROM inventory WHERE quantity <= reorder_point").fetchone()[0]
+    done = time.perf_counter()
+    return {"pairs": len(keys), "with_demand": len(active), "at_or_below": below, "through": through.isoformat(),
+            "lead_time_days": lead_time_days, "service_level": service_level,
+            "compute_seconds": computed - started, "write_seconds": done - computed}
+
+
+if __name__ == "__main__":
+    lead_time_days = float(sys.argv[1]) if len(sys.argv) > 1 else LEAD_TIME_DAYS
+    service_level = float(sys.argv[2]) if len(sys.argv) > 2 else SERVICE_LEVEL
+    db.migrate()
+    summary = refresh(lead_time_days=lead_time_days, service_level=service_level)
+    print(f"Reorder points for {summary['pairs']} pairs through {summary['through']} "
+          f"({summary['with_demand']} with demand, {summary['at_or_below']} at or below): "
+          f"compute {summary['compute_seconds']:.2f}s, write {summary['write_seconds']:.2f}s")
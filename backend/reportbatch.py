@@ -0,0 +1,195 @@
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import dbserver as db
+import llm
+import loginscript
+import reportcache
+import reportgen
+
+# Nightly pre-generation of every client's report, so the month-start rush on /api/v1/reportgen is
+# served from the report cache instead of queueing behind the LLM's rate limits.
+# Clients come from user.db. Each client's inputs are pulled from products.db and looked up in the
+# report cache, and only clients whose data, prompt or model changed are generated. An asyncio
+# pipeline runs it: PREPARE_WORKERS pull inputs and build prompts into a bounded queue, and
+# `concurrency` generators take prompts off it, each waiting on the rate limiter (requests and tokens
+# per minute) before its LLM call. A failed call is retried with exponential backoff and jitter; a
+# rate-limit rejection also holds back every other call for the retry-after the provider asked for.
+# Each finished client is checkpointed in the report_batch table under the run id (the date by
+# default), so rerunning an interrupted run skips the clients it finished and retries the failures.
+# Run it after midnight, e.g. from cron, so the reports cover the day they will be read on:
+#   python reportbatch.py [concurrency] [run_id]
+#   SPACIFY_LLM_RPM, SPACIFY_LLM_TPM    the account's requests and tokens per minute (default 30 and 30000)
+
+CONCURRENCY = 8         # LLM calls in flight
+PREPARE_WORKERS = 2     # clients having their inputs pulled and prompts built at once
+RETRIES = 5             # retries of a failed LLM call before the client is marked failed
+BACKOFF = 1.0           # seconds before the first retry, doubling with each one
+MAX_BACKOFF = 60.0
+LLM_RPM = float(os.environ.get("SPACIFY_LLM_RPM", 30))
+LLM_TPM = float(os.environ.get("SPACIFY_LLM_TPM", 30000))
+
+GENERATED = "generated"
+CACHED = "cached"
+FAILED = "failed"
+
+
+# Paces LLM calls to the account's limits: each call books its share of a minute of requests and of
+# tokens, and waits until both are free. Thread-safe, so prompt building and the pipeline share one.
+class RateLimiter:
+    def __init__(self, rpm=LLM_RPM, tpm=LLM_TPM):
+        self.request_interval = 60 / rpm if rpm else 0.0
+        self.token_interval = 60 / tpm if tpm else 0.0
+        self.lock = threading.Lock()
+        self.next_request = self.next_token = 0.0
+        self.retries = self.rate_limited = 0
+
+    # Function to book a call of `tokens` tokens; returns the seconds to wait before making it
+    def reserve(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request, self.next_token)
+            self.next_request = start + self.request_interval
+            self.next_token = start + tokens * self.token_interval
+            return start - now
+
+    # Function to get the seconds to back off after a failed call (attempt counts from 1).
+    # A rate-limit rejection pauses every call for at least the retry-after.
+    def failed(self, attempt, error):
+        delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1)))
+        with self.lock:
+            self.retries += 1
+            if isinstance(error, llm.RateLimitError):
+                self.rate_limited += 1
+                delay = max(delay, error.retry_after or BACKOFF)
+                self.next_request = max(self.next_request, time.monotonic() + delay)
+        return delay
+
+
+# LLM client for the calls reportgen makes while building a prompt (map-reduce sections), held to
+# the same limiter and retries as the pipeline's own calls
+class ThrottledLLM:
+    def __init__(self, inner, limiter, retries=RETRIES):
+        self.inner = inner
+        self.limiter = limiter
+        self.retries = retries
+
+    def complete(self, system, message, model, max_tokens):
+        tokens = reportgen.count_tokens(system + message) + max_tokens
+        for attempt in range(1, self.retries + 2):
+            time.sleep(self.limiter.reserve(tokens))
+            try:
+                return self.inner.complete(system, message, model, max_tokens)
+            except Exception as e:
+                if attempt > self.retries:
+                    raise
+                time.sleep(self.limiter.failed(attempt, e))
+
+    def stream(self, system, message, model, max_tokens):
+        time.sleep(self.limiter.reserve(reportgen.count_tokens(system + message) + max_tokens))
+        yield from self.inner.stream(system, message, model, max_tokens)
+
+
+def _checkpoint(run_id, client_id, status, attempts, error, seconds):
+    with db.write_txn() as cursor:
+        cursor.execute("""
+        INSERT OR REPLACE INTO report_batch (run_id, client_id, status, attempts, error, seconds, finished_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (run_id, client_id, status, attempts, error, seconds, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+async def _pipeline(clients, run_id, concurrency, limiter, model_client, summary):
+    section_client = ThrottledLLM(model_client, limiter)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(PREPARE_WORKERS + concurrency, thread_name_prefix="batch"))
+    todo = asyncio.Queue()
+    for client_id in clients:
+        todo.put_nowait(client_id)
+    prompts = asyncio.Queue(concurrency)
+
+    async def finish(client_id, status, attempts, error, started):
+        await asyncio.to_thread(_checkpoint, run_id, client_id, status, attempts, error, time.perf_counter() - started)
+        summary[status] += 1
+        if error is not None:
+            print(f"Report for {client_id} failed: {error}")
+
+    async def prepare():
+        while not todo.empty():
+            client_id = todo.get_nowait()
+            started = time.perf_counter()
+            try:
+                report, key, inputs = await asyncio.to_thread(reportgen.cached_report, client_id)
+                if report is not None:
+                    await finish(client_id, CACHED, 0, None, started)
+                    continue
+                message, _ = await asyncio.to_thread(reportgen.final_prompt, inputs, reportgen.SPLIT_BY, section_client)
+            except Exception as e:
+                await finish(client_id, FAILED, 0, f"{type(e).__name__}: {e}", started)
+                continue
+            await prompts.put((client_id, key, message, started))
+
+    async def generate():
+        while (item := await prompts.get()) is not None:
+            client_id, key, message, started = item
+            tokens = reportgen.count_tokens(reportgen.SYSTEM_PROMPT + message) + reportgen.MAX_TOKENS
+            for attempt in range(1, RETRIES + 2):
+                await asyncio.sleep(limiter.reserve(tokens))
+                try:
+                    report = await asyncio.to_thread(model_client.complete, reportgen.SYSTEM_PROMPT, message,
+                                                     reportgen.MODEL, reportgen.MAX_TOKENS)
+                except Exception as e:
+                    if attempt > RETRIES:
+                        await finish(client_id, FAILED, attempt, f"{type(e).__name__}: {e}", started)
+                        break
+                    await asyncio.sleep(limiter.failed(attempt, e))
+                    continue
+                try:
+                    await asyncio.to_thread(reportcache.cache.put, key, client_id, report)
+                except Exception as e:
+                    await finish(client_id, FAILED, attempt, f"{type(e).__name__}: {e}", started)
+                    break
+                await finish(client_id, GENERATED, attempt, None, started)
+                break
+
+    generators = [asyncio.create_task(generate()) for _ in range(concurrency)]
+    await asyncio.gather(*(prepare() for _ in range(PREPARE_WORKERS)))
+    for _ in generators:
+        await prompts.put(None)
+    await asyncio.gather(*generators)
+
+
+# Function to pre-generate the reports of the given clients (default: every client in user.db).
+# Clients already finished under run_id are skipped. Every LLM call goes to model_client (default
+# llm.client) through the limiter; llm.client itself is left alone for in-process report requests.
+# Returns a summary with counts and throughput.
+def run(clients=None, run_id=None, concurrency=CONCURRENCY, limiter=None, model_client=None):
+    started = time.perf_counter()
+    run_id = run_id or date.today().isoformat()
+    clients = loginscript.list_clients() if clients is None else clients
+    limiter = limiter or RateLimiter()
+    done = {c for c, in db.get_conn().execute(
+        "SELECT client_id FROM report_batch WHERE run_id = ? AND status != ?", (run_id, FAILED))}
+    pending = [c for c in clients if c not in done]
+    summary = {GENERATED: 0, CACHED: 0, FAILED: 0}
+    asyncio.run(_pipeline(pending, run_id, concurrency, limiter, model_client or llm.client, summary))
+    seconds = time.perf_counter() - started
+    return {"run_id": run_id, "clients": len(clients), "skipped": len(clients) - len(pending), **summary,
+            "retries": limiter.retries, "rate_limited": limiter.rate_limited, "seconds": seconds,
+            "clients_per_minute": len(pending) / seconds * 60 if seconds else None}
+
+
+if __name__ == "__main__":
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else CONCURRENCY
+    run_id = sys.argv[2] if len(sys.argv) > 2 else None
+    db.migrate()
+    summary = run(run_id=run_id, concurrency=concurrency)
+    print(f"Report batch {summary['run_id']}: {summary['clients']} clients, {summary['skipped']} already done, "
+          f"{summary['generated']} generated, {summary['cached']} unchanged, {summary['failed']} failed "
+          f"({summary['retries']} retries, {summary['rate_limited']} rate limited) in {summary['seconds']:.1f}s, "
+          f"{summary['clients_per_minute']:.1f} clients/min")
+    db.close_all()
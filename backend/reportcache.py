@@ -0,0 +1,187 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import dbserver as db
+
+# Cache of generated reports for /api/v1/reportgen.
+# A report is keyed by (client, hash of its input data, prompt version, model), so it is reused
+# until the client's data, the prompt or the model changes. Recently used reports are held in an
+# in-memory LRU; every report is also written to the report_cache table of a SQLite file of its own
+# next to products.db (products_reports.db), so cache reads and writes never take products.db's
+# write lock. That table survives restarts and is trimmed least recently used first once its
+# reports pass DISK_BYTES.
+
+MEMORY_ENTRIES = 256            # reports held in memory
+DISK_BYTES = 64 * 1024 * 1024   # report text kept in the report_cache table before evicting
+
+# Function to get the cache database path for the current products database
+def cache_path():
+    return os.path.splitext(db.proddb)[0] + "_reports.db"
+
+# Open a connection to the cache database, creating the table on first use
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=db.DB_TIMEOUT, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS report_cache (
+        cache_key TEXT PRIMARY KEY,
+        client_id TEXT NOT NULL,
+        report TEXT NOT NULL,
+        bytes INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        last_used INTEGER NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_report_cache_last_used ON report_cache(last_used)")
+    # Running total of the report bytes stored, kept in the same transactions as the reports themselves
+    # so every process writing this file sees it; seeded from the table the first time
+    conn.execute("CREATE TABLE IF NOT EXISTS report_cache_size (bytes INTEGER NOT NULL)")
+    conn.execute("""
+    INSERT INTO report_cache_size (bytes) SELECT COALESCE(SUM(bytes), 0) FROM report_cache
+    WHERE NOT EXISTS (SELECT 1 FROM report_cache_size)
+    """)
+    return conn
+
+# Return the calling thread's connection to the cache database, from dbserver's connection pool
+def _conn():
+    return db.pooled_conn(cache_path(), _connect)
+
+
+# Function to build the cache key for a report
+def report_key(client_id, input_hash, prompt_version, model):
+    return f"{client_id}|{input_hash}|{prompt_version}|{model}"
+
+# Function to hash report input arrays and values in a stable order
+def input_hash(inputs):
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(inputs):
+        value = inputs[name]
+        digest.update(name.encode())
+        if hasattr(value, "tobytes"):
+            # Same bytes in another dtype or shape are different inputs
+            digest.update(f"{value.dtype.str}{value.shape}".encode())
+            digest.update(value.tobytes())
+        else:
+            digest.update(str(value).encode())
+    return digest.hexdigest()
+
+
+class ReportCache:
+    def __init__(self, memory_entries=MEMORY_ENTRIES, disk_bytes=DISK_BYTES):
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.path = None
+        self.memory = OrderedDict()     # cache_key -> report, least recently used first
+        self.hits = self.memory_hits = self.disk_hits = self.misses = self.evictions = 0
+
+    # The in-memory entries belong to one database; switching databases drops them
+    def _fresh(self):
+        if self.path != db.proddb:
+            self.memory.clear()
+            self.path = db.proddb
+
+    def _remember(self, key, report):
+        self.memory[key] = report
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    # Function to get a cached report, or None on a miss
+    def get(self, key):
+        with self.lock:
+            self._fresh()
+            report = self.memory.get(key)
+            if report is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return report
+        conn = _conn()
+        row = conn.execute("SELECT report FROM report_cache WHERE cache_key = ?", (key,)).fetchone()
+        if row is not None:
+            # Best effort: a busy cache database only costs this report some recency
+            try:
+                conn.execute("UPDATE report_cache SET last_used = ? WHERE cache_key = ?", (time.time_ns(), key))
+            except sqlite3.OperationalError:
+                pass
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, row[0])
+            return row[0]
+
+    # Function to store a report, evicting the least recently used ones past disk_bytes
+    def put(self, key, client_id, report):
+        size = len(report.encode())
+        conn = _conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.cursor()
+            replaced = cursor.execute("SELECT bytes FROM report_cache WHERE cache_key = ?", (key,)).fetchone()
+            cursor.execute("""
+            INSERT OR REPLACE INTO report_cache (cache_key, client_id, report, bytes, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, (key, client_id, report, size, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), time.time_ns()))
+            # fetchall, not fetchone: a RETURNING statement is only finished once its rows are read to the end
+            total = cursor.execute("UPDATE report_cache_size SET bytes = bytes + ? RETURNING bytes",
+                                   (size - (replaced[0] if replaced else 0),)).fetchall()[0][0]
+            evicted = []
+            if total > self.disk_bytes:
+                # Oldest first until back under the limit; the report just written is the newest
+                freed = 0
+                oldest = conn.execute("SELECT cache_key, bytes FROM report_cache ORDER BY last_used")
+                for old_key, old_size in oldest:
+                    if total - freed <= self.disk_bytes or old_key == key:
+                        break
+                    evicted.append(old_key)
+                    freed += old_size
+                oldest.close()
+                cursor.executemany("DELETE FROM report_cache WHERE cache_key = ?", [(k,) for k in evicted])
+                cursor.execute("UPDATE report_cache_size SET bytes = bytes - ?", (freed,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        with self.lock:
+            self._fresh()
+            for old_key in evicted:
+                self.memory.pop(old_key, None)
+            self.evictions += len(evicted)
+            self._remember(key, report)
+
+    # Function to drop every cached report, in memory and on disk
+    def clear(self):
+        conn = _conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM report_cache")
+            conn.execute("UPDATE report_cache_size SET bytes = 0")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        with self.lock:
+            self.memory.clear()
+
+    # Function to get hit and miss counts and the cache's size
+    def stats(self):
+        row = _conn().execute("SELECT (SELECT COUNT(*) FROM report_cache), bytes FROM report_cache_size").fetchone()
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else None,
+                    "evictions": self.evictions, "memory_entries": len(self.memory),
+                    "disk_entries": row[0], "disk_bytes": row[1], "disk_limit_bytes": self.disk_bytes}
+
+
+cache = ReportCache()
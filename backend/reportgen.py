@@ -1,522 +1,178 @@
 # import os
-from groq import Groq
-
-f = open('apikey.txt','r')
-key = f.read()
-# print(key)
-
-past_month_sales_data = """
-2023-09-01,1,1,146
-2023-09-01,1,2,88
-2023-09-01,1,3,116
-2023-09-01,1,4,248
-2023-09-01,2,1,220
-2023-09-01,2,2,224
-2023-09-01,2,3,197
-2023-09-01,2,4,190
-2023-09-02,1,1,183
-2023-09-02,1,2,266
-2023-09-02,1,3,116
-2023-09-02,1,4,185
-2023-09-02,2,1,192
-2023-09-02,2,2,158
-2023-09-02,2,3,246
-2023-09-02,2,4,238
-2023-09-03,1,1,100
-2023-09-03,1,2,174
-2023-09-03,1,3,120
-2023-09-03,1,4,296
-2023-09-03,2,1,278
-2023-09-03,2,2,55
-2023-09-03,2,3,209
-2023-09-03,2,4,296
-2023-09-04,1,1,51
-2023-09-04,1,2,205
-2023-09-04,1,3,88
-2023-09-04,1,4,113
-2023-09-04,2,1,64
-2023-09-04,2,2,107
-2023-09-04,2,3,184
-2023-09-04,2,4,53
-2023-09-05,1,1,191
-2023-09-05,1,2,282
-2023-09-05,1,3,288
-2023-09-05,1,4,293
-2023-09-05,2,1,201
-2023-09-05,2,2,179
-2023-09-05,2,3,293
-2023-09-05,2,4,247
-2023-09-06,1,1,136
-2023-09-06,1,2,138
-2023-09-06,1,3,197
-2023-09-06,1,4,74
-2023-09-06,2,1,245
-2023-09-06,2,2,179
-2023-09-06,2,3,279
-2023-09-06,2,4,287
-2023-09-07,1,1,167
-2023-09-07,1,2,58
-2023-09-07,1,3,251
-2023-09-07,1,4,206
-2023-09-07,2,1,145
-2023-09-07,2,2,106
-2023-09-07,2,3,156
-2023-09-07,2,4,136
-2023-09-08,1,1,66
-2023-09-08,1,2,135
-2023-09-08,1,3,230
-2023-09-08,1,4,112
-2023-09-08,2,1,181
-2023-09-08,2,2,152
-2023-09-08,2,3,238
-2023-09-08,2,4,137
-2023-09-09,1,1,110
-2023-09-09,1,2,134
-2023-09-09,1,3,252
-2023-09-09,1,4,151
-2023-09-09,2,1,128
-2023-09-09,2,2,55
-2023-09-09,2,3,217
-2023-09-09,2,4,65
-2023-09-10,1,1,278
-2023-09-10,1,2,170
-2023-09-10,1,3,253
-2023-09-10,1,4,132
-2023-09-10,2,1,69
-2023-09-10,2,2,181
-2023-09-10,2,3,248
-2023-09-10,2,4,268
-2023-09-11,1,1,208
-2023-09-11,1,2,217
-2023-09-11,1,3,202
-2023-09-11,1,4,53
-2023-09-11,2,1,201
-2023-09-11,2,2,252
-2023-09-11,2,3,186
-2023-09-11,2,4,262
-2023-09-12,1,1,190
-2023-09-12,1,2,166
-2023-09-12,1,3,217
-2023-09-12,1,4,137
-2023-09-12,2,1,238
-2023-09-12,2,2,130
-2023-09-12,2,3,268
-2023-09-12,2,4,167
-2023-09-13,1,1,71
-2023-09-13,1,2,67
-2023-09-13,1,3,296
-2023-09-13,1,4,250
-2023-09-13,2,1,166
-2023-09-13,2,2,291
-2023-09-13,2,3,263
-2023-09-13,2,4,112
-2023-09-14,1,1,263
-2023-09-14,1,2,140
-2023-09-14,1,3,265
-2023-09-14,1,4,297
-2023-09-14,2,1,75
-2023-09-14,2,2,297
-2023-09-14,2,3,205
-2023-09-14,2,4,245
-2023-09-15,1,1,178
-2023-09-15,1,2,168
-2023-09-15,1,3,159
-2023-09-15,1,4,116
-2023-09-15,2,1,246
-2023-09-15,2,2,139
-2023-09-15,2,3,128
-2023-09-15,2,4,122
-2023-09-16,1,1,182
-2023-09-16,1,2,72
-2023-09-16,1,3,286
-2023-09-16,1,4,69
-2023-09-16,2,1,167
-2023-09-16,2,2,275
-2023-09-16,2,3,209
-2023-09-16,2,4,219
-2023-09-17,1,1,70
-2023-09-17,1,2,171
-2023-09-17,1,3,298
-2023-09-17,1,4,206
-2023-09-17,2,1,232
-2023-09-17,2,2,233
-2023-09-17,2,3,73
-2023-09-17,2,4,58
-2023-09-18,1,1,233
-2023-09-18,1,2,74
-2023-09-18,1,3,207
-2023-09-18,1,4,279
-2023-09-18,2,1,148
-2023-09-18,2,2,252
-2023-09-18,2,3,56
-2023-09-18,2,4,298
-2023-09-19,1,1,76
-2023-09-19,1,2,128
-2023-09-19,1,3,53
-2023-09-19,1,4,115
-2023-09-19,2,1,198
-2023-09-19,2,2,289
-2023-09-19,2,3,156
-2023-09-19,2,4,80
-2023-09-20,1,1,257
-2023-09-20,1,2,95
-2023-09-20,1,3,127
-2023-09-20,1,4,59
-2023-09-20,2,1,223
-2023-09-20,2,2,261
-2023-09-20,2,3,283
-2023-09-20,2,4,179
-2023-09-21,1,1,129
-2023-09-21,1,2,210
-2023-09-21,1,3,180
-2023-09-21,1,4,136
-2023-09-21,2,1,92
-2023-09-21,2,2,271
-2023-09-21,2,3,125
-2023-09-21,2,4,224
-2023-09-22,1,1,258
-2023-09-22,1,2,99
-2023-09-22,1,3,105
-2023-09-22,1,4,79
-2023-09-22,2,1,269
-2023-09-22,2,2,146
-2023-09-22,2,3,156
-2023-09-22,2,4,285
-2023-09-23,1,1,221
-2023-09-23,1,2,115
-2023-09-23,1,3,266
-2023-09-23,1,4,88
-2023-09-23,2,1,97
-2023-09-23,2,2,133
-2023-09-23,2,3,87
-2023-09-23,2,4,53
-2023-09-24,1,1,172
-2023-09-24,1,2,70
-2023-09-24,1,3,203
-2023-09-24,1,4,214
-2023-09-24,2,1,96
-2023-09-24,2,2,300
-2023-09-24,2,3,81
-2023-09-24,2,4,253
-2023-09-25,1,1,208
-2023-09-25,1,2,92
-2023-09-25,1,3,113
-2023-09-25,1,4,113
-2023-09-25,2,1,149
-2023-09-25,2,2,78
-2023-09-25,2,3,253
-2023-09-25,2,4,161
-2023-09-26,1,1,52
-2023-09-26,1,2,179
-2023-09-26,1,3,65
-2023-09-26,1,4,242
-2023-09-26,2,1,71
-2023-09-26,2,2,185
-2023-09-26,2,3,167
-2023-09-26,2,4,240
-2023-09-27,1,1,99
-2023-09-27,1,2,232
-2023-09-27,1,3,226
-2023-09-27,1,4,95
-2023-09-27,2,1,114
-2023-09-27,2,2,283
-2023-09-27,2,3,282
-2023-09-27,2,4,87
-2023-09-28,1,1,196
-2023-09-28,1,2,219
-2023-09-28,1,3,165
-2023-09-28,1,4,271
-2023-09-28,2,1,90
-2023-09-28,2,2,289
-2023-09-28,2,3,78
-2023-09-28,2,4,293
-2023-09-29,1,1,291
-2023-09-29,1,2,275
-2023-09-29,1,3,125
-2023-09-29,1,4,79
-2023-09-29,2,1,86
-2023-09-29,2,2,81
-2023-09-29,2,3,103
-2023-09-29,2,4,260
-2023-09-30,1,1,241
-2023-09-30,1,2,215
-2023-09-30,1,3,282
-2023-09-30,1,4,134
-2023-09-30,2,1,80
-2023-09-30,2,2,71
-2023-09-30,2,3,70
-2023-09-30,2,4,223"""
-
-forecasted_sales_data = """
-2023-10-01,1,1,150
-2023-10-01,1,2,183
-2023-10-01,1,3,298
-2023-10-01,1,4,227
-2023-10-01,2,1,93
-2023-10-01,2,2,267
-2023-10-01,2,3,239
-2023-10-01,2,4,190
-2023-10-02,1,1,285
-2023-10-02,1,2,254
-2023-10-02,1,3,121
-2023-10-02,1,4,84
-2023-10-02,2,1,102
-2023-10-02,2,2,172
-2023-10-02,2,3,232
-2023-10-02,2,4,159
-2023-10-03,1,1,300
-2023-10-03,1,2,158
-2023-10-03,1,3,64
-2023-10-03,1,4,167
-2023-10-03,2,1,100
-2023-10-03,2,2,69
-2023-10-03,2,3,279
-2023-10-03,2,4,269
-2023-10-04,1,1,297
-2023-10-04,1,2,52
-2023-10-04,1,3,285
-2023-10-04,1,4,157
-2023-10-04,2,1,147
-2023-10-04,2,2,105
-2023-10-04,2,3,63
-2023-10-04,2,4,268
-2023-10-05,1,1,276
-2023-10-05,1,2,84
-2023-10-05,1,3,271
-2023-10-05,1,4,95
-2023-10-05,2,1,243
-2023-10-05,2,2,143
-2023-10-05,2,3,236
-2023-10-05,2,4,284
-2023-10-06,1,1,296
-2023-10-06,1,2,74
-2023-10-06,1,3,179
-2023-10-06,1,4,174
-2023-10-06,2,1,291
-2023-10-06,2,2,126
-2023-10-06,2,3,173
-2023-10-06,2,4,78
-2023-10-07,1,1,269
-2023-10-07,1,2,265
-2023-10-07,1,3,188
-2023-10-07,1,4,80
-2023-10-07,2,1,97
-2023-10-07,2,2,246
-2023-10-07,2,3,97
-2023-10-07,2,4,145
-2023-10-08,1,1,157
-2023-10-08,1,2,237
-2023-10-08,1,3,115
-2023-10-08,1,4,67
-2023-10-08,2,1,102
-2023-10-08,2,2,218
-2023-10-08,2,3,112
-2023-10-08,2,4,90
-2023-10-09,1,1,105
-2023-10-09,1,2,234
-2023-10-09,1,3,157
-2023-10-09,1,4,180
-2023-10-09,2,1,298
-2023-10-09,2,2,196
-2023-10-09,2,3,155
-2023-10-09,2,4,92
-2023-10-10,1,1,99
-2023-10-10,1,2,196
-2023-10-10,1,3,126
-2023-10-10,1,4,159
-2023-10-10,2,1,130
-2023-10-10,2,2,116
-2023-10-10,2,3,148
-2023-10-10,2,4,279
-2023-10-11,1,1,194
-2023-10-11,1,2,182
-2023-10-11,1,3,52
-2023-10-11,1,4,192
-2023-10-11,2,1,141
-2023-10-11,2,2,190
-2023-10-11,2,3,276
-2023-10-11,2,4,65
-2023-10-12,1,1,176
-2023-10-12,1,2,166
-2023-10-12,1,3,240
-2023-10-12,1,4,205
-2023-10-12,2,1,222
-2023-10-12,2,2,170
-2023-10-12,2,3,222
-2023-10-12,2,4,258
-2023-10-13,1,1,241
-2023-10-13,1,2,108
-2023-10-13,1,3,118
-2023-10-13,1,4,126
-2023-10-13,2,1,190
-2023-10-13,2,2,110
-2023-10-13,2,3,100
-2023-10-13,2,4,240
-2023-10-14,1,1,266
-2023-10-14,1,2,139
-2023-10-14,1,3,255
-2023-10-14,1,4,286
-2023-10-14,2,1,93
-2023-10-14,2,2,213
-2023-10-14,2,3,107
-2023-10-14,2,4,281
-2023-10-15,1,1,210
-2023-10-15,1,2,163
-2023-10-15,1,3,107
-2023-10-15,1,4,205
-2023-10-15,2,1,211
-2023-10-15,2,2,81
-2023-10-15,2,3,123
-2023-10-15,2,4,153
-2023-10-16,1,1,197
-2023-10-16,1,2,72
-2023-10-16,1,3,67
-2023-10-16,1,4,65
-2023-10-16,2,1,57
-2023-10-16,2,2,63
-2023-10-16,2,3,110
-2023-10-16,2,4,127
-2023-10-17,1,1,115
-2023-10-17,1,2,238
-2023-10-17,1,3,62
-2023-10-17,1,4,213
-2023-10-17,2,1,103
-2023-10-17,2,2,276
-2023-10-17,2,3,92
-2023-10-17,2,4,89
-2023-10-18,1,1,134
-2023-10-18,1,2,164
-2023-10-18,1,3,297
-2023-10-18,1,4,234
-2023-10-18,2,1,292
-2023-10-18,2,2,84
-2023-10-18,2,3,258
-2023-10-18,2,4,163
-2023-10-19,1,1,238
-2023-10-19,1,2,282
-2023-10-19,1,3,162
-2023-10-19,1,4,95
-2023-10-19,2,1,272
-2023-10-19,2,2,292
-2023-10-19,2,3,150
-2023-10-19,2,4,220
-2023-10-20,1,1,257
-2023-10-20,1,2,185
-2023-10-20,1,3,154
-2023-10-20,1,4,137
-2023-10-20,2,1,154
-2023-10-20,2,2,114
-2023-10-20,2,3,266
-2023-10-20,2,4,284
-2023-10-21,1,1,278
-2023-10-21,1,2,112
-2023-10-21,1,3,240
-2023-10-21,1,4,88
-2023-10-21,2,1,101
-2023-10-21,2,2,62
-2023-10-21,2,3,146
-2023-10-21,2,4,252
-2023-10-22,1,1,241
-2023-10-22,1,2,281
-2023-10-22,1,3,211
-2023-10-22,1,4,287
-2023-10-22,2,1,240
-2023-10-22,2,2,106
-2023-10-22,2,3,272
-2023-10-22,2,4,137
-2023-10-23,1,1,231
-2023-10-23,1,2,250
-2023-10-23,1,3,91
-2023-10-23,1,4,64
-2023-10-23,2,1,62
-2023-10-23,2,2,64
-2023-10-23,2,3,244
-2023-10-23,2,4,267
-2023-10-24,1,1,74
-2023-10-24,1,2,175
-2023-10-24,1,3,82
-2023-10-24,1,4,58
-2023-10-24,2,1,104
-2023-10-24,2,2,269
-2023-10-24,2,3,53
-2023-10-24,2,4,285
-2023-10-25,1,1,249
-2023-10-25,1,2,175
-2023-10-25,1,3,65
-2023-10-25,1,4,67
-2023-10-25,2,1,257
-2023-10-25,2,2,120
-2023-10-25,2,3,213
-2023-10-25,2,4,239
-2023-10-26,1,1,136
-2023-10-26,1,2,88
-2023-10-26,1,3,93
-2023-10-26,1,4,101
-2023-10-26,2,1,85
-2023-10-26,2,2,188
-2023-10-26,2,3,148
-2023-10-26,2,4,69
-2023-10-27,1,1,188
-2023-10-27,1,2,287
-2023-10-27,1,3,143
-2023-10-27,1,4,149
-2023-10-27,2,1,106
-2023-10-27,2,2,186
-2023-10-27,2,3,65
-2023-10-27,2,4,207
-2023-10-28,1,1,216
-2023-10-28,1,2,272
-2023-10-28,1,3,113
-2023-10-28,1,4,218
-2023-10-28,2,1,159
-2023-10-28,2,2,112
-2023-10-28,2,3,268
-2023-10-28,2,4,128
-2023-10-29,1,1,258
-2023-10-29,1,2,211
-2023-10-29,1,3,118
-2023-10-29,1,4,89
-2023-10-29,2,1,173
-2023-10-29,2,2,196
-2023-10-29,2,3,116
-2023-10-29,2,4,194
-2023-10-30,1,1,148
-2023-10-30,1,2,214
-2023-10-30,1,3,144
-2023-10-30,1,4,194
-2023-10-30,2,1,87
-2023-10-30,2,2,186
-2023-10-30,2,3,171
-2023-10-30,2,4,238"""
-
-monthly_stock = """1,1,5000
-1,2,6000
-1,3,2000
-1,4,4000
-2,1,5000
-2,2,2000
-2,3,1000
-2,4,10000"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import dbserver as db
+import llm
+import reportcache
+
+REPORT_DAYS = 30        # days of past sales and of forecast sales a report covers
+
+
+# Parse one group_concat column of numbers from every row into a single array, in row order
+def _concat_numbers(rows, column):
+    return np.array(",".join(r[column] for r in rows).split(","), dtype=np.float64)
+
+# Day offsets within the report window come back one character per day, char(48 + offset), so they
+# are decoded straight from the bytes instead of parsed as numbers (ASCII while REPORT_DAYS < 80)
+def _concat_days(rows, column):
+    return np.frombuffer("".join(r[column] for r in rows).encode(), dtype=np.uint8) - 48
+
+# Function to pull a client's report inputs from products.db, one aggregated query per input:
+# daily sales over the last REPORT_DAYS complete days, forecast daily sales for the next REPORT_DAYS
+# (read from the forecast cache; reports never refit) and current stock, per warehouse and product.
+# client_id is the email/username stored in products.client_id. Each query returns one row per
+# series with its days packed by group_concat, so only a row per series crosses into Python.
+# group_concat has no guaranteed order, so every value comes with its day offset, concatenated
+# from the same rows in the same pass, and is placed by that offset rather than by position.
+# Returns {"products", "warehouses": series ids, "sales_from": date, "sales": (series x REPORT_DAYS),
+#          "forecast_from": date, "forecasts": (series x REPORT_DAYS), "stock": units per series,
+#          "categories": category names, "category": index into them per series}
+def report_inputs(client_id, as_of=None):
+    today = db.to_ts(as_of) if as_of is not None else db.now_ts()
+    sales_from = db.ts_day(today - REPORT_DAYS * 86400)
+    sales_to = db.ts_day(today - 86400)
+    forecast_from = db.ts_day(today)
+    forecast_to = db.ts_day(today + (REPORT_DAYS - 1) * 86400)
+    conn = db.get_conn()
+    sales = conn.execute("""
+    SELECT (p.product_id << 32) | d.warehouse_id, COUNT(*),
+           group_concat(char(48 + CAST(julianday(d.sale_date) - julianday(?) AS INTEGER)), ''), group_concat(d.sales)
+    FROM products p
+    JOIN daily_sales d ON d.product_id = p.product_id
+    WHERE p.client_id = ? AND d.sale_date >= ? AND d.sale_date <= ?
+    GROUP BY p.product_id, d.warehouse_id
+    """, (sales_from, client_id, sales_from, sales_to)).fetchall()
+    forecasts = conn.execute("""
+    SELECT (p.product_id << 32) | f.warehouse_id, COUNT(*),
+           group_concat(char(48 + CAST(julianday(f.forecast_date) - julianday(?) AS INTEGER)), ''), group_concat(f.sales)
+    FROM products p
+    JOIN forecasts f ON f.product_id = p.product_id
+    WHERE p.client_id = ? AND f.forecast_date >= ? AND f.forecast_date <= ?
+    GROUP BY p.product_id, f.warehouse_id
+    """, (forecast_from, client_id, forecast_from, forecast_to)).fetchall()
+    stock = conn.execute("""
+    SELECT (p.product_id << 32) | i.warehouse_id, i.quantity
+    FROM products p
+    JOIN inventory i ON i.product_id = p.product_id
+    WHERE p.client_id = ?
+    """, (client_id,)).fetchall()
+
+    keys = np.unique(np.array([r[0] for rows in (sales, forecasts, stock) for r in rows], dtype=np.int64))
+    inputs = {"products": keys >> 32, "warehouses": keys & 0xFFFFFFFF,
+              "sales_from": sales_from, "sales": np.zeros((len(keys), REPORT_DAYS)),
+              "forecast_from": forecast_from, "forecasts": np.zeros((len(keys), REPORT_DAYS)),
+              "stock": np.zeros(len(keys), dtype=np.int64)}
+    if sales:
+        counts = np.array([r[1] for r in sales])
+        rows = np.repeat(np.searchsorted(keys, [r[0] for r in sales]), counts)
+        days = _concat_days(sales, 2)
+        inputs["sales"][rows, days] = _concat_numbers(sales, 3)
+    if forecasts:
+        counts = np.array([r[1] for r in forecasts])
+        rows = np.repeat(np.searchsorted(keys, [r[0] for r in forecasts]), counts)
+        days = _concat_days(forecasts, 2)
+        inputs["forecasts"][rows, days] = _concat_numbers(forecasts, 3)
+    if stock:
+        inputs["stock"][np.searchsorted(keys, [r[0] for r in stock])] = [r[1] for r in stock]
+    # Product category of each series, as an index into the sorted category names
+    products = conn.execute("SELECT product_id, COALESCE(category, '') FROM products WHERE client_id = ? ORDER BY product_id",
+                            (client_id,)).fetchall()
+    inputs["categories"], codes = np.unique([c for _, c in products] or [""], return_inverse=True)
+    inputs["categories"] = inputs["categories"].tolist()
+    ids = np.array([p for p, _ in products], dtype=np.int64)
+    inputs["category"] = codes[np.minimum(np.searchsorted(ids, inputs["products"]), max(len(ids) - 1, 0))] if len(ids) \
+        else np.zeros(len(keys), dtype=np.int64)
+    return inputs
+
+# Function to write report inputs as the prompt's CSV sections: (past month sales, forecast sales, stock),
+# each line Date,Warehouse_ID,Product_ID,Sales or Warehouse_ID,Product_ID,Stock. Days without sales are left out.
+def input_tables(inputs):
+    def daily(first, values):
+        dates = [db.ts_day(db.to_ts(first) + d * 86400) for d in range(REPORT_DAYS)]
+        day, series = np.nonzero(values.T)
+        return "\n" + "\n".join(f"{dates[d]},{w},{p},{round(v)}" for d, w, p, v in zip(
+            day.tolist(), inputs["warehouses"][series].tolist(), inputs["products"][series].tolist(), values[series, day].tolist()))
+    stock = "\n" + "\n".join(f"{w},{p},{q}" for w, p, q in zip(
+        inputs["warehouses"].tolist(), inputs["products"].tolist(), inputs["stock"].tolist()))
+    return daily(inputs["sales_from"], inputs["sales"]), daily(inputs["forecast_from"], inputs["forecasts"]), stock
+
+# Metrics per product and per warehouse, computed here so the prompt carries a compact table
+# instead of raw daily rows. Sums are kept per group so any rows left out of a table can be
+# folded into one "others" line.
+SUMS = ["first_half", "second_half", "forecast", "stock"]
+COLUMNS = "Units_Sold,Avg_Daily,Growth_%,Forecast_Units,Forecast_Delta_%,Stock,Cover_Days"
+
+# Function to sum each series' sales halves, forecast total and stock into groups:
+# (group ids, sums shaped groups x len(SUMS))
+def group_sums(inputs, by):
+    half = REPORT_DAYS // 2
+    per_series = np.column_stack([inputs["sales"][:, :half].sum(axis=1), inputs["sales"][:, half:].sum(axis=1),
+                                  inputs["forecasts"].sum(axis=1), inputs["stock"]])
+    ids, at = np.unique(inputs[by], return_inverse=True)
+    sums = np.zeros((len(ids), len(SUMS)))
+    np.add.at(sums, at, per_series)
+    return ids, sums
+
+# Function to derive the metric columns from group sums, NaN where undefined:
+# units sold, average daily sales, growth of the second half over the first (%), forecast units,
+# forecast change over the past period (%), stock, and days the stock covers at the average rate
+def report_metrics(sums):
+    first, second, forecast, stock = sums.T
+    units = first + second
+    average = units / REPORT_DAYS
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = np.where(first > 0, (second - first) / first * 100, np.nan)
+        delta = np.where(units > 0, (forecast - units) / units * 100, np.nan)
+        cover = np.where(average > 0, stock / average, np.nan)
+    return np.column_stack([units, average, growth, forecast, delta, stock, cover])
+
+# The metrics table lines for the `limit` best-selling groups, plus an "others" line summing the rest
+def _metrics_rows(label, ids, sums, limit):
+    order = np.argsort(-(sums[:, 0] + sums[:, 1]), kind="stable")
+    shown, rest = order[:limit], order[limit:]
+    names = [str(i) for i in ids[shown].tolist()]
+    if len(rest):
+        names.append(f"others ({len(rest)} {label}s)")
+        sums = np.vstack([sums[shown], sums[rest].sum(axis=0)])
+    else:
+        sums = sums[shown]
+    lines = []
+    for name, row in zip(names, report_metrics(sums).tolist()):
+        lines.append(name + "," + ",".join("-" if v != v else f"{v:.1f}" if k in (1, 2, 4, 6) else f"{v:.0f}"
+                                           for k, v in enumerate(row)))
+    return "\n".join(lines)
+
+# Rough token count for llama3's tokenizer without shipping it: words cost a token per 4 letters,
+# numbers a token per 3 digits and every other symbol a token, which errs on the high side
+_token_re = re.compile(r"[^\W\d_]+|\d+|\S")
+
+def count_tokens(text):
+    return sum(-(-len(t) // 4) if t[0].isalpha() else -(-len(t) // 3) if t[0].isdigit() else 1
+               for t in _token_re.findall(text))
 
 dynamic_allocation = """ """
 
-def generate_report(past_month_sales_data, forecasted_sales_data, monthly_stock, dynamic_allocation):
+PROMPT_VERSION = 3      # bump whenever the prompt text or the metrics change
+MODEL = "llama3-8b-8192"
+CONTEXT_TOKENS = 8192   # the model's context, shared by the prompt and the completion
+MAX_TOKENS = 2048       # completion tokens requested
+PROMPT_TOKEN_BUDGET = CONTEXT_TOKENS - MAX_TOKENS - 256   # what the prompt may use, less chat formatting overhead
+
+METRICS_HELP = """Units_Sold is the total sold, Avg_Daily the average units sold per day, Growth_% the change in sales of the last {half} days over the {half} days before, Forecast_Units the forecast sales for the next {days} days, Forecast_Delta_% the change the forecast makes over the last {days} days, Stock the units currently held, and Cover_Days how many days that stock lasts at the average daily sales. A "-" means the metric is undefined. Rows are ordered by Units_Sold; an "others" row sums the rest."""
 
-    message = """
-    Given under the heading "past month sales data" is the data for sales of products of the company XYZ in the last month. Given under the heading "forecasted sales data" are the forecasted sales for the next month. Given under the heading "monthly stock" is the total amount of stock stored for each product at each warehouse. Please understand the data first.
+SYSTEM_PROMPT = "You are an expert product sales analyst. You look at product data for the past month and predictions for the next month. Your task is to create a detailed and incisive report consisting of sales insights for the company."
 
-    past month sales data:
-    <Date,Warehouse_ID,Product_ID,Sales
-    {past_month_sales_data}>
+PROMPT = """
+    Given under the heading "product metrics" are the sales metrics of each product of the company XYZ over the last {days} days, and under "warehouse metrics" the same metrics for each warehouse. {metrics_help} Please understand the data first.
 
-    forecasted sales data:
-    <Date,Warehouse_ID,Product_ID,Sales
-    {forecasted_sales_data}>
+    product metrics:
+    <Product_ID,{columns}
+    {product_metrics}>
 
-    monthly stock:
-    <Warehouse_ID,Product_ID,Stock
-    {monthly_stock}>
-    >
+    warehouse metrics:
+    <Warehouse_ID,{columns}
+    {warehouse_metrics}>
 
     dynamic allocation:
     <
@@ -526,73 +182,254 @@ def generate_report(past_month_sales_data, forecasted_sales_data, monthly_stock,
     1. Create a detailed product performance review for each product (Average Daily Sales, Sales Growth Rate, Total Units Sold, and more).
     2. Create a detailed warehouse performance review for each warehouse (Average Daily Sales, Sales Growth Rate, Total Units Sold, and more).
     3. Never only present tabular information. Always provide key insights and suggestions based on the data.
-    4. Generate key insights from the "forecasted sales data".
+    4. Generate key insights from the forecast sales.
+    5. If the "dynamic allocation" header has data present under it, generate key insights on the changes in allocations made for the coming month. IF it is empty, always ignore.
+    6. Generate suggestions and improvements on improving inventory management by increasing/decreasing supply of products wherever required. Always provide actual amounts.
+    7. Note that improvements to warehouses are not of concern to the company. The company is only concerned about improvements for the products. Do not mention this in the report.
+    """
+
+def _metrics_format(**fields):
+    metrics_help = METRICS_HELP.format(days=REPORT_DAYS, half=REPORT_DAYS // 2)
+    return dict(fields, days=REPORT_DAYS, half=REPORT_DAYS // 2, columns=COLUMNS, metrics_help=metrics_help,
+                dynamic_allocation=dynamic_allocation)
+
+def _report_prompt(products, warehouses, limit):
+    return PROMPT.format(**_metrics_format(product_metrics=_metrics_rows("product", *products, limit),
+                                           warehouse_metrics=_metrics_rows("warehouse", *warehouses, limit)))
+
+# Function to build the report prompt from report inputs within the token budget.
+# When every row does not fit, each table keeps its best-selling rows and folds the rest into an
+# "others" row, with the row limit found by binary search on the counted tokens.
+def build_prompt(inputs, budget=PROMPT_TOKEN_BUDGET):
+    products = group_sums(inputs, "products")
+    warehouses = group_sums(inputs, "warehouses")
+    lo, hi = 0, max(len(products[0]), len(warehouses[0]))
+    if count_tokens(SYSTEM_PROMPT + _report_prompt(products, warehouses, hi)) <= budget:
+        return _report_prompt(products, warehouses, hi)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(SYSTEM_PROMPT + _report_prompt(products, warehouses, mid)) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    message = _report_prompt(products, warehouses, lo)
+    if count_tokens(SYSTEM_PROMPT + message) > budget:
+        raise ValueError(f"report prompt does not fit in {budget} tokens")
+    return message
+
+
+# Map-reduce for clients too large for one prompt. The series are split into sections by product
+# category (or by warehouse), the LLM writes a section report for each with at most MAP_CONCURRENCY
+# calls in flight, and the section reports are merged, level by level while they do not fit one
+# prompt, into the final report. Latency grows with the depth of that tree, not the client's size.
+
+SECTION_TOKENS = 768    # completion tokens for a section report or an intermediate merge
+SECTION_TOKEN_BUDGET = CONTEXT_TOKENS - SECTION_TOKENS - 256
+MAP_CONCURRENCY = 4     # section and merge calls in flight at once
+SPLIT_BY = "category"   # "category" or "warehouse"
+
+SECTION_PROMPT = """
+    Given under the heading "product metrics" are the sales metrics of the products in one section of the company XYZ ({section}) over the last {days} days, and under "warehouse metrics" the same metrics for those products in each warehouse. {metrics_help} Please understand the data first.
+
+    product metrics:
+    <Product_ID,{columns}
+    {product_metrics}>
+
+    warehouse metrics:
+    <Warehouse_ID,{columns}
+    {warehouse_metrics}>
+
+    Now write a concise report on this section only, which will be merged with the reports on the other sections:
+    1. Review the performance of each product (Average Daily Sales, Sales Growth Rate, Total Units Sold) and of each warehouse for these products.
+    2. Generate key insights from the forecast sales.
+    3. Suggest increasing or decreasing the supply of products wherever required. Always provide actual amounts.
+    """
+
+MERGE_PROMPT = """
+    Given under the heading "section reports" are reports on separate sections of the products of the company XYZ. Merge them into one concise report on all of these sections, keeping every product's figures, insights and supply suggestions with their amounts.
+
+    section reports:
+    <{sections}>
+    """
+
+REDUCE_PROMPT = """
+    Given under the heading "section reports" are reports on separate sections of the products of the company XYZ, each written from that section's sales metrics over the last {days} days. Given under the heading "warehouse metrics" are the same metrics for each warehouse across all products. {metrics_help} Please understand the data first.
+
+    section reports:
+    <{sections}>
+
+    warehouse metrics:
+    <Warehouse_ID,{columns}
+    {warehouse_metrics}>
+
+    dynamic allocation:
+    <
+    {dynamic_allocation}>
+
+    Now, follow the instructions given below  and create your report from the section reports:
+    1. Create a detailed product performance review for each product (Average Daily Sales, Sales Growth Rate, Total Units Sold, and more).
+    2. Create a detailed warehouse performance review for each warehouse (Average Daily Sales, Sales Growth Rate, Total Units Sold, and more).
+    3. Never only present tabular information. Always provide key insights and suggestions based on the data.
+    4. Generate key insights from the forecast sales.
     5. If the "dynamic allocation" header has data present under it, generate key insights on the changes in allocations made for the coming month. IF it is empty, always ignore.
     6. Generate suggestions and improvements on improving inventory management by increasing/decreasing supply of products wherever required. Always provide actual amounts.
     7. Note that improvements to warehouses are not of concern to the company. The company is only concerned about improvements for the products. Do not mention this in the report.
     """
 
-    message = message.format(
-    past_month_sales_data=past_month_sales_data,
-    forecasted_sales_data=forecasted_sales_data,
-    monthly_stock=monthly_stock,
-    dynamic_allocation=dynamic_allocation
-    )
-
-    client = Groq(
-        api_key=key,
-    )
-
-    chat_completion = client.chat.completions.create(
-        #
-        # Required parameters
-        #
-        messages=[
-            # Set an optional system message. This sets the behavior of the
-            # assistant and can be used to provide specific instructions for
-            # how it should behave throughout the conversation.
-            {
-                "role": "system",
-                "content": "You are an expert product sales analyst. You look at product data for the past month and predictions for the next month. Your task is to create a detailed and incisive report consisting of sales insights for the company."
-            },
-            # Set a user message for the assistant to respond to.
-            {
-                "role": "user",
-                "content": message,
-            }
-        ],
-
-        # The language model which will generate the completion.
-        model="llama3-8b-8192",
-
-        #
-        # Optional parameters
-        #
-
-        # Controls randomness: lowering results in less random completions.
-        # As the temperature approaches zero, the model will become
-        # deterministic and repetitive.
-        temperature=0,
-
-        # The maximum number of tokens to generate. Requests can use up to
-        # 2048 tokens shared between prompt and completion.
-        max_tokens=2048,
-
-        # Controls diversity via nucleus sampling: 0.5 means half of all
-        # likelihood-weighted options are considered.
-        top_p=1,
-
-        # A stop sequence is a predefined or user-specified text string that
-        # signals an AI to stop generating content, ensuring its responses
-        # remain focused and concise. Examples include punctuation marks and
-        # markers like "[end]".
-        stop=None,
-
-        # If set, partial message deltas will be sent.
-        stream=False,
-    )
-
-    return chat_completion.choices[0].message.content
+SERIES_FIELDS = ("products", "warehouses", "sales", "forecasts", "stock", "category")
+
+def _subset(inputs, rows):
+    return dict(inputs, **{name: inputs[name][rows] for name in SERIES_FIELDS})
+
+def _section_prompt(inputs, rows, section):
+    part = _subset(inputs, rows)
+    products = group_sums(part, "products")
+    warehouses = group_sums(part, "warehouses")
+    return SECTION_PROMPT.format(**_metrics_format(section=section,
+                                                   product_metrics=_metrics_rows("product", *products, len(products[0])),
+                                                   warehouse_metrics=_metrics_rows("warehouse", *warehouses, len(warehouses[0]))))
 
+def _sections_text(sections):
+    return "\n\n".join(f"section {i + 1} ({title}):\n{text.strip()}" for i, (title, text) in enumerate(sections))
+
+# Function to split report inputs into sections whose prompts fit the section budget: [(title, series rows)].
+# A category or warehouse too big for one prompt is halved between its products, best sellers first,
+# until each part fits; neighbouring groups small enough to share a prompt are packed together.
+def plan_sections(inputs, by=SPLIT_BY, budget=SECTION_TOKEN_BUDGET):
+    if by == "category":
+        keys, names = inputs["category"], [f"category {c or 'uncategorised'}" for c in inputs["categories"]]
+    elif by == "warehouse":
+        keys = inputs["warehouses"]
+        names = {w: f"warehouse {w}" for w in np.unique(keys).tolist()}
+    else:
+        raise ValueError(f"cannot split reports by {by}")
+    units = np.asarray(inputs["sales"].sum(axis=1))
+
+    def fits(rows, title):
+        return count_tokens(SYSTEM_PROMPT + _section_prompt(inputs, rows, title)) <= budget
+
+    parts = []
+    for key in np.unique(keys).tolist():
+        pending, done = [np.flatnonzero(keys == key)], []
+        while pending:
+            rows = pending.pop(0)
+            if fits(rows, f"{names[key]}, part 1 of 1"):
+                done.append(rows)
+                continue
+            products, at = np.unique(inputs["products"][rows], return_inverse=True)
+            if len(products) < 2:
+                raise ValueError(f"product {products[0]} does not fit in a {budget} token section prompt")
+            sold = np.zeros(len(products))
+            np.add.at(sold, at, units[rows])
+            first = np.isin(inputs["products"][rows], products[np.argsort(-sold, kind="stable")[:len(products) // 2]])
+            pending[:0] = [rows[first], rows[~first]]
+        parts += [(names[key] if len(done) == 1 else f"{names[key]}, part {i + 1} of {len(done)}", rows)
+                  for i, rows in enumerate(done)]
+
+    sections = []
+    for title, rows in parts:
+        if sections:
+            merged_title, merged_rows = f"{sections[-1][0]}; {title}", np.concatenate([sections[-1][1], rows])
+            if fits(merged_rows, merged_title):
+                sections[-1] = (merged_title, merged_rows)
+                continue
+        sections.append((title, rows))
+    return sections
+
+def _complete_all(prompts, max_tokens, client=None):
+    client = client or llm.client
+    with ThreadPoolExecutor(MAP_CONCURRENCY) as pool:
+        return list(pool.map(lambda message: client.complete(SYSTEM_PROMPT, message, MODEL, max_tokens), prompts))
+
+# Function to write the message for the final report call: (message, {"sections", "calls", "depth"}).
+# A client whose metrics fit one prompt gets build_prompt(); a larger one is reported on section by section
+# and the section reports are merged until they fit the final prompt. The section and merge calls go
+# to `client`, an LLM client as in llm.py, by default llm.client.
+def final_prompt(inputs, by=SPLIT_BY, client=None):
+    products = group_sums(inputs, "products")
+    warehouses = group_sums(inputs, "warehouses")
+    single = _report_prompt(products, warehouses, max(len(products[0]), len(warehouses[0])))
+    if count_tokens(SYSTEM_PROMPT + single) <= PROMPT_TOKEN_BUDGET:
+        return single, {"sections": 1, "calls": 1, "depth": 1}
+
+    sections = plan_sections(inputs, by)
+    texts = _complete_all([_section_prompt(inputs, rows, title) for title, rows in sections], SECTION_TOKENS, client)
+    reports = [(title, text) for (title, _), text in zip(sections, texts)]
+    stats = {"sections": len(sections), "calls": len(sections) + 1, "depth": 2}
+
+    def reduce_prompt(parts):
+        # The warehouse table shrinks to its best sellers and an "others" row if it would crowd out the sections
+        for limit in (len(warehouses[0]), 20, 0):
+            message = REDUCE_PROMPT.format(**_metrics_format(sections=_sections_text(parts),
+                                                             warehouse_metrics=_metrics_rows("warehouse", *warehouses, limit)))
+            if count_tokens(SYSTEM_PROMPT + message) <= PROMPT_TOKEN_BUDGET:
+                break
+        return message
+
+    while count_tokens(SYSTEM_PROMPT + reduce_prompt(reports)) > PROMPT_TOKEN_BUDGET:
+        groups = [[]]
+        for report in reports:
+            if groups[-1] and count_tokens(SYSTEM_PROMPT + MERGE_PROMPT.format(sections=_sections_text(groups[-1] + [report]))) \
+                    > SECTION_TOKEN_BUDGET:
+                groups.append([])
+            groups[-1].append(report)
+        if len(groups) == len(reports):
+            raise ValueError("section reports are too long to merge")
+        merged = _complete_all([MERGE_PROMPT.format(sections=_sections_text(group)) for group in groups], SECTION_TOKENS, client)
+        reports = [("; ".join(title for title, _ in group), text) for group, text in zip(groups, merged)]
+        stats["calls"] += len(groups)
+        stats["depth"] += 1
+    return reduce_prompt(reports), stats
+
+# Function to generate a report from a built prompt with the configured LLM client
+def generate_report(message):
+    return llm.client.complete(SYSTEM_PROMPT, message, MODEL, MAX_TOKENS)
+
+# Function to get the state of everything a report reads: the inventory version, the last ledger
+# transaction, the last forecast refresh and the day. Any write a report could see changes it.
+def data_stamp():
+    conn = db.get_conn()
+    return (db.inventory_version(), conn.execute("SELECT MAX(transaction_id) FROM transactions").fetchone()[0],
+            conn.execute("SELECT through, data_version FROM forecast_refresh WHERE id = 1").fetchone(), db.ts_day(db.now_ts()))
+
+_input_hashes = {}      # (database, client_id) -> (data stamp, input hash) of the client's last report inputs
+
+# Function to look a client's report up in the cache: (report or None, cache key, inputs pulled or None).
+# While the data stamp is unchanged the inputs are not even pulled again.
+def cached_report(username):
+    stamp = data_stamp()
+    known = _input_hashes.get((db.proddb, username))
+    looked_up = None
+    if known is not None and known[0] == stamp:
+        looked_up = reportcache.report_key(username, known[1], PROMPT_VERSION, MODEL)
+        report = reportcache.cache.get(looked_up)
+        if report is not None:
+            return report, looked_up, None
+    inputs = report_inputs(username)
+    digest = reportcache.input_hash(inputs)
+    _input_hashes[(db.proddb, username)] = (stamp, digest)
+    key = reportcache.report_key(username, digest, PROMPT_VERSION, MODEL)
+    report = reportcache.cache.get(key) if key != looked_up else None
+    return report, key, inputs
+
+# Function to get a client's report, generating it only when no report exists for the same inputs,
+# prompt version and model
 def gen_report(username):
-    return generate_report(past_month_sales_data, forecasted_sales_data, monthly_stock, dynamic_allocation)
\ No newline at end of file
+    report, key, inputs = cached_report(username)
+    if report is None:
+        report = generate_report(final_prompt(inputs)[0])
+        reportcache.cache.put(key, username, report)
+    return report
+
+# Function to stream a client's report as text deltas: a cached report comes as one piece, otherwise
+# the model's deltas are passed on as they arrive and the completed report is cached
+def stream_report(username):
+    report, key, inputs = cached_report(username)
+    if report is not None:
+        yield report
+        return
+    parts = []
+    for delta in llm.client.stream(SYSTEM_PROMPT, final_prompt(inputs)[0], MODEL, MAX_TOKENS):
+        parts.append(delta)
+        yield delta
+    reportcache.cache.put(key, username, "".join(parts))
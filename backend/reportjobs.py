@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import reportgen
+
+# Background report generation for /api/v1/reportgen, /reportgen/jobs and /reportgen/stream.
+# A submitted report runs on a worker pool instead of the request thread and is polled by job id,
+# or followed delta by delta as the model writes it. A client has at most one job in flight:
+# submitting again while it is queued or running returns the same job, and a late follower is
+# replayed the deltas it missed. A job not finished within the timeout (counted from submission) is
+# reported as timed out and stops blocking new submissions; its completion, if it arrives, still
+# fills the cache.
+#   SPACIFY_REPORT_WORKERS     concurrent report generations (default 4)
+#   SPACIFY_REPORT_TIMEOUT     seconds before a job times out (default 120)
+
+REPORT_WORKERS = int(os.environ.get("SPACIFY_REPORT_WORKERS", 4))
+REPORT_TIMEOUT = float(os.environ.get("SPACIFY_REPORT_TIMEOUT", 120))
+JOB_TTL = 3600          # seconds a finished job stays pollable
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+
+class ReportJobs:
+    def __init__(self, workers=REPORT_WORKERS, timeout=REPORT_TIMEOUT, job_ttl=JOB_TTL):
+        self.workers = workers
+        self.timeout = timeout
+        self.job_ttl = job_ttl
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)   # notified on every delta and status change
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="report")
+        self.jobs = {}                  # job_id -> job
+        self.inflight = {}              # client_id -> job_id of its queued or running job
+        self.finished = {}              # job_id -> Event set once the job leaves the queue for good
+        self.submitted = self.merged = 0
+
+    # Function to queue a report for a client; returns the job, merged into the client's job in flight if any
+    def submit(self, client_id):
+        with self.lock:
+            self._expire()
+            job_id = self.inflight.get(client_id)
+            if job_id is not None:
+                self.merged += 1
+                return _public(self.jobs[job_id])
+            job_id = uuid.uuid4().hex
+            job = {"job_id": job_id, "client_id": client_id, "status": QUEUED, "submitted_at": time.time(),
+                   "started_at": None, "finished_at": None, "report": None, "error": None, "deltas": []}
+            self.jobs[job_id] = job
+            self.inflight[client_id] = job_id
+            self.finished[job_id] = threading.Event()
+            self.submitted += 1
+        self.pool.submit(self._run, job_id)
+        return _public(job)
+
+    def _run(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            if self._timed_out(job):
+                return
+            job["status"] = RUNNING
+            job["started_at"] = time.time()
+        try:
+            for delta in reportgen.stream_report(job["client_id"]):
+                with self.lock:
+                    job["deltas"].append(delta)
+                    self.changed.notify_all()
+            report, error = "".join(job["deltas"]), None
+        except Exception as e:
+            report, error = None, f"{type(e).__name__}: {e}"
+        with self.lock:
+            if job["status"] == RUNNING:
+                job["status"] = DONE if error is None else FAILED
+                job["report"] = report
+                job["error"] = error
+                job["finished_at"] = time.time()
+                self._release(job)
+
+    # Mark a job that outlived the timeout; called with the lock held
+    def _timed_out(self, job):
+        if job["status"] in (QUEUED, RUNNING) and time.time() - job["submitted_at"] > self.timeout:
+            job["status"] = TIMED_OUT
+            job["error"] = f"not finished within {self.timeout:g}s"
+            job["finished_at"] = time.time()
+            self._release(job)
+        return job["status"] == TIMED_OUT
+
+    def _release(self, job):
+        if self.inflight.get(job["client_id"]) == job["job_id"]:
+            del self.inflight[job["client_id"]]
+        self.finished[job["job_id"]].set()
+        self.changed.notify_all()
+
+    # Drop finished jobs older than job_ttl; called with the lock held
+    def _expire(self):
+        cutoff = time.time() - self.job_ttl
+        for job_id in [j for j, job in self.jobs.items() if job["finished_at"] is not None and job["finished_at"] < cutoff]:
+            del self.jobs[job_id]
+            del self.finished[job_id]
+
+    # Function to get a job's current state, or None for an unknown or expired job id
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            self._timed_out(job)
+            return _public(job)
+
+    # Function to yield a job's report deltas from the first one, as the model writes them, until it
+    # is done. Raises KeyError for an unknown job and RuntimeError if it fails or times out.
+    def follow(self, job_id):
+        sent = 0
+        while True:
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    raise KeyError(job_id)
+                while len(job["deltas"]) == sent and not self._timed_out(job) and job["status"] in (QUEUED, RUNNING):
+                    self.changed.wait(max(job["submitted_at"] + self.timeout - time.time(), 0) + 0.05)
+                deltas = job["deltas"][sent:]
+                status, error = job["status"], job["error"]
+            if status in (FAILED, TIMED_OUT):
+                raise RuntimeError(error)
+            sent += len(deltas)
+            yield from deltas
+            if status == DONE and not deltas:
+                return
+
+    # Function to wait for a job to finish or time out; returns its final state
+    def wait(self, job_id):
+        event = self.finished.get(job_id)
+        if event is not None:
+            job = self.status(job_id)
+            if job is not None:
+                event.wait(max(self.timeout - (time.time() - job["submitted_at"]), 0) + 0.05)
+        return self.status(job_id)
+
+    # Function to get job counts for monitoring
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {"workers": self.workers, "timeout": self.timeout, "submitted": self.submitted,
+                    "merged": self.merged, "in_flight": len(self.inflight), "jobs": counts}
+
+
+# A job as returned to callers, without its delta buffer
+def _public(job):
+    return {name: value for name, value in job.items() if name != "deltas"}
+
+
+jobs = ReportJobs()
@@ -0,0 +1,317 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import dbserver as db
+import invmatrix as inv
+
+# Nearest-warehouse order routing for /api/v1/route_order.
+# Warehouses with coordinates are held in an in-memory KD-tree over unit vectors on the
+# sphere (straight-line chord order equals great-circle order), built from the warehouses
+# table and grown in place by add_warehouse. Stock comes from the in-memory inventory matrix.
+
+EARTH_RADIUS_KM = 6371.0
+LEAF_SIZE = 32          # points per leaf; a leaf is split once it grows past twice this
+BRUTE_FORCE_MAX = 2048  # stocked candidates up to which distances are computed directly
+MAX_STALENESS = 1.0     # seconds between checks for warehouses added by other processes
+BATCH_CHUNK = 2048      # orders per distance matrix in batch routing
+
+
+# Function to convert degrees of latitude and longitude to unit vectors, shape (..., 3)
+def to_xyz(latitude, longitude):
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+# Function to convert squared chord lengths between unit vectors to great-circle kilometres
+def chord_km(chord_sq):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.sqrt(chord_sq) / 2, 1.0))
+
+
+class _Node:
+    __slots__ = ("axis", "split", "left", "right", "points")
+
+    def __init__(self, points):
+        self.axis = self.split = self.left = self.right = None
+        self.points = points            # point indices for a leaf, None once split
+
+
+class WarehouseIndex:
+    def __init__(self, max_staleness=MAX_STALENESS):
+        self.max_staleness = max_staleness
+        self.lock = threading.RLock()
+        self.path = None
+        self._clear()
+
+    def _clear(self):
+        self.xyz = np.zeros((0, 3), dtype=np.float64)
+        self.warehouse_ids = np.zeros(0, dtype=np.int64)
+        self.size = 0
+        self.points = {}                # warehouse_id -> point index
+        self.root = _Node(np.zeros(0, dtype=np.int64))
+        self.max_warehouse_id = 0
+        self.checked = 0.0
+        self._cols_key = None           # inventory matrix layout the column maps were built for
+        self.col_of_point = np.zeros(0, dtype=np.int64)
+        self.point_of_col = np.zeros(0, dtype=np.int64)
+
+    # Function to (re)build the whole index from the warehouses table
+    def load(self):
+        with self.lock:
+            self._clear()
+            self.path = db.proddb
+            rows = db.get_conn().execute("SELECT warehouse_id, latitude, longitude FROM warehouses").fetchall()
+            self._append(rows)
+            self.root = self._build(np.arange(self.size, dtype=np.int64))
+            self.checked = time.monotonic()
+
+    # Store rows of (warehouse_id, latitude, longitude) as points; returns the new point indices
+    def _append(self, rows):
+        for warehouse_id, _, _ in rows:
+            self.max_warehouse_id = max(self.max_warehouse_id, warehouse_id)
+        rows = [r for r in rows if r[1] is not None and r[2] is not None and r[0] not in self.points]
+        start = self.size
+        if rows:
+            self.size += len(rows)
+            if self.size > len(self.xyz):
+                capacity = max(self.size, len(self.xyz) * 2, 64)
+                xyz = np.zeros((capacity, 3), dtype=np.float64)
+                xyz[:start] = self.xyz[:start]
+                ids = np.zeros(capacity, dtype=np.int64)
+                ids[:start] = self.warehouse_ids[:start]
+                self.xyz, self.warehouse_ids = xyz, ids
+            ids = [r[0] for r in rows]
+            self.xyz[start:self.size] = to_xyz([r[1] for r in rows], [r[2] for r in rows])
+            self.warehouse_ids[start:self.size] = ids
+            self.points.update(zip(ids, range(start, self.size)))
+            self._cols_key = None
+        return np.arange(start, self.size, dtype=np.int64)
+
+    # Median split on the widest axis until every leaf holds at most LEAF_SIZE points
+    def _build(self, points):
+        node = _Node(points)
+        if len(points) > LEAF_SIZE:
+            coords = self.xyz[points]
+            axis = int(np.argmax(coords.max(axis=0) - coords.min(axis=0)))
+            mid = len(points) // 2
+            order = np.argpartition(coords[:, axis], mid)
+            node.axis = axis
+            node.split = float(coords[order[mid], axis])
+            node.left = self._build(points[order[:mid]])
+            node.right = self._build(points[order[mid:]])
+            node.points = None
+        return node
+
+    # Insert points into the existing tree, splitting only the leaves that overflow
+    def _insert(self, points):
+        for point in points.tolist():
+            node = self.root
+            while node.points is None:
+                node = node.left if self.xyz[point, node.axis] < node.split else node.right
+            node.points = np.append(node.points, point)
+            if len(node.points) > 2 * LEAF_SIZE:
+                split = self._build(node.points)
+                node.axis, node.split, node.left, node.right, node.points = (
+                    split.axis, split.split, split.left, split.right, split.points)
+
+    # Incremental update: registered as a dbserver warehouse listener, called after add_warehouse commits
+    def add(self, warehouse_id, latitude, longitude):
+        with self.lock:
+            if self.path != db.proddb:
+                return
+            self._insert(self._append([(warehouse_id, latitude, longitude)]))
+
+    # Pull warehouses added by other processes since the last check
+    def refresh(self):
+        with self.lock:
+            if self.path != db.proddb:
+                self.load()
+                return
+            rows = db.get_conn().execute("""
+            SELECT warehouse_id, latitude, longitude FROM warehouses WHERE warehouse_id > ?
+            """, (self.max_warehouse_id,)).fetchall()
+            self._insert(self._append(rows))
+            self.checked = time.monotonic()
+
+    def _fresh(self):
+        if self.path != db.proddb or time.monotonic() - self.checked > self.max_staleness:
+            self.refresh()
+
+    # Map points to inventory matrix columns and back; rebuilt when either side changes layout
+    def _columns(self, matrix):
+        key = (matrix.generation, len(matrix.warehouse_cols), self.size)
+        if key != self._cols_key:
+            cols = matrix.warehouse_cols
+            self.col_of_point = np.array([cols.get(w, -1) for w in self.warehouse_ids[:self.size].tolist()], dtype=np.int64)
+            self.point_of_col = np.full(len(cols), -1, dtype=np.int64)
+            mapped = self.col_of_point >= 0
+            self.point_of_col[self.col_of_point[mapped]] = np.flatnonzero(mapped)
+            self._cols_key = key
+
+    # Best-first KD-tree search for the k nearest points whose mask(points) is true
+    def _search(self, q, k, mask):
+        best = []                       # max-heap of (-chord_sq, point)
+        tie = itertools.count()
+        heap = [(0.0, next(tie), self.root)]
+        while heap:
+            bound, _, node = heapq.heappop(heap)
+            if len(best) == k and bound >= -best[0][0]:
+                break
+            if node.points is None:
+                diff = q[node.axis] - node.split
+                near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+                heapq.heappush(heap, (bound, next(tie), near))
+                heapq.heappush(heap, (max(bound, diff * diff), next(tie), far))
+                continue
+            points = node.points[mask(node.points)]
+            if not len(points):
+                continue
+            d = ((self.xyz[points] - q) ** 2).sum(axis=1)
+            for dist, point in zip(d.tolist(), points.tolist()):
+                if len(best) < k:
+                    heapq.heappush(best, (-dist, point))
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, (-dist, point))
+        return sorted((-d, p) for d, p in best)
+
+    # Function to find the nearest `count` warehouses holding at least `quantity` of a product:
+    # [(warehouse_id, distance_km, stock), ...] nearest first
+    def nearest(self, product_id, quantity, latitude, longitude, count=1, matrix=None):
+        matrix = matrix or inv.matrix
+        q = to_xyz(latitude, longitude)
+        with self.lock, matrix.lock:
+            self._fresh()
+            matrix._fresh()
+            row = matrix.product_rows.get(product_id)
+            if row is None or quantity < 1 or count < 1 or not self.size:
+                return []
+            self._columns(matrix)
+            line = matrix.quantity[row, :len(matrix.warehouse_cols)]
+            stocked = np.flatnonzero(line >= quantity)
+            if len(stocked) <= BRUTE_FORCE_MAX:
+                # Few holders of this product: distance to each of them beats walking the tree
+                points = self.point_of_col[stocked]
+                points = points[points >= 0]
+                d = ((self.xyz[points] - q) ** 2).sum(axis=1)
+                if len(points) > count:
+                    top = np.argpartition(d, count)[:count]
+                    points, d = points[top], d[top]
+                order = np.argsort(d)
+                found = list(zip(d[order].tolist(), points[order].tolist()))
+            else:
+                def mask(points):
+                    cols = self.col_of_point[points]
+                    return (cols >= 0) & (line[cols] >= quantity)
+                found = self._search(q, count, mask)
+            if not found:
+                return []
+            dist = chord_km(np.array([d for d, _ in found]))
+            ids = self.warehouse_ids[[p for _, p in found]].tolist()
+            stock = line[self.col_of_point[[p for _, p in found]]].tolist()
+            return list(zip(ids, dist.tolist(), stock))
+
+    # Function to assign a batch of orders [(product_id, quantity, latitude, longitude), ...] to warehouses.
+    # Orders are served in list order, each from the nearest warehouse still holding enough stock once the
+    # earlier orders in the batch have been taken out: [(warehouse_id, distance_km) or None, ...]
+    def assign(self, orders, matrix=None):
+        matrix = matrix or inv.matrix
+        assigned = [None] * len(orders)
+        if not orders:
+            return assigned
+        quantities = np.array([o[1] for o in orders], dtype=np.int64)
+        q_xyz = to_xyz([o[2] for o in orders], [o[3] for o in orders])
+        by_product = defaultdict(list)
+        for i, order in enumerate(orders):
+            by_product[order[0]].append(i)
+        with self.lock, matrix.lock:
+            self._fresh()
+            matrix._fresh()
+            self._columns(matrix)
+            for product_id, lines in by_product.items():
+                row = matrix.product_rows.get(product_id)
+                if row is None:
+                    continue
+                line = matrix.quantity[row, :len(matrix.warehouse_cols)]
+                cols = np.flatnonzero(line > 0)
+                points = self.point_of_col[cols]
+                cols, points = cols[points >= 0], points[points >= 0]
+                if not len(cols):
+                    continue
+                stock = line[cols].copy()   # remaining stock per candidate, decremented as orders are assigned
+                w_xyz = self.xyz[points]
+                lines = np.array(lines, dtype=np.int64)
+                for start in range(0, len(lines), BATCH_CHUNK):
+                    chunk = lines[start:start + BATCH_CHUNK]
+                    need = quantities[chunk]
+                    # Squared chord distance for every (order, candidate), masked by stock at the start of the chunk
+                    d = 2.0 - 2.0 * (q_xyz[chunk] @ w_xyz.T)
+                    d[need[:, None] > stock[None, :]] = np.inf
+                    best = np.argmin(d, axis=1)
+                    for k, i in enumerate(chunk.tolist()):
+                        q, j = need[k], best[k]
+                        if stock[j] < q:
+                            # An earlier order in this chunk took that stock; stock only falls, so re-mask this row
+                            j = int(np.argmin(np.where(stock >= q, d[k], np.inf)))
+                        if d[k, j] == np.inf:
+                            continue
+                        stock[j] -= q
+                        assigned[i] = (int(self.warehouse_ids[points[j]]), float(chord_km(max(d[k, j], 0.0))))
+        return assigned
+
+
+index = WarehouseIndex()
+db.warehouse_listeners.append(index.add)
+
+
+# Route helper: parameters arrive as query strings; raises ValueError on bad input
+def route_order(product_id, quantity, latitude, longitude, count=1):
+    product_id, quantity, count = int(product_id), int(quantity), int(count)
+    latitude, longitude = float(latitude), float(longitude)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude must be within [-90, 90] and longitude within [-180, 180]")
+    if quantity < 1 or count < 1:
+        raise ValueError("quantity and count must be positive")
+    return [(warehouse_id, inv.matrix.warehouse_names.get(warehouse_id), distance_km, stock)
+            for warehouse_id, distance_km, stock in index.nearest(product_id, quantity, latitude, longitude, count)]
+
+# Function to route a batch of orders and, unless preview, record the routed ones as sales in one
+# commit through dbserver.add_sales. orders is a list of dicts with product_id, quantity, latitude, longitude.
+def route_orders(orders, commit=True, all_or_nothing=False):
+    results = []
+    parsed = []
+    for i, order in enumerate(orders):
+        try:
+            product_id, quantity = int(order["product_id"]), int(order.get("quantity", 1))
+            latitude, longitude = float(order["latitude"]), float(order["longitude"])
+            if quantity < 1 or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise ValueError("quantity must be positive and coordinates in range")
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results.append({"line": i, "ok": False, "error": f"invalid order: {e}"})
+            continue
+        results.append({"line": i, "ok": True})
+        parsed.append((i, (product_id, quantity, latitude, longitude)))
+
+    routed = []
+    for (i, order), found in zip(parsed, index.assign([order for _, order in parsed])):
+        if found is None:
+            results[i].update(ok=False, error="no warehouse can fulfil this order")
+            continue
+        results[i].update(warehouse_id=found[0], distance_km=found[1])
+        routed.append((i, (order[0], found[0], order[1])))
+
+    committed = False
+    if commit:
+        if all_or_nothing and len(routed) < len(results):
+            print(f"Error: batch routing rolled back, {len(results) - len(routed)} of {len(results)} orders not routed")
+        else:
+            sales = db.add_sales([sale for _, sale in routed], all_or_nothing)
+            committed = sales["committed"]
+            for (i, _), sale in zip(routed, sales["results"]):
+                if not sale["ok"]:
+                    results[i].update(ok=False, error=sale["error"])
+    passed = sum(1 for r in results if r["ok"])
+    return {"committed": committed, "routed": passed, "unrouted": len(results) - passed, "results": results}
@@ -0,0 +1,19 @@
+import bench
+import dbserver as db
+
+# Query plan regression check: every query in dbserver.HOT_QUERIES must be answered from an index.
+# Runs under pytest (python -m pytest test_plans.py) or on its own (python test_plans.py), and
+# bench.py plans runs it too.
+
+
+def test_hot_queries_use_an_index():
+    bench.setup_db()
+    scans = db.full_scan_queries()
+    assert not scans, "hot queries fall back to a full scan or sort: " + "; ".join(
+        f"{name}: {detail}" for name, detail in scans)
+
+
+if __name__ == "__main__":
+    test_hot_queries_use_an_index()
+    print(f"query plans: all {len(db.HOT_QUERIES)} hot queries use an index")
+    db.close_all()
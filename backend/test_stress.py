@@ -0,0 +1,56 @@
+import threading
+import time
+
+import bench
+import dbserver as db
+
+# Concurrent add_transaction stress test: oversubscribes one SKU from several threads and checks
+# that stock, successful sales and logged rows all agree (no lost updates, no overselling).
+# Runs under pytest (python -m pytest test_stress.py) or on its own; bench.py stress runs the same
+# check with more threads and reports throughput.
+
+THREADS = 4             # kept small so the test is quick and stable on a CI runner
+SALES_PER_THREAD = 100
+
+
+# Function to sell one unit at a time from `threads` threads against stock for 3/4 of the attempts.
+# Returns (stock, sold, stock left, (logged sale rows, units logged), seconds).
+def sell_concurrently(threads, sales_per_thread):
+    bench.setup_db()
+    stock = threads * sales_per_thread * 3 // 4
+    db.update_inventory(1, 1, stock)
+    ok = [0] * threads
+
+    def worker(t):
+        for _ in range(sales_per_thread):
+            if db.add_transaction(1, 1, "sale", -1):
+                ok[t] += 1
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+    elapsed = time.perf_counter() - start
+
+    sold = sum(ok)
+    left = db.get_inventory_by_product_and_warehouse(1, 1)[0][3]
+    logged = db.get_conn().execute("SELECT COUNT(*), -SUM(quantity) FROM transactions WHERE type_id = ?", (db.SALE,)).fetchone()
+    return stock, sold, left, logged, elapsed
+
+def assert_consistent(stock, sold, left, logged):
+    assert sold == stock, f"sold {sold} of stock {stock}"
+    assert left == 0, f"stock left {left} after selling out"
+    assert logged == (sold, sold), f"logged {logged[0]} rows totalling {logged[1]} for {sold} sales"
+
+
+def test_concurrent_sales_keep_stock_consistent():
+    stock, sold, left, logged, _ = sell_concurrently(THREADS, SALES_PER_THREAD)
+    assert_consistent(stock, sold, left, logged)
+
+
+if __name__ == "__main__":
+    test_concurrent_sales_keep_stock_consistent()
+    print(f"stress: {THREADS} threads x {SALES_PER_THREAD} sales, stock consistent")
+    db.close_all()
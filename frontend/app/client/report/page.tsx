@@ -17,17 +17,23 @@ export default function Page() {
     }
 
 
-    const res = await fetch(
-      `https://spacifyapi.pythonanywhere.com/api/v1/reportgen?email=${email}`
+    // The report streams in as the model writes it
+    const source = new EventSource(
+      `https://spacifyapi.pythonanywhere.com/api/v1/reportgen/stream?email=${email}`
     );
-
-    if (res.status == 200) {
+    let text = "";
+    source.onmessage = (event) => {
+      text += JSON.parse(event.data);
+      setReport(text);
+    };
+    source.addEventListener("end", () => {
+      source.close();
       toast.success("Report generated successfully");
-      const data = await res.text();
-      setReport(data);
-    } else {
+    });
+    source.addEventListener("error", () => {
+      source.close();
       toast.error("Report generation failed");
-    }
+    });
 
   };
 